@@ -1,60 +1,215 @@
+import multiprocessing
 import os
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, ThreadPoolExecutor, wait
 from pathlib import Path
-from config_manager import Config
+from config_manager import DIRECTORY_SETTINGS, RESYNC_SETTINGS, Config
+import tracing
 
-from fetch import fetch_hack_list_from_server
+from catalog import RomList, RomTable, read_catalog
+
+from fetch import fetch_hack_list_from_server, load_cached_hack_list
+from patch import apply_patch, share_base_roms
+from install_queue import InstallQueue
+from base_roms import BaseRomFingerprints
+from library import LibraryManifest
+from materialized import MaterializedCache
+from patch_cache import PatchCache
+from search_index import SearchIndex
+from storage import migrate_library
 from rom import GBARom, NDSRom
 
 # Acts as API for the GUI
 
+ROM_CLASSES = {"gba": GBARom, "nds": NDSRom}
+
+# How many catalog entries the GUI merges per event loop callback
+SYNC_BATCH_SIZE = 200
+
+def empty_changes():
+    # What a catalog sync reports back, lists of hack ids
+    return {"added": [], "updated": [], "removed": []}
+
 class RomLauncherService:
     
-    def __init__(self):
+    def __init__(self, sync_on_start=True, install_concurrency=None):
         self.config = Config()
-        self._roms = {} # Stores ROM objects, keyed by hack_id
+        tracing.configure_from(self.config)
+        self._roms = RomTable(self._make_rom) # ROM objects keyed by hack_id, made as they're looked up
+        self._catalog_version = None
+        self.search_index = SearchIndex() # Kept in step with _roms by _merge_entry
+
+        # What's installed comes from the library manifest, checked against the disk once here
+        self.library = LibraryManifest(self.config)
+        self.library.reconcile()
+        self.patch_cache = PatchCache(self.config)
+        self.fingerprints = BaseRomFingerprints(self.config)
+        self.materialized = MaterializedCache(self.config)
+
+        # Background installs, used by the GUI so several can run at once
+        self.installs = InstallQueue(self.config, install_concurrency)
         
-        self._initialize_data()
+        # The GUI loads the catalog in the background itself, everything else
+        # wants it ready as soon as the service exists
+        if sync_on_start:
+            self.load_catalog()
 
-    def _initialize_data(self):
-        # Gets hack information from the server and populates the roms dictionary
-        hacks = fetch_hack_list_from_server(self.config) 
+    def load_catalog(self, refresh=True):
+        # Loads the catalog from the cache, then revalidates it with the server unless
+        # refresh is False. Returns what the revalidation changed
+        self._load_cached_data()
+        if not refresh:
+            return empty_changes()
+        return self._initialize_data()
+
+    def load_cached_catalog(self):
+        # Returns the catalog saved from the last successful fetch, without applying it
+        return load_cached_hack_list(self.config)
+
+    def fetch_catalog(self):
+        # Revalidates the catalog with the server, without applying it.
+        # Safe to call from a worker thread
+        return fetch_hack_list_from_server(self.config)
+
+    def _load_cached_data(self):
+        # Populates the roms dictionary from the last catalog we downloaded,
+        # so installed hacks are available straight away, even offline
+        hacks = self.load_cached_catalog()
         if hacks:
-            # Clear existing roms before populating
-            self._roms.clear()
-            for hack_id, hack_info in hacks.items():
+            self._sync_roms(hacks)
+
+    def _make_rom(self, entry):
+        return ROM_CLASSES[entry.system](entry, self.config, self.library, self.patch_cache, self.fingerprints, self.materialized)
+
+    def _initialize_data(self):
+        # Revalidates the catalog with the server and merges in anything that changed.
+        # Returns the changes so callers can refresh only the affected entries
+        hacks, modified = self.fetch_catalog()
+        if modified and hacks:
+            return self._sync_roms(hacks)
+        return empty_changes()
+
+    @tracing.traced("catalog.sync", "catalog")
+    def _sync_roms(self, hacks):
+        # Merges a whole catalog in one go and returns everything that changed
+        changes = empty_changes()
+        for batch in self.sync_in_batches(hacks, batch_size=max(1, len(hacks))):
+            for key in changes:
+                changes[key] += batch[key]
+
+        if any(changes.values()):
+            print(f"Catalog synced: {len(changes['added'])} added, {len(changes['updated'])} updated, {len(changes['removed'])} removed.")
+        return changes
+
+    def sync_in_batches(self, hacks, batch_size=SYNC_BATCH_SIZE):
+        # Merges a catalog into the roms dictionary in place, a batch at a time,
+        # yielding the changes from each batch. Installed hacks are merged first so
+        # the GUI can show them straight away.
+        # Unchanged entries keep their ROM object, changed ones are updated rather
+        # than rebuilt, so anything holding a reference (like the GUI's list items)
+        # stays valid
+        # hacks can be a Catalog, hacks.json as it came from the server, or a dict of it.
+        # A catalog may carry a top-level version, if it matches there's nothing to do
+        catalog = read_catalog(hacks)
+        if catalog.version is not None and catalog.version == self._catalog_version:
+            return
+        self._catalog_version = catalog.version
+
+        entries = {hack_id: entry for hack_id, entry in catalog.entries.items() if isinstance(entry.system, str) and entry.system in ROM_CLASSES}
+        installed_ids = self.library.installed_ids()
+        order = sorted(entries, key=lambda hack_id: hack_id not in installed_ids)
+
+        for start in range(0, len(order), batch_size):
+            changes = empty_changes()
+            for hack_id in order[start:start + batch_size]:
+                self._merge_entry(hack_id, entries[hack_id], changes)
+            yield changes
+
+        changes = empty_changes()
+        for hack_id in [hack_id for hack_id in self._roms if hack_id not in entries]:
+            del self._roms[hack_id]
+            self.search_index.remove(hack_id)
+            changes["removed"].append(hack_id)
+        yield changes
 
-                if hack_info.get("system") == "gba":
-                    self._roms[hack_id] = GBARom(hack_info, self.config)
-                elif hack_info.get("system") == "nds":
-                    self._roms[hack_id] = NDSRom(hack_info, self.config)
+    def _merge_entry(self, hack_id, entry, changes):
+        existing = self._roms.entries.get(hack_id)
+        if existing is None:
+            changes["added"].append(hack_id)
+        elif existing.system != entry.system or existing.is_outdated(entry):
+            changes["updated"].append(hack_id)
+        else:
+            return
+        self._roms.set_entry(entry)
+        self.search_index.add(entry)
 
     def update_settings(self, new_config_data):
-        # Saves new settings to the config file and re-initializes data
-        self.config.save_config(new_config_data)
-        self._initialize_data() 
-        return {"success": True, "message": "Settings updated successfully."}
+        # Applies new settings, redoing only what they affect. ROMs read paths like the
+        # emulator and base ROMs from the config when they need them, so those take
+        # effect straight away; a new server means a re-sync, and new directories mean
+        # re-reading what's stored in them. The config file is written shortly after,
+        # in the background
+        changed = self.config.changed_settings(new_config_data)
+        installed_before = self.library.installed_ids() if "patched_roms_dir" in changed else None
+        self.config.save_config_later(new_config_data)
+
+        changes = empty_changes()
+        if any(key in changed for key in DIRECTORY_SETTINGS):
+            changes = self._reload_directories(changed, installed_before)
+        if any(key in changed for key in RESYNC_SETTINGS):
+            # The new server's catalog version means nothing next to the old one's
+            self._catalog_version = None
+            resynced = self._initialize_data()
+            for key in changes:
+                changes[key] += [hack_id for hack_id in resynced[key] if hack_id not in changes[key]]
+        return {"success": True, "message": "Settings updated successfully.", "changes": changes}
+
+    def _reload_directories(self, changed, installed_before=None):
+        # Points the shared stores at changed directories. Returns the hacks whose
+        # installed state changed with the patched ROMs directory, as updated
+        changes = empty_changes()
+        if "patched_roms_dir" in changed:
+            self.library.reconcile()
+            flipped = self.library.installed_ids() ^ (installed_before or set())
+            changes["updated"] = [hack_id for hack_id in flipped if hack_id in self._roms]
+        if "patch_dir" in changed:
+            self.patch_cache.reload()
+        if "cache_dir" in changed:
+            self.fingerprints.reload()
+        return changes
+
+    # The get_*_hacks lists make each ROM object as it's read, so a caller that only
+    # looks at the first few rows doesn't pay for the rest
+
+    def get_all_hacks(self, search_query=None, system=None, base_rom=None):
+        # Returns a filtered list of every ROM in the catalog, installed or not
+        return self.filter_hacks(self._roms.rows(list(self._roms)), search_query, system, base_rom)
 
     def get_installed_hacks(self, search_query=None, system=None, base_rom=None):
         # Returns a filtered list of all installed ROMs
-        installed_hacks = [rom for rom in self._roms.values() if rom.patched_rom_path.exists()]
+        installed_ids = self.library.installed_ids()
+        installed_hacks = self._roms.rows([hack_id for hack_id in self._roms if hack_id in installed_ids])
         return self.filter_hacks(installed_hacks, search_query, system, base_rom)
     
     def get_available_hacks(self, search_query=None, system=None, base_rom=None):
         # Returns a filtered list of ROMs from the server that are not yet installed
-        available_hacks = [rom for rom in self._roms.values() if not rom.patched_rom_path.exists()]
+        installed_ids = self.library.installed_ids()
+        available_hacks = self._roms.rows([hack_id for hack_id in self._roms if hack_id not in installed_ids])
         return self.filter_hacks(available_hacks, search_query, system, base_rom)
 
+    @tracing.traced("catalog.filter_hacks", "catalog")
     def filter_hacks(self, rom_list, search_query=None, system=None, base_rom=None):
-        # Applies search and filter criteria to a list of ROMs
-        results = rom_list
-        if search_query:
-            results = [rom for rom in results if search_query.lower() in rom.name.lower()]
-        if base_rom:
-            results = [rom for rom in results if rom.base_rom_id == base_rom]
-        if system:
-            results = [rom for rom in results if rom.system == system.lower()]
-        print(results)
-        return results
+        # Applies search and filter criteria to a list of ROMs using the search index.
+        # With a search query the results are ranked, best match first
+        hack_ids = rom_list.ids if isinstance(rom_list, RomList) else [rom.id for rom in rom_list]
+        if search_query and search_query.strip():
+            candidates = set(hack_ids)
+            ranked_ids = self.search_index.search(search_query, system, base_rom)
+            return self._roms.rows([hack_id for hack_id in ranked_ids if hack_id in candidates])
+
+        allowed = self.search_index.facet_ids(system, base_rom)
+        if allowed is None:
+            return self._roms.rows(hack_ids)
+        return self._roms.rows([hack_id for hack_id in hack_ids if hack_id in allowed])
     
     def install_hack(self, hack_id):
         # Triggers the download and patching process for a given hack
@@ -63,6 +218,118 @@ class RomLauncherService:
             return {"success": False, "message": f"Hack with ID '{hack_id}' not found."}
         return rom_to_install.patch()
 
+    def queue_install(self, hack_id):
+        # Adds a hack to the background install queue and returns its job
+        rom_to_install = self._roms.get(hack_id)
+        if not rom_to_install:
+            print(f"Hack with ID '{hack_id}' not found.")
+            return None
+        return self.installs.submit(rom_to_install)
+
+    def install_batch(self, hack_ids, workers=None, cancel_event=None, on_result=None):
+        # Installs many hacks at once, grouped by base ROM. Patches are downloaded on
+        # install_concurrency threads and applied across a pool of processes, one per
+        # core unless workers says otherwise, each of which maps every base ROM once
+        # for all the patches it applies. on_result(hack_id, success) is called as
+        # each hack finishes. Returns {hack_id: success}.
+        results = {}
+        groups = {} # base ROM path -> ROMs to install against it
+        for hack_id in dict.fromkeys(hack_ids):
+            rom = self._roms.get(hack_id)
+            if not rom:
+                print(f"Hack with ID '{hack_id}' not found.")
+                results[hack_id] = False
+                continue
+            groups.setdefault(rom.base_rom_id, []).append(rom)
+        for base_rom_id, roms in list(groups.items()):
+            del groups[base_rom_id]
+            base_rom_path_str = roms[0]._base_rom_path()
+            if base_rom_path_str:
+                groups.setdefault(base_rom_path_str, []).extend(roms)
+            else:
+                results.update((rom.id, False) for rom in roms)
+        for hack_id, success in results.items():
+            if on_result:
+                on_result(hack_id, success)
+
+        def finished(rom, success):
+            results[rom.id] = success
+            if on_result:
+                on_result(rom.id, success)
+
+        roms = [rom for group in groups.values() for rom in group]
+        if not roms:
+            return results
+        cancelled = lambda: cancel_event is not None and cancel_event.is_set()
+        concurrency = max(1, int(self.config.get_setting("install_concurrency", 2)))
+        # Spawned rather than forked, as the download threads are already running
+        patch_pool = ProcessPoolExecutor(max_workers=min(workers or os.cpu_count() or 1, len(roms)),
+                                         mp_context=multiprocessing.get_context("spawn"),
+                                         initializer=share_base_roms, initargs=(sorted(groups),))
+        with tracing.span("install.batch", "install", hacks=len(roms), base_roms=len(groups)), \
+                ThreadPoolExecutor(max_workers=concurrency) as download_pool, patch_pool:
+            # Downloaded a base ROM at a time, so workers tend to stay on one base ROM
+            pending = {download_pool.submit(rom.download_patch, cancel_event): (rom, None, None) for rom in roms}
+            while pending:
+                done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    rom, patch_path, part_path = pending.pop(future)
+                    if future.cancelled():
+                        # A patch that never ran still has its patch and output file to clean up
+                        finished(rom, bool(part_path) and rom.finish_apply(patch_path, part_path, False, cancel_event))
+                        continue
+                    try:
+                        result = future.result()
+                    except Exception as e:
+                        print(f"Error installing {rom.name}: {e}")
+                        result = None
+
+                    if part_path:
+                        # Patched, or failed to
+                        finished(rom, rom.finish_apply(patch_path, part_path, bool(result), cancel_event))
+                    elif not result or cancelled():
+                        if result:
+                            rom.patch_cache.release(Path(result))
+                        finished(rom, False)
+                    else:
+                        patch_path = Path(result)
+                        prepared = rom.prepare_apply(patch_path)
+                        if not prepared:
+                            finished(rom, False)
+                            continue
+                        base_rom_path_str, part_path = prepared
+                        args, kwargs = rom.patch_arguments(patch_path, base_rom_path_str, part_path)
+                        pending[patch_pool.submit(apply_patch, *args, **kwargs)] = (rom, patch_path, part_path)
+                if cancelled():
+                    # Whatever hasn't started yet is dropped, what has finishes and is cleaned up
+                    for future in pending:
+                        future.cancel()
+        return results
+
+    def cancel_install(self, hack_id):
+        # Cancels a queued or running install, returns False if there wasn't one
+        return self.installs.cancel(hack_id)
+
+    def install_job(self, hack_id):
+        # The latest install job for a hack, with its state and progress, or None
+        return self.installs.get(hack_id)
+
+    def migrate_storage(self, target_storage, workers=None):
+        # Converts the installed library to full or compressed storage, across as
+        # many processes as there are cores unless workers says otherwise
+        return migrate_library(self.config, self.library, target_storage, workers)
+
+    def get_rom(self, hack_id):
+        # The ROM for a hack id, or None if it isn't in the catalog
+        return self._roms.get(hack_id)
+
+    def verify_installs(self, hack_ids=None, workers=None):
+        # Re-hashes installed files against the library manifest, all of them unless
+        # given hack_ids. Returns {hack_id: status}, see LibraryManifest.verify
+        hack_ids = sorted(self.library.installed_ids()) if hack_ids is None else list(hack_ids)
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            return dict(zip(hack_ids, pool.map(self.library.verify, hack_ids)))
+
     def play_rom(self, rom_id):
         # Launches an installed ROM with the configured emulator
         rom_to_play = self._roms.get(rom_id)
@@ -74,5 +341,9 @@ class RomLauncherService:
         # Deletes an installed ROM file
         rom_to_delete = self._roms.get(rom_id)
         if rom_to_delete:
-            return rom_to_delete.delete()
+            deleted = rom_to_delete.delete()
+            if deleted is True:
+                # Back in the available list, it shouldn't show its old install as done
+                self.installs.forget(rom_id)
+            return deleted
         return {"success": False, "message": f"ROM with ID '{rom_id}' not found."}
\ No newline at end of file
@@ -0,0 +1,111 @@
+import itertools
+import queue
+import threading
+
+from fetch import download_image_from_server
+
+# One application-wide scheduler for box art downloads. A fixed set of worker
+# threads pulls from a priority queue, so rows in view are fetched before rows
+# just off screen, and the same URL is only ever downloaded once at a time.
+# Results are handed back to the Tk thread through a queue drained with after().
+
+PRIORITY_VISIBLE = 0
+PRIORITY_OFFSCREEN = 1
+RESULT_POLL_MS = 50
+
+
+class ArtDownloadScheduler:
+
+    def __init__(self, root, thumbnails, max_workers=4):
+        self.root = root
+        self.thumbnails = thumbnails
+        self._lock = threading.Lock()
+        self._queue = queue.PriorityQueue()
+        self._results = queue.Queue()
+        self._jobs = {} # box_art_url -> job, for de-duplicating in-flight downloads
+        self._counter = itertools.count() # Keeps equal priorities first in, first out
+        self._polling = False
+        self._stopping = False
+        self._workers = [threading.Thread(target=self._worker, daemon=True) for _ in range(max_workers)]
+        for worker in self._workers:
+            worker.start()
+
+    def request(self, rom, scale, priority, callback):
+        # Queues the art for a ROM, or joins the download already under way for it.
+        # Asking again with a better priority moves it up the queue.
+        # callback(image_path) runs on the Tk thread, image_path is None on failure.
+        # Must be called from the Tk thread.
+        if self._stopping or not rom.box_art_url:
+            return
+        url = rom.box_art_url
+        with self._lock:
+            job = self._jobs.get(url)
+            if job is None:
+                job = {"rom": rom, "scale": scale, "priority": priority, "state": "queued", "callbacks": []}
+                self._jobs[url] = job
+                self._queue.put((priority, next(self._counter), url))
+            elif job["state"] == "queued" and priority < job["priority"]:
+                # The old queue entry is skipped when it comes up, as its priority no longer matches.
+                job["priority"] = priority
+                self._queue.put((priority, next(self._counter), url))
+            job["callbacks"].append(callback)
+
+        if not self._polling:
+            self._polling = True
+            self.root.after(RESULT_POLL_MS, self._poll_results)
+
+    def _worker(self):
+        while True:
+            priority, _, url = self._queue.get()
+            if url is None or self._stopping:
+                return
+            with self._lock:
+                job = self._jobs.get(url)
+                if not job or job["state"] != "queued" or job["priority"] != priority:
+                    continue
+                job["state"] = "running"
+
+            image_path = None
+            try:
+                image_path = download_image_from_server(url, job["rom"].config)
+                if image_path:
+                    self.thumbnails.generate(image_path, job["scale"])
+            except Exception as e:
+                print(f"Error fetching box art {url}: {e}")
+
+            # Both under the lock, so a poll never sees the job gone before its result is there.
+            with self._lock:
+                self._jobs.pop(url, None)
+                self._results.put((job["callbacks"], image_path))
+
+    def _poll_results(self):
+        # Runs on the Tk thread. Keeps polling only while there's work outstanding.
+        while True:
+            try:
+                callbacks, image_path = self._results.get_nowait()
+            except queue.Empty:
+                break
+            for callback in callbacks:
+                try:
+                    callback(image_path)
+                except Exception as e:
+                    print(f"Error updating box art: {e}")
+
+        with self._lock:
+            outstanding = bool(self._jobs) or not self._results.empty()
+        if outstanding and not self._stopping:
+            self.root.after(RESULT_POLL_MS, self._poll_results)
+        else:
+            self._polling = False
+
+    def shutdown(self):
+        # Drops anything still queued and stops the workers. Downloads already
+        # running are left to finish on their daemon threads.
+        self._stopping = True
+        with self._lock:
+            self._jobs.clear()
+        for _ in self._workers:
+            # Sorts ahead of any real job so the workers see it straight away.
+            self._queue.put((-1, -1, None))
+        for worker in self._workers:
+            worker.join(timeout=1)
@@ -0,0 +1,111 @@
+import hashlib
+import json
+import os
+import threading
+import zlib
+from pathlib import Path
+
+import tracing
+from progress import PHASE_VERIFY, report
+
+# Identifies base ROMs by CRC32 and SHA-1, so a wrong dump (wrong region, wrong
+# revision, or a ROM that's already been patched) is caught before an install
+# starts. Fingerprints are remembered in the cache directory against the file's
+# size and modification time, so each base ROM is only ever hashed once.
+
+FINGERPRINTS_FILENAME = "base_roms.json"
+HASH_CHUNK_SIZE = 1024 * 1024
+
+
+def _hash_rom(path, progress=None):
+    # CRC32 and SHA-1 in a single read of the file.
+    crc = 0
+    sha1 = hashlib.sha1()
+    total = os.path.getsize(path)
+    done = 0
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(HASH_CHUNK_SIZE), b""):
+            crc = zlib.crc32(chunk, crc)
+            sha1.update(chunk)
+            done += len(chunk)
+            report(progress, PHASE_VERIFY, done, total)
+    return f"{crc:08x}", sha1.hexdigest()
+
+
+def check_fingerprint(fingerprint, size=None, crc32=None, sha1=None):
+    # Compares a fingerprint against whatever is expected of it. Returns a
+    # description of the first mismatch, or None if everything expected matches.
+    if size is not None and fingerprint["size"] != size:
+        return f"it is {fingerprint['size']} bytes, expected {size}"
+    if crc32 is not None:
+        # Catalogs give the CRC32 as hex, patch headers as a number
+        try:
+            expected = int(crc32, 16) if isinstance(crc32, str) else int(crc32)
+        except (TypeError, ValueError):
+            # A malformed catalog value says nothing, so it's checked on size and SHA-1 alone
+            print(f"Ignoring malformed CRC32 {crc32!r}")
+            expected = None
+        if expected is not None and int(fingerprint["crc32"], 16) != expected:
+            return f"its CRC32 is {fingerprint['crc32'].upper()}, expected {expected:08X}"
+    if sha1 is not None and not isinstance(sha1, str):
+        print(f"Ignoring malformed SHA-1 {sha1!r}")
+    elif sha1 is not None and fingerprint["sha1"] != sha1.lower():
+        return f"its SHA-1 is {fingerprint['sha1']}, expected {sha1.lower()}"
+    return None
+
+
+class BaseRomFingerprints:
+
+    def __init__(self, config):
+        self.config = config
+        self._lock = threading.Lock()
+        self._entries = None # Resolved path -> {size, mtime_ns, crc32, sha1}
+
+    @property
+    def store_path(self):
+        return Path(self.config.get_setting("cache_dir", "cache")) / FINGERPRINTS_FILENAME
+
+    def _load(self):
+        # Callers must hold the lock.
+        if self._entries is None:
+            try:
+                with open(self.store_path, "r") as f:
+                    self._entries = json.load(f)
+            except (FileNotFoundError, json.JSONDecodeError, OSError):
+                self._entries = {}
+        return self._entries
+
+    def _save(self):
+        # Callers must hold the lock.
+        temp_path = self.store_path.with_name(FINGERPRINTS_FILENAME + ".tmp")
+        try:
+            self.store_path.parent.mkdir(parents=True, exist_ok=True)
+            with open(temp_path, "w") as f:
+                json.dump(self._entries, f, indent=4)
+            os.replace(temp_path, self.store_path)
+        except OSError as e:
+            print(f"Could not save base ROM fingerprints: {e}")
+
+    def reload(self):
+        # Forgets the loaded fingerprints, for when cache_dir has been changed in the settings.
+        with self._lock:
+            self._entries = None
+
+    def fingerprint(self, rom_path, progress=None):
+        # Returns {"size", "crc32", "sha1"} for a ROM, hashing it only if it's new
+        # or has changed on disk since we last saw it.
+        key = str(Path(rom_path).resolve())
+        stat = os.stat(key)
+        with self._lock:
+            entry = self._load().get(key)
+        if entry and entry.get("size") == stat.st_size and entry.get("mtime_ns") == stat.st_mtime_ns:
+            tracing.count("base_rom_fingerprint.hit")
+            return {"size": entry["size"], "crc32": entry["crc32"], "sha1": entry["sha1"]}
+
+        tracing.count("base_rom_fingerprint.miss")
+        with tracing.span("base_rom.hash", "install", size=stat.st_size):
+            crc32, sha1 = _hash_rom(key, progress)
+        with self._lock:
+            self._load()[key] = {"size": stat.st_size, "mtime_ns": stat.st_mtime_ns, "crc32": crc32, "sha1": sha1}
+            self._save()
+        return {"size": stat.st_size, "crc32": crc32, "sha1": sha1}
@@ -0,0 +1,104 @@
+import argparse
+import contextlib
+import json
+import sys
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from app import RomLauncherService
+from benchmarks.common import catalog_content, fake_installs, scratch_directory, serve_catalog, time_best, time_once
+from benchmarks.synthetic import make_catalog, touch_catalog
+
+# Catalog sync and search timings against synthetic catalogs, with no network:
+# RomLauncherService._initialize_data for a first load, an unchanged re-sync and
+# a re-sync with 1% of entries updated, then filter_hacks over a mix of queries.
+
+DEFAULT_SIZES = [100, 1000, 10000, 100000]
+INSTALLED_RATIO = 0.05
+
+# (label, query, system, base_rom). Search-as-you-type sends every prefix, so
+# those are here as well as whole words, multi-word and misspelt queries.
+FILTER_QUERIES = [
+    ("all", None, None, None),
+    ("system", None, "gba", None),
+    ("system_base_rom", None, "nds", "platinum"),
+    ("prefix_1", "f", None, None),
+    ("prefix_3", "fir", None, None),
+    ("word", "fire", None, None),
+    ("two_words", "fire quest", None, None),
+    ("typo", "emrald", None, None),
+    ("author", "cynthia", None, None),
+    ("word_system", "shadow", "gba", "emerald"),
+    ("no_match", "zzzzqx", None, None),
+]
+
+
+def bench_sync(catalog, repeats):
+    # Returns the timings and the loaded service, for the filter benchmark to reuse.
+    service = RomLauncherService(sync_on_start=False)
+    serve_catalog(service, catalog)
+    first, _ = time_once(service._initialize_data)
+
+    unchanged = time_best(service._initialize_data, repeats)
+
+    # Each one builds on the last, so every re-sync sees exactly 1% changed.
+    updated_catalogs = [catalog]
+    for seed in range(repeats):
+        updated_catalogs.append(touch_catalog(updated_catalogs[-1], 0.01, seed))
+    updated_catalogs = [catalog_content(updated) for updated in updated_catalogs[1:]]
+    def resync_updated():
+        serve_catalog(service, updated_catalogs.pop(0))
+        service._initialize_data()
+    updated = time_best(resync_updated, repeats)
+
+    return {
+        "initialize_s": round(first, 4),
+        "resync_unchanged_s": round(unchanged, 4),
+        "resync_1pct_updated_s": round(updated, 4),
+    }, service
+
+
+def bench_filter(service, repeats):
+    # Each query's first run is timed separately, as the search index caches results.
+    roms = service.get_all_hacks()
+    results = {}
+    for label, query, system, base_rom in FILTER_QUERIES:
+        first, matches = time_once(lambda: service.filter_hacks(roms, query, system, base_rom))
+        repeat = time_best(lambda: service.filter_hacks(roms, query, system, base_rom), repeats)
+        results[label] = {"first_ms": round(first * 1000, 3), "repeat_ms": round(repeat * 1000, 3), "matches": len(matches)}
+
+    # Typing a query one key at a time, as the search box would. None of its
+    # prefixes are in FILTER_QUERIES, so none of them are cached yet.
+    typed = "legends storm"
+    elapsed, _ = time_once(lambda: [service.filter_hacks(roms, typed[:end]) for end in range(1, len(typed) + 1)])
+    results["typing"] = {"total_ms": round(elapsed * 1000, 3), "keystrokes": len(typed)}
+    return results
+
+
+def run(sizes=DEFAULT_SIZES, repeats=3, installed_ratio=INSTALLED_RATIO):
+    results = []
+    for size in sizes:
+        catalog = make_catalog(size)
+        with scratch_directory():
+            installed = fake_installs(catalog, installed_ratio)
+            sync, service = bench_sync(catalog, repeats)
+            filtering = bench_filter(service, repeats)
+            service.installs.shutdown()
+        results.append({"catalog_size": size, "installed": installed, "sync": sync, "filter": filtering})
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark catalog sync and filter_hacks against synthetic catalogs.")
+    parser.add_argument("--sizes", type=lambda value: [int(size) for size in value.split(",")], default=DEFAULT_SIZES)
+    parser.add_argument("--repeats", type=int, default=3)
+    args = parser.parse_args()
+
+    with contextlib.redirect_stdout(sys.stderr):
+        results = run(args.sizes, args.repeats)
+    print(json.dumps(results, indent=4))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,156 @@
+import argparse
+import contextlib
+import json
+import os
+import shutil
+import subprocess
+import sys
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from app import RomLauncherService
+from catalog import read_catalog
+from benchmarks.common import catalog_content, fake_installs, scratch_directory, time_best, time_once
+from benchmarks.synthetic import make_catalog
+
+# MainApplication.refresh_lists timings against synthetic catalogs. Needs a
+# display, so without one this starts Xvfb if it's installed, and otherwise
+# reports itself as skipped. Box art is left out of the catalogs, so nothing
+# touches the network.
+
+DEFAULT_SIZES = [100, 1000, 10000, 100000]
+INSTALLED_RATIO = 0.05
+XVFB_SCREEN = "1280x1024x24"
+CATALOG_LOAD_TIMEOUT = 600
+
+# (label, view, query, system filter)
+REFRESH_SCENARIOS = [
+    ("installed", "installed", "", "All"),
+    ("available", "available", "", "All"),
+    ("available_search", "available", "fire", "All"),
+    ("available_system", "available", "", "gba"),
+    ("available_no_match", "available", "zzzzqx", "All"),
+]
+
+
+@contextlib.contextmanager
+def virtual_display():
+    # Yields the display to use, starting an Xvfb for the duration if there isn't
+    # one already, or None if neither is available.
+    if os.environ.get("DISPLAY"):
+        yield os.environ["DISPLAY"]
+        return
+    xvfb = shutil.which("Xvfb")
+    if not xvfb:
+        yield None
+        return
+
+    # Xvfb picks a free display number itself and writes it to -displayfd.
+    read_fd, write_fd = os.pipe()
+    process = subprocess.Popen([xvfb, "-displayfd", str(write_fd), "-screen", "0", XVFB_SCREEN, "-nolisten", "tcp"],
+                               pass_fds=(write_fd,), stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    os.close(write_fd)
+    with os.fdopen(read_fd) as f:
+        number = f.readline().strip()
+    if not number:
+        process.kill()
+        process.wait()
+        yield None
+        return
+
+    os.environ["DISPLAY"] = f":{number}"
+    try:
+        yield os.environ["DISPLAY"]
+    finally:
+        del os.environ["DISPLAY"]
+        process.terminate()
+        process.wait()
+
+
+@contextlib.contextmanager
+def offline_catalog(catalog):
+    # The GUI makes its own service, so the fetch is replaced on the class.
+    # Parsed on every fetch, like the real one.
+    content = catalog_content(catalog)
+    original = RomLauncherService.fetch_catalog
+    RomLauncherService.fetch_catalog = lambda service: (read_catalog(content), True)
+    try:
+        yield
+    finally:
+        RomLauncherService.fetch_catalog = original
+
+
+def _wait_for_catalog(window):
+    # Pumps the event loop until the progressive catalog load has finished.
+    deadline = time.monotonic() + CATALOG_LOAD_TIMEOUT
+    while window.catalog_loading:
+        if time.monotonic() > deadline:
+            raise RuntimeError("Catalog load didn't finish.")
+        window.update()
+
+
+def bench_window(catalog, repeats):
+    import gui
+
+    with offline_catalog(catalog):
+        startup, window = time_once(gui.MainApplication)
+        loaded, _ = time_once(lambda: _wait_for_catalog(window))
+    window.update()
+
+    results = {"startup_s": round(startup, 4), "catalog_load_s": round(loaded, 4), "refresh_ms": {}}
+    try:
+        for label, view, query, system in REFRESH_SCENARIOS:
+            window.current_view.set(view)
+            window.current_system_filter.set(system)
+            window.search_entry.delete(0, "end")
+            window.search_entry.insert(0, query)
+            def refresh():
+                window.refresh_lists()
+                window.update_idletasks()
+            results["refresh_ms"][label] = round(time_best(refresh, repeats) * 1000, 3)
+
+        # Jumping to the middle of the full available list rebinds every row.
+        window.current_view.set("available")
+        window.current_system_filter.set("All")
+        window.search_entry.delete(0, "end")
+        window.refresh_lists()
+        def scroll():
+            window._on_scrollbar("moveto", 0.5 if window.scroll_offset == 0 else 0)
+            window._render_list()
+            window.update_idletasks()
+        results["scroll_render_ms"] = round(time_best(scroll, repeats) * 1000, 3)
+    finally:
+        window._on_close()
+    return results
+
+
+def run(sizes=DEFAULT_SIZES, repeats=3, installed_ratio=INSTALLED_RATIO):
+    with virtual_display() as display:
+        if display is None:
+            return [{"skipped": "No display, and Xvfb isn't installed."}]
+        results = []
+        for size in sizes:
+            catalog = make_catalog(size)
+            with scratch_directory():
+                installed = fake_installs(catalog, installed_ratio)
+                result = {"catalog_size": size, "installed": installed}
+                result.update(bench_window(catalog, repeats))
+            results.append(result)
+        return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark refresh_lists against synthetic catalogs.")
+    parser.add_argument("--sizes", type=lambda value: [int(size) for size in value.split(",")], default=DEFAULT_SIZES)
+    parser.add_argument("--repeats", type=int, default=3)
+    args = parser.parse_args()
+
+    with contextlib.redirect_stdout(sys.stderr):
+        results = run(args.sizes, args.repeats)
+    print(json.dumps(results, indent=4))
+
+
+if __name__ == "__main__":
+    main()
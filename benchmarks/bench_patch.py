@@ -0,0 +1,87 @@
+import argparse
+import contextlib
+import json
+import shutil
+import subprocess
+import sys
+import tempfile
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from patch import apply_in_place
+from patch_engine import IN_PLACE_PATCHERS, PATCHERS
+from benchmarks.common import time_best
+from benchmarks.synthetic import PATCH_GENERATORS, make_base_rom, make_target
+
+# Patch apply throughput of the built-in engine, optionally compared against
+# the external flips/ups tools if their paths are given.
+
+EXTERNAL_COMMANDS = {
+    "ips": lambda tool, patch, base, out: [tool, "--apply", patch, base, out],
+    "bps": lambda tool, patch, base, out: [tool, "--apply", patch, base, out],
+    "ups": lambda tool, patch, base, out: [tool, "apply", "--base", base, "--patch", patch, "--output", out],
+}
+
+
+def run(size_mb=16, change_ratio=0.02, repeats=3, flips=None, ups=None):
+    results = []
+    tools = {"ips": flips, "bps": flips, "ups": ups}
+    size = size_mb * 1024 * 1024
+
+    with tempfile.TemporaryDirectory() as tmp:
+        tmp = Path(tmp)
+        source = make_base_rom(size)
+        target = make_target(source, change_ratio)
+        base_path = tmp / "base.gba"
+        base_path.write_bytes(source)
+
+        for patch_type, generate in PATCH_GENERATORS.items():
+            patch_path = tmp / f"patch.{patch_type}"
+            patch_path.write_bytes(generate(source, target))
+            out_path = tmp / f"out_{patch_type}.gba"
+
+            elapsed = time_best(lambda: PATCHERS[patch_type](str(patch_path), str(base_path), str(out_path)), repeats)
+            if out_path.read_bytes() != target:
+                raise RuntimeError(f"Built-in {patch_type} patcher produced the wrong output.")
+            result = {
+                "patch_type": patch_type,
+                "rom_mb": size_mb,
+                "patch_bytes": patch_path.stat().st_size,
+                "builtin_s": round(elapsed, 4),
+                "builtin_mb_s": round(size_mb / elapsed, 1),
+            }
+
+            # Includes cloning the base ROM, which is how installs use it.
+            elapsed = time_best(lambda: apply_in_place(IN_PLACE_PATCHERS[patch_type], str(patch_path), str(base_path), str(out_path)), repeats)
+            if out_path.read_bytes() != target:
+                raise RuntimeError(f"In-place {patch_type} patcher produced the wrong output.")
+            result["in_place_s"] = round(elapsed, 4)
+            result["in_place_mb_s"] = round(size_mb / elapsed, 1)
+
+            tool = tools[patch_type]
+            if tool and shutil.which(tool):
+                cmd = EXTERNAL_COMMANDS[patch_type](tool, str(patch_path), str(base_path), str(out_path))
+                elapsed = time_best(lambda: subprocess.run(cmd, check=True, capture_output=True), repeats)
+                result["external_s"] = round(elapsed, 4)
+                result["external_mb_s"] = round(size_mb / elapsed, 1)
+            results.append(result)
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark IPS/BPS/UPS patch throughput.")
+    parser.add_argument("--size-mb", type=int, default=16)
+    parser.add_argument("--change-ratio", type=float, default=0.02)
+    parser.add_argument("--repeats", type=int, default=3)
+    parser.add_argument("--flips", help="Path to flips for comparison")
+    parser.add_argument("--ups", help="Path to the ups patcher for comparison")
+    args = parser.parse_args()
+
+    with contextlib.redirect_stdout(sys.stderr):
+        results = run(args.size_mb, args.change_ratio, args.repeats, args.flips, args.ups)
+    print(json.dumps(results, indent=4))
+
+
+if __name__ == "__main__":
+    main()
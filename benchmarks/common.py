@@ -0,0 +1,67 @@
+import contextlib
+import json
+import os
+import tempfile
+import time
+from pathlib import Path
+
+from catalog import read_catalog
+
+# Shared helpers for the benchmarks: timing, and a throwaway working directory
+# with the service pointed at a synthetic catalog instead of the server.
+
+
+def time_best(func, repeats):
+    # Best of N wall-clock runs, in seconds.
+    best = None
+    for _ in range(repeats):
+        start = time.perf_counter()
+        func()
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def time_once(func):
+    # Wall-clock time of a single run in seconds, and what it returned.
+    start = time.perf_counter()
+    result = func()
+    return time.perf_counter() - start, result
+
+
+@contextlib.contextmanager
+def scratch_directory():
+    # Runs the body in an empty temporary directory, so the service's config.json,
+    # caches and library go there rather than next to the real ones.
+    previous = os.getcwd()
+    with tempfile.TemporaryDirectory() as tmp:
+        os.chdir(tmp)
+        try:
+            yield Path(tmp)
+        finally:
+            os.chdir(previous)
+
+
+def fake_installs(catalog, ratio, directory="patched_roms"):
+    # Drops empty ROM files for `ratio` of the catalog into the patched ROMs
+    # directory, which the library picks up as installed.
+    directory = Path(directory)
+    directory.mkdir(parents=True, exist_ok=True)
+    hack_ids = sorted(catalog)
+    step = max(1, int(1 / ratio)) if ratio else 0
+    installed = hack_ids[::step] if step else []
+    for hack_id in installed:
+        (directory / f"{hack_id}.{catalog[hack_id]['system']}").touch()
+    return len(installed)
+
+
+def catalog_content(catalog):
+    # A catalog as the hacks.json bytes the server would send.
+    return catalog if isinstance(catalog, bytes) else json.dumps(catalog).encode("utf-8")
+
+
+def serve_catalog(service, catalog):
+    # Makes the service's catalog fetch return `catalog` as if the server sent it.
+    # Each fetch parses the hacks.json bytes, like the real one, so that's timed too.
+    content = catalog_content(catalog)
+    service.fetch_catalog = lambda: (read_catalog(content), True)
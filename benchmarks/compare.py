@@ -0,0 +1,83 @@
+import argparse
+import json
+import sys
+from pathlib import Path
+
+# Compares two results files from benchmarks/run.py and lists every timing that
+# moved by more than the threshold. Exits with 1 if anything got slower, so it
+# can gate a CI job.
+
+DEFAULT_THRESHOLD = 0.10
+# Timings this short are mostly noise, so they're never reported.
+MIN_SECONDS = 0.001
+# Results in a list are told apart by these, rather than their position.
+LIST_KEYS = ("catalog_size", "patch_type")
+
+
+def flatten(results, prefix=""):
+    # {"catalog": [{"catalog_size": 100, "sync": {"initialize_s": ...}}]} becomes
+    # {"catalog.100.sync.initialize_s": ...}, keeping only the measurements.
+    flat = {}
+    if isinstance(results, dict):
+        for key, value in results.items():
+            path = f"{prefix}{key}"
+            if isinstance(value, (dict, list)):
+                flat.update(flatten(value, path + "."))
+            elif _is_measurement(key) and isinstance(value, (int, float)):
+                flat[path] = value
+    elif isinstance(results, list):
+        for index, item in enumerate(results):
+            name = next((str(item[key]) for key in LIST_KEYS if isinstance(item, dict) and key in item), str(index))
+            flat.update(flatten(item, f"{prefix}{name}."))
+    return flat
+
+
+def _is_measurement(key):
+    return key.endswith(("_s", "_ms"))
+
+
+def _higher_is_better(path):
+    return path.endswith("_mb_s")
+
+
+def _seconds(path, value):
+    return value / 1000 if path.endswith("_ms") else value
+
+
+def compare(before, after, threshold=DEFAULT_THRESHOLD):
+    # Returns [(path, before, after, change, is_regression)] for everything that
+    # moved more than the threshold. change is the fractional slowdown.
+    before, after = flatten(before), flatten(after)
+    changes = []
+    for path in sorted(before.keys() & after.keys()):
+        old, new = before[path], after[path]
+        if not old or not new:
+            continue
+        if not _higher_is_better(path) and max(_seconds(path, old), _seconds(path, new)) < MIN_SECONDS:
+            continue
+        change = (old / new - 1) if _higher_is_better(path) else (new / old - 1)
+        if abs(change) > threshold:
+            changes.append((path, old, new, change, change > 0))
+    return changes
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare two benchmark results files.")
+    parser.add_argument("before")
+    parser.add_argument("after")
+    parser.add_argument("--threshold", type=float, default=DEFAULT_THRESHOLD, help="Fractional change to report, default 0.10")
+    args = parser.parse_args()
+
+    before = json.loads(Path(args.before).read_text())
+    after = json.loads(Path(args.after).read_text())
+    print(f"{before.get('commit')} -> {after.get('commit')}")
+    changes = compare(before, after, args.threshold)
+    if not changes:
+        print(f"Nothing moved by more than {args.threshold:.0%}.")
+    for path, old, new, change, regression in changes:
+        print(f"{'SLOWER' if regression else 'faster'}  {path}: {old} -> {new} ({change:+.0%})")
+    return 1 if any(regression for *_, regression in changes) else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
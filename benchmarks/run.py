@@ -0,0 +1,74 @@
+import argparse
+import contextlib
+import json
+import platform
+import subprocess
+import sys
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from benchmarks import bench_catalog, bench_gui, bench_patch
+
+# Runs every benchmark and writes one JSON file, tagged with the commit it ran
+# against, so two runs can be put side by side with benchmarks/compare.py:
+#   python benchmarks/run.py -o before.json
+#   (make a change)
+#   python benchmarks/run.py -o after.json
+#   python benchmarks/compare.py before.json after.json
+
+SUITES = ["catalog", "gui", "patch"]
+QUICK_SIZES = [100, 1000, 10000]
+
+
+def _git_commit():
+    try:
+        result = subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=Path(__file__).resolve().parent,
+                                capture_output=True, text=True, check=True)
+        return result.stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run(suites=SUITES, sizes=bench_catalog.DEFAULT_SIZES, repeats=3, patch_size_mb=16):
+    results = {
+        "commit": _git_commit(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+        "repeats": repeats,
+    }
+    if "catalog" in suites:
+        results["catalog"] = bench_catalog.run(sizes, repeats)
+    if "gui" in suites:
+        results["gui"] = bench_gui.run(sizes, repeats)
+    if "patch" in suites:
+        results["patch"] = bench_patch.run(patch_size_mb, repeats=repeats)
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Run the offline benchmark suite.")
+    parser.add_argument("-o", "--output", help="Write the results here as well as to stdout")
+    parser.add_argument("--suites", type=lambda value: value.split(","), default=SUITES, help=f"Comma separated, from {','.join(SUITES)}")
+    parser.add_argument("--sizes", type=lambda value: [int(size) for size in value.split(",")], default=bench_catalog.DEFAULT_SIZES, help="Catalog sizes")
+    parser.add_argument("--quick", action="store_true", help=f"Catalogs of {','.join(map(str, QUICK_SIZES))} and a 4 MB ROM")
+    parser.add_argument("--repeats", type=int, default=3)
+    parser.add_argument("--patch-size-mb", type=int, default=16)
+    args = parser.parse_args()
+
+    if args.quick:
+        args.sizes, args.patch_size_mb = QUICK_SIZES, 4
+    # Everything the app prints goes to stderr, leaving stdout for the results.
+    with contextlib.redirect_stdout(sys.stderr):
+        results = run(args.suites, args.sizes, args.repeats, args.patch_size_mb)
+
+    output = json.dumps(results, indent=4)
+    if args.output:
+        Path(args.output).write_text(output + "\n")
+    print(output)
+
+
+if __name__ == "__main__":
+    main()
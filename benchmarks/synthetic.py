@@ -0,0 +1,154 @@
+import random
+import zlib
+
+# Generators for synthetic base ROMs and patches, so the benchmarks
+# run without real ROMs or a network connection.
+
+
+def make_base_rom(size, seed=0):
+    # Random data with large 0xFF padded regions, roughly like a real GBA ROM.
+    rng = random.Random(seed)
+    data = bytearray(rng.randbytes(size // 2))
+    data += b"\xFF" * (size - len(data))
+    return bytes(data)
+
+
+def make_target(source, change_ratio=0.02, run_length=64, seed=1):
+    # Scatters runs of modified bytes over a copy of the source.
+    rng = random.Random(seed)
+    target = bytearray(source)
+    runs = max(1, int(len(source) * change_ratio) // run_length)
+    for _ in range(runs):
+        start = rng.randrange(0, max(1, len(source) - run_length))
+        target[start:start + run_length] = rng.randbytes(run_length)
+    return bytes(target)
+
+
+def encode_varint(value):
+    # BPS/UPS variable-length integer encoding.
+    out = bytearray()
+    while True:
+        low = value & 0x7F
+        value >>= 7
+        if value == 0:
+            out.append(0x80 | low)
+            return bytes(out)
+        out.append(low)
+        value -= 1
+
+
+def _diff_runs(source, target):
+    # Yields (start, end) ranges where source and target differ.
+    length = len(target)
+    pos = 0
+    while pos < length:
+        if pos < len(source) and source[pos] == target[pos]:
+            pos += 1
+            continue
+        start = pos
+        while pos < length and not (pos < len(source) and source[pos] == target[pos]):
+            pos += 1
+        yield start, pos
+
+
+def make_ips(source, target):
+    # Only supports targets up to 16 MB, which is the IPS addressing limit.
+    out = bytearray(b"PATCH")
+    for start, end in _diff_runs(source, target):
+        pos = start
+        while pos < end:
+            size = min(end - pos, 0xFFFF)
+            if pos == 0x454F46:  # "EOF" as an offset would end the patch early
+                pos -= 1
+                size += 1
+            out += pos.to_bytes(3, "big") + size.to_bytes(2, "big") + target[pos:pos + size]
+            pos += size
+    out += b"EOF"
+    return bytes(out)
+
+
+def make_bps(source, target):
+    # Encodes with SourceRead and TargetRead actions only.
+    out = bytearray(b"BPS1")
+    out += encode_varint(len(source)) + encode_varint(len(target)) + encode_varint(0)
+    pos = 0
+    for start, end in _diff_runs(source, target):
+        if start > pos:
+            out += encode_varint(((start - pos - 1) << 2) | 0)
+        out += encode_varint(((end - start - 1) << 2) | 1) + target[start:end]
+        pos = end
+    if pos < len(target):
+        out += encode_varint(((len(target) - pos - 1) << 2) | 0)
+    out += zlib.crc32(source).to_bytes(4, "little") + zlib.crc32(target).to_bytes(4, "little")
+    out += zlib.crc32(out).to_bytes(4, "little")
+    return bytes(out)
+
+
+def make_ups(source, target):
+    out = bytearray(b"UPS1")
+    out += encode_varint(len(source)) + encode_varint(len(target))
+    pos = 0
+    for start, end in _diff_runs(source, target):
+        if start < pos:
+            # The previous hunk's terminator already covered this byte.
+            start = pos
+            if start >= end:
+                continue
+        out += encode_varint(start - pos)
+        for i in range(start, end):
+            src = source[i] if i < len(source) else 0
+            out.append(src ^ target[i])
+        out.append(0)
+        pos = end + 1
+    out += zlib.crc32(source).to_bytes(4, "little") + zlib.crc32(target).to_bytes(4, "little")
+    out += zlib.crc32(out).to_bytes(4, "little")
+    return bytes(out)
+
+
+# Vocabulary for synthetic catalog entries, so searches have realistic overlap.
+NAME_WORDS = [
+    "fire", "red", "emerald", "crystal", "dark", "light", "quest", "legends", "shadow", "storm",
+    "rising", "lost", "island", "kanto", "hoenn", "johto", "unbound", "radical", "glazed", "gaia",
+    "blaze", "clover", "rogue", "saga", "origins", "eclipse", "frost", "thunder", "ancient", "prism",
+]
+AUTHOR_WORDS = ["ash", "misty", "brock", "gary", "dawn", "may", "red", "blue", "lance", "cynthia"]
+BASE_ROMS = {"gba": ["firered", "emerald", "ruby"], "nds": ["soulsilver", "platinum"]}
+
+
+def make_catalog(count, seed=0, nds_ratio=0.2):
+    # A hacks.json style catalog of `count` entries with no box art, so nothing
+    # using it goes near the network.
+    rng = random.Random(seed)
+    hacks = {}
+    for i in range(count):
+        hack_id = f"hack{i:06d}"
+        system = "nds" if rng.random() < nds_ratio else "gba"
+        words = [rng.choice(NAME_WORDS) for _ in range(rng.randint(1, 4))]
+        hacks[hack_id] = {
+            "id": hack_id,
+            "name": " ".join(words).title() + f" {i}",
+            "description": " ".join(rng.choice(NAME_WORDS) for _ in range(12)),
+            "author": rng.choice(AUTHOR_WORDS) + str(rng.randint(1, 99)),
+            "system": system,
+            "base_rom_id": rng.choice(BASE_ROMS[system]),
+            "patch_file": f"patches/{hack_id}.{'xdelta' if system == 'nds' else 'bps'}",
+            "revision": 1,
+        }
+    return hacks
+
+
+def touch_catalog(catalog, ratio, seed=0):
+    # A copy of a catalog with `ratio` of its entries given a new revision.
+    rng = random.Random(seed)
+    updated = {hack_id: dict(info) for hack_id, info in catalog.items()}
+    for hack_id in rng.sample(sorted(updated), int(len(updated) * ratio)):
+        updated[hack_id]["revision"] += 1
+        updated[hack_id]["name"] += " DX"
+    return updated
+
+
+PATCH_GENERATORS = {
+    "ips": make_ips,
+    "bps": make_bps,
+    "ups": make_ups,
+}
@@ -0,0 +1,288 @@
+import hashlib
+import json
+import mmap
+import os
+import struct
+import sys
+from array import array
+from json.decoder import WHITESPACE
+
+# Compact in-memory form of hacks.json. Each entry is a CatalogEntry with
+# __slots__ instead of a dict, with repeated strings like author, system and
+# base_rom_id shared between entries, and the document is parsed an entry at a
+# time rather than all at once. ROM objects are only made for an entry when
+# something looks it up, see RomTable.
+#
+# A parsed catalog can be saved as a binary snapshot, which is mmapped and read
+# back without parsing the catalog again: entries are rows of indexes into one
+# JSON table of distinct values, so only each distinct value is decoded, once.
+
+# The fields kept from each entry, in snapshot column order
+FIELDS = (
+    "id", "name", "description", "author", "system", "base_rom_id", "box_art_url",
+    "patch_file", "patch_sha256", "base_rom_crc32", "base_rom_sha1", "revision",
+)
+# Values shared by many entries, interned so there's one copy of each
+INTERNED_FIELDS = ("author", "system", "base_rom_id")
+_INTERNED_INDEXES = [FIELDS.index(field) for field in INTERNED_FIELDS]
+VERSION_KEY = "catalog_version"
+
+SNAPSHOT_MAGIC = b"RHCATSNP"
+SNAPSHOT_FORMAT = 1
+# magic, format, field count, entry count, value table size, catalog version and source key value indexes
+SNAPSHOT_HEADER = struct.Struct("<8sHHIIII")
+
+
+def _digest(info):
+    # Stands in for the whole entry when it has no revision, to spot changes.
+    encoded = json.dumps(info, sort_keys=True, separators=(",", ":")).encode("utf-8")
+    return int.from_bytes(hashlib.blake2b(encoded, digest_size=8).digest(), "little")
+
+
+class CatalogEntry:
+    # One hack from the catalog, holding just the fields the launcher uses.
+    __slots__ = FIELDS + ("digest",)
+
+    def __init__(self, values, digest=None):
+        # values are in FIELDS order
+        (self.id, self.name, self.description, self.author, self.system, self.base_rom_id, self.box_art_url,
+         self.patch_file, self.patch_sha256, self.base_rom_crc32, self.base_rom_sha1, self.revision) = values
+        self.digest = digest
+
+    @classmethod
+    def from_info(cls, info, hack_id=None):
+        # Builds an entry from its hacks.json dict. The catalog's key for it, if given,
+        # is its id, as that's what everything looks it up by.
+        values = [info.get(field) for field in FIELDS]
+        if hack_id is not None:
+            values[0] = hack_id
+        for index in _INTERNED_INDEXES:
+            if isinstance(values[index], str):
+                values[index] = sys.intern(values[index])
+        return cls(values, None if info.get("revision") is not None else _digest(info))
+
+    def is_outdated(self, other):
+        # Whether other is a newer version of this entry, going by the revision if
+        # both have one and otherwise by the whole entry.
+        if self.revision is not None and other.revision is not None:
+            return self.revision != other.revision
+        return self.digest is None or self.digest != other.digest
+
+    def values(self):
+        return [getattr(self, field) for field in FIELDS]
+
+    def as_dict(self):
+        return {field: value for field, value in zip(FIELDS, self.values()) if value is not None}
+
+
+class Catalog:
+    # A parsed catalog: its version, if it has one, and its entries keyed by hack id.
+
+    def __init__(self, entries=None, version=None):
+        self.entries = entries if entries is not None else {}
+        self.version = version
+
+    def __len__(self):
+        return len(self.entries)
+
+
+def iter_json_object(content):
+    # Yields the (key, value) pairs of a JSON object one at a time, so only one
+    # catalog entry is ever held as a dict. Raises json.JSONDecodeError like json.loads.
+    text = content.decode("utf-8-sig") if isinstance(content, (bytes, bytearray)) else content
+    decoder = json.JSONDecoder()
+    index = WHITESPACE.match(text, 0).end()
+    if text[index:index + 1] != "{":
+        raise json.JSONDecodeError("Expecting '{'", text, index)
+    index = WHITESPACE.match(text, index + 1).end()
+    if text[index:index + 1] == "}":
+        _check_end(text, index + 1)
+        return
+    while True:
+        key, index = decoder.raw_decode(text, index)
+        if not isinstance(key, str):
+            raise json.JSONDecodeError("Expecting property name", text, index)
+        index = WHITESPACE.match(text, index).end()
+        if text[index:index + 1] != ":":
+            raise json.JSONDecodeError("Expecting ':' delimiter", text, index)
+        value, index = decoder.raw_decode(text, WHITESPACE.match(text, index + 1).end())
+        yield key, value
+        index = WHITESPACE.match(text, index).end()
+        delimiter = text[index:index + 1]
+        index = WHITESPACE.match(text, index + 1).end()
+        if delimiter == "}":
+            _check_end(text, index)
+            return
+        if delimiter != ",":
+            raise json.JSONDecodeError("Expecting ',' delimiter", text, index)
+
+
+def _check_end(text, index):
+    index = WHITESPACE.match(text, index).end()
+    if index != len(text):
+        raise json.JSONDecodeError("Extra data", text, index)
+
+
+def read_catalog(source):
+    # Returns a Catalog from hacks.json as bytes or text, an already parsed dict,
+    # or a Catalog (which is returned as it is). Entries that aren't objects are skipped.
+    if isinstance(source, Catalog):
+        return source
+    pairs = source.items() if isinstance(source, dict) else iter_json_object(source)
+    catalog = Catalog()
+    for key, value in pairs:
+        if key == VERSION_KEY:
+            catalog.version = value
+        elif isinstance(value, dict):
+            catalog.entries[key] = CatalogEntry.from_info(value, key)
+    return catalog
+
+
+def write_snapshot(path, catalog, source_key=None):
+    # Saves a catalog in the binary snapshot format: a header, each entry as a row
+    # of indexes into a table of distinct values, the entries' digests, then the
+    # table itself as one JSON array. source_key identifies what the catalog was
+    # made from, read_snapshot only returns it for the same key.
+    values = [None] # None is always index 0
+    value_index = {}
+
+    def add(value):
+        if value is None:
+            return 0
+        # Lists and objects can't be dict keys, so they're keyed by their JSON
+        key = (type(value), value if isinstance(value, (str, int, float)) else json.dumps(value, sort_keys=True))
+        index = value_index.get(key)
+        if index is None:
+            index = value_index[key] = len(values)
+            values.append(value)
+        return index
+
+    version_index = add(catalog.version)
+    source_index = add(source_key)
+    rows = array("I")
+    digests = array("Q")
+    for entry in catalog.entries.values():
+        rows.extend(map(add, entry.values()))
+        digests.append(entry.digest or 0)
+    table = json.dumps(values, separators=(",", ":")).encode("utf-8")
+
+    temp_path = path.with_name(path.name + ".tmp")
+    with open(temp_path, "wb") as f:
+        f.write(SNAPSHOT_HEADER.pack(SNAPSHOT_MAGIC, SNAPSHOT_FORMAT, len(FIELDS), len(catalog.entries), len(table), version_index, source_index))
+        f.write(rows.tobytes())
+        f.write(digests.tobytes())
+        f.write(table)
+    os.replace(temp_path, path)
+
+
+def read_snapshot(path, source_key=None):
+    # Loads a snapshot saved by write_snapshot, or returns None if there isn't a
+    # usable one for source_key. Each distinct value is decoded once and shared
+    # by every entry that has it.
+    try:
+        with open(path, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+            return _read_mapped(mapped, source_key)
+    except (OSError, ValueError, IndexError, struct.error) as e:
+        if not isinstance(e, FileNotFoundError):
+            print(f"Ignoring unreadable catalog snapshot {path}: {e}")
+        return None
+
+
+def _read_array(mapped, typecode, position, count):
+    values = array(typecode)
+    values.frombytes(mapped[position:position + count * values.itemsize])
+    if len(values) != count:
+        raise ValueError("snapshot is truncated")
+    return values, position + count * values.itemsize
+
+
+def _read_mapped(mapped, source_key):
+    magic, fmt, field_count, count, table_size, version_index, source_index = SNAPSHOT_HEADER.unpack_from(mapped)
+    if magic != SNAPSHOT_MAGIC or fmt != SNAPSHOT_FORMAT or field_count != len(FIELDS):
+        return None
+    rows, position = _read_array(mapped, "I", SNAPSHOT_HEADER.size, count * field_count)
+    digests, position = _read_array(mapped, "Q", position, count)
+    values = json.loads(mapped[position:position + table_size])
+    if values[source_index] != source_key:
+        return None
+
+    lookup = values.__getitem__
+    entries = {}
+    for row in range(count):
+        entry = CatalogEntry(list(map(lookup, rows[row * field_count:(row + 1) * field_count])), digests[row] or None)
+        entries[entry.id] = entry
+    return Catalog(entries, values[version_index])
+
+
+class RomList:
+    # A list of ROMs by hack id, whose ROM objects are only made as they're read,
+    # so a screen showing a few rows of a long list only makes those few.
+
+    def __init__(self, table, hack_ids):
+        self.table = table
+        self.ids = hack_ids
+
+    def __len__(self):
+        return len(self.ids)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return RomList(self.table, self.ids[index])
+        return self.table[self.ids[index]]
+
+    def __iter__(self):
+        for hack_id in self.ids:
+            yield self.table[hack_id]
+
+
+class RomTable:
+    # The catalog's entries keyed by hack id, behaving like a dict of ROM objects.
+    # An entry's ROM is made by make_rom the first time it's looked up, and kept,
+    # so anything holding on to it sees later updates to the entry.
+
+    def __init__(self, make_rom):
+        self.entries = {}
+        self._roms = {}
+        self._make_rom = make_rom
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __contains__(self, hack_id):
+        return hack_id in self.entries
+
+    def __iter__(self):
+        return iter(self.entries)
+
+    def __getitem__(self, hack_id):
+        rom = self._roms.get(hack_id)
+        if rom is None:
+            rom = self._roms[hack_id] = self._make_rom(self.entries[hack_id])
+        return rom
+
+    def __delitem__(self, hack_id):
+        del self.entries[hack_id]
+        self._roms.pop(hack_id, None)
+
+    def get(self, hack_id, default=None):
+        return self[hack_id] if hack_id in self.entries else default
+
+    def values(self):
+        return RomList(self, list(self.entries))
+
+    def rows(self, hack_ids):
+        return RomList(self, hack_ids)
+
+    def set_entry(self, entry):
+        # Adds or replaces an entry. A ROM already made for it is updated in place,
+        # unless the entry moved to another system, which needs a new ROM object.
+        self.entries[entry.id] = entry
+        rom = self._roms.get(entry.id)
+        if rom is not None:
+            if rom.system == entry.system:
+                rom.update_info(entry)
+            else:
+                del self._roms[entry.id]
+
+    def materialized_count(self):
+        return len(self._roms)
@@ -0,0 +1,267 @@
+import argparse
+import contextlib
+import json
+import sys
+import threading
+import time
+
+import tracing
+from app import RomLauncherService
+from install_queue import ACTIVE_STATES, CANCELLED, DONE, FAILED
+from library import STORAGE_COMPRESSED, STORAGE_ROM, VERIFY_OK
+
+# Command line front end to RomLauncherService, for setting up and refreshing a
+# library without a display. Doesn't touch Tk or PIL, so it's quick to start and
+# fine to run from scripts and cron:
+#   python cli.py sync
+#   python cli.py install -j 4 hack_a hack_b
+#   python cli.py install --batch hack_a hack_b hack_c
+#   python cli.py list --installed --json
+# Everything the service prints goes to stderr, so --json output on stdout can
+# be piped straight into something else.
+
+INSTALL_POLL_SECONDS = 0.2
+
+
+def _rom_summary(rom, installed_ids, library):
+    summary = {
+        "id": rom.id,
+        "name": rom.name,
+        "author": rom.author,
+        "system": rom.system,
+        "base_rom_id": rom.base_rom_id,
+        "installed": rom.id in installed_ids,
+    }
+    if summary["installed"]:
+        entry = library.get(rom.id) or {}
+        summary["storage"] = entry.get("storage", STORAGE_ROM)
+        summary["file"] = entry.get("file")
+    return summary
+
+
+def _print_table(rows, columns):
+    # Plain columns, each as wide as its longest value.
+    widths = [max([len(title)] + [len(str(row.get(key) or "")) for row in rows]) for key, title in columns]
+    print("  ".join(title.ljust(width) for (_, title), width in zip(columns, widths)))
+    for row in rows:
+        print("  ".join(str(row.get(key) or "").ljust(width) for (key, _), width in zip(columns, widths)))
+
+
+def _list_roms(service, args, search_query=None):
+    if args.installed:
+        roms = service.get_installed_hacks(search_query, args.system, args.base_rom)
+    elif args.available:
+        roms = service.get_available_hacks(search_query, args.system, args.base_rom)
+    else:
+        roms = service.get_all_hacks(search_query, args.system, args.base_rom)
+    if not search_query:
+        roms = sorted(roms, key=lambda rom: (rom.name or "").lower())
+    installed_ids = service.library.installed_ids()
+    return [_rom_summary(rom, installed_ids, service.library) for rom in roms], 0
+
+
+def cmd_list(service, args):
+    return _list_roms(service, args)
+
+
+def cmd_search(service, args):
+    return _list_roms(service, args, args.query)
+
+
+def cmd_install(service, args):
+    # Queues every hack and waits for them all, cancelling the lot on Ctrl+C.
+    if args.batch:
+        return _install_batch(service, args)
+    results = {}
+    jobs = []
+    for hack_id in args.ids:
+        job = service.queue_install(hack_id)
+        if job is None:
+            results[hack_id] = "not found"
+        else:
+            jobs.append(job)
+
+    states = {}
+    def on_update(job):
+        if states.get(job.rom.id) != job.state:
+            states[job.rom.id] = job.state
+            print(f"[{job.rom.id}] {job.state}", file=sys.stderr)
+    service.installs.add_listener(on_update)
+
+    try:
+        while any(job.state in ACTIVE_STATES for job in jobs):
+            time.sleep(INSTALL_POLL_SECONDS)
+    except KeyboardInterrupt:
+        for job in jobs:
+            service.cancel_install(job.rom.id)
+        while any(job.state in ACTIVE_STATES for job in jobs):
+            time.sleep(INSTALL_POLL_SECONDS)
+
+    for job in jobs:
+        results[job.rom.id] = job.state
+    failed = any(state != DONE for state in results.values())
+    return results, 1 if failed else 0
+
+
+def _install_batch(service, args):
+    # Runs RomLauncherService.install_batch on a thread, so Ctrl+C reaches this one
+    # and can cancel the batch.
+    cancel_event = threading.Event()
+    outcome = {}
+    def on_result(hack_id, success):
+        print(f"[{hack_id}] {DONE if success else FAILED}", file=sys.stderr)
+    def run():
+        outcome.update(service.install_batch(args.ids, args.jobs, cancel_event, on_result))
+    worker = threading.Thread(target=run, daemon=True)
+    worker.start()
+
+    try:
+        while worker.is_alive():
+            worker.join(INSTALL_POLL_SECONDS)
+    except KeyboardInterrupt:
+        cancel_event.set()
+        worker.join()
+
+    results = {}
+    for hack_id in args.ids:
+        if service.get_rom(hack_id) is None:
+            results[hack_id] = "not found"
+        elif hack_id in outcome:
+            results[hack_id] = DONE if outcome[hack_id] else FAILED
+        else:
+            results[hack_id] = CANCELLED
+    failed = any(state != DONE for state in results.values())
+    return results, 1 if failed else 0
+
+
+def cmd_delete(service, args):
+    results = {}
+    for hack_id in args.ids:
+        if service.get_rom(hack_id) is None:
+            results[hack_id] = "not found"
+        else:
+            results[hack_id] = "deleted" if service.delete_rom(hack_id) is True else "failed"
+    return results, 0 if all(result == "deleted" for result in results.values()) else 1
+
+
+def cmd_verify(service, args):
+    results = service.verify_installs(args.ids or None, args.jobs)
+    return results, 0 if all(status == VERIFY_OK for status in results.values()) else 1
+
+
+def cmd_sync(service, args):
+    # Revalidates the catalog and re-checks the library against the disk.
+    changes = service.load_catalog(refresh=True)
+    service.library.reconcile()
+    changes["installed"] = len(service.library.installed_ids())
+    changes["catalog"] = len(service.get_all_hacks())
+    return changes, 0
+
+
+def cmd_migrate(service, args):
+    target = STORAGE_COMPRESSED if args.to == STORAGE_COMPRESSED else STORAGE_ROM
+    if args.format:
+        service.config.set_setting("compression_format", args.format)
+    results = service.migrate_storage(target, args.jobs)
+    return results, 1 if results["failed"] else 0
+
+
+def _print_result(command, result):
+    # The human readable version of each command's result.
+    if command in ("list", "search"):
+        if result:
+            _print_table(result, [("id", "ID"), ("name", "Name"), ("system", "System"), ("base_rom_id", "Base ROM"), ("storage", "Installed")])
+        else:
+            print("No hacks found.")
+    elif command == "sync":
+        print(f"{len(result['added'])} added, {len(result['updated'])} updated, {len(result['removed'])} removed. "
+              f"{result['catalog']} hacks in the catalog, {result['installed']} installed.")
+    elif command == "migrate":
+        print(f"{result['converted']} converted, {result['skipped']} skipped, {result['failed']} failed.")
+    else:
+        for hack_id, status in result.items():
+            print(f"{hack_id}: {status}")
+
+
+def _add_filters(parser):
+    shown = parser.add_mutually_exclusive_group()
+    shown.add_argument("--installed", action="store_true", help="Only installed hacks")
+    shown.add_argument("--available", action="store_true", help="Only hacks that aren't installed")
+    parser.add_argument("--system", help="Only this system (gba, nds)")
+    parser.add_argument("--base-rom", help="Only hacks of this base ROM")
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(description="Manage the ROM hack library without the GUI.")
+    parser.add_argument("--json", action="store_true", help="Print results as JSON")
+    parser.add_argument("--offline", action="store_true", help="Use the cached catalog, even if there isn't one")
+    parser.add_argument("--trace", metavar="FILE", help="Record timings and save them to FILE as a Chrome trace")
+    subcommands = parser.add_subparsers(dest="command", required=True)
+
+    list_parser = subcommands.add_parser("list", help="List hacks in the catalog")
+    _add_filters(list_parser)
+    list_parser.set_defaults(handler=cmd_list)
+
+    search_parser = subcommands.add_parser("search", help="Search hacks, best match first")
+    search_parser.add_argument("query")
+    _add_filters(search_parser)
+    search_parser.set_defaults(handler=cmd_search)
+
+    install_parser = subcommands.add_parser("install", help="Install hacks")
+    install_parser.add_argument("ids", nargs="+", metavar="id")
+    install_parser.add_argument("-j", "--jobs", type=int, default=None,
+                                help="How many to install at once, defaults to install_concurrency (with --batch, worker processes, defaults to one per core)")
+    install_parser.add_argument("--batch", action="store_true", help="Patch across one process per core, sharing each base ROM between them")
+    install_parser.set_defaults(handler=cmd_install)
+
+    delete_parser = subcommands.add_parser("delete", help="Delete installed hacks")
+    delete_parser.add_argument("ids", nargs="+", metavar="id")
+    delete_parser.set_defaults(handler=cmd_delete)
+
+    verify_parser = subcommands.add_parser("verify", help="Check installed files against their install-time hashes")
+    verify_parser.add_argument("ids", nargs="*", metavar="id", help="Defaults to everything installed")
+    verify_parser.add_argument("-j", "--jobs", type=int, default=None, help="Files to hash at once")
+    verify_parser.set_defaults(handler=cmd_verify)
+
+    sync_parser = subcommands.add_parser("sync", help="Update the catalog from the server and re-check the library")
+    sync_parser.set_defaults(handler=cmd_sync)
+
+    migrate_parser = subcommands.add_parser("migrate", help="Convert installed ROMs between full and compressed storage")
+    migrate_parser.add_argument("--to", choices=[STORAGE_ROM, "full", STORAGE_COMPRESSED], required=True)
+    migrate_parser.add_argument("--format", choices=["zip", "zstd"], help="Compression format, defaults to compression_format")
+    migrate_parser.add_argument("-j", "--jobs", type=int, default=None, help="Worker processes, defaults to one per core")
+    migrate_parser.set_defaults(handler=cmd_migrate)
+    return parser
+
+
+def main(argv=None):
+    args = build_parser().parse_args(argv)
+    if args.trace:
+        tracing.configure(True)
+    # The service reports what it's doing with print(), which mustn't end up mixed into the results.
+    with contextlib.redirect_stdout(sys.stderr):
+        service = RomLauncherService(sync_on_start=False, install_concurrency=getattr(args, "jobs", None) if args.command == "install" else None)
+        try:
+            if args.command != "sync":
+                # The cached catalog is enough for everything else. It's only fetched
+                # if there's no cache yet, which is what sync is for.
+                service.load_catalog(refresh=False)
+                if not service.get_all_hacks() and not args.offline:
+                    service.load_catalog(refresh=True)
+            result, exit_code = args.handler(service, args)
+        finally:
+            service.installs.shutdown()
+            if args.trace:
+                tracing.export_chrome_trace(args.trace)
+                print(tracing.format_summary())
+
+    if args.json:
+        json.dump(result, sys.stdout, indent=2)
+        sys.stdout.write("\n")
+    else:
+        _print_result(args.command, result)
+    return exit_code
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,7 +1,32 @@
+import atexit
 import json
 import os
+import threading
 from pathlib import Path
 
+# What changing a setting affects, so RomLauncherService.update_settings only redoes
+# what it has to. Everything else is read from the config whenever it's used, so
+# changing it needs nothing more than saving
+RESYNC_SETTINGS = ("server_url",)
+DIRECTORY_SETTINGS = ("patched_roms_dir", "patch_dir", "box_art_dir", "cache_dir")
+
+# How long save_config_later waits for more changes before writing the file
+SAVE_DELAY_SECONDS = 0.5
+
+# Configs with a save_config_later that hasn't written yet, flushed if the app exits first
+_pending_configs = set()
+_pending_lock = threading.Lock()
+
+
+def _flush_pending():
+    with _pending_lock:
+        configs = list(_pending_configs)
+    for config in configs:
+        config.flush()
+
+
+atexit.register(_flush_pending)
+
 # Manages loading and saving application settings from config.json
 class Config:
 
@@ -13,6 +38,19 @@ class Config:
         "patch_dir": "downloaded_patches",
         "box_art_dir": "box_art",
         "patched_roms_dir": "patched_roms",
+        "cache_dir": "cache",
+        "patch_memory_limit_mb": 64,
+        "download_segments": 4,
+        "install_concurrency": 2,
+        "patch_cache_mb": 512,
+        "reflink_installs": True,
+        "storage_mode": "full",
+        "compression_format": "zip",
+        "materialized_dir": "",
+        "materialized_cache_mb": 1024,
+        "thumbnail_cache_mb": 64,
+        "tracing_enabled": False,
+        "trace_file": "",
         "base_roms": {
             "firered": "",
             "emerald": "",
@@ -24,6 +62,8 @@ class Config:
         self.config_file = config_file
         self.default_config = default_config
         self.config_data = {} 
+        self._lock = threading.Lock()
+        self._pending_save = None # Timer for a save_config_later that hasn't written yet
         self.load_config()
 
     def load_config(self):
@@ -31,6 +71,7 @@ class Config:
         if not os.path.exists(self.config_file):
             print(f"Config file not found. Creating default config at {self.config_file}")
             self.config_data = self.default_config.copy()
+            self.ensure_directories()
             self.save_config()
             return
 
@@ -64,22 +105,68 @@ class Config:
     
     def set_setting(self, key, value):
         # Updates a setting value in memory
-        self.config_data[key] = value
+        with self._lock:
+            self.config_data[key] = value
 
-    def save_config(self, new_config=None):
-        # Saves the current configuration to the JSON file
-        if new_config:
-            self.config_data.update(new_config)
-            
-        # Ensure all required directories exist
-        for key in ["patched_roms_dir", "patch_dir", "box_art_dir"]:
+    def changed_settings(self, new_config):
+        # The keys in new_config whose values differ from the current ones
+        return {key for key, value in new_config.items() if self.config_data.get(key) != value}
+
+    def ensure_directories(self, keys=DIRECTORY_SETTINGS):
+        # Creates the configured directories for the given settings
+        for key in keys:
             dir_path = self.config_data.get(key)
             if dir_path:
                 Path(dir_path).mkdir(parents=True, exist_ok=True)
 
-        try:
-            with open(self.config_file, 'w') as f:
-                json.dump(self.config_data, f, indent=4)
-            print(f"Configuration saved to {self.config_file}")
-        except IOError as e:
-            print(f"Error saving config file {self.config_file}: {e}")
\ No newline at end of file
+    def _update(self, new_config):
+        # Applies new settings in memory, creating any directory that was changed
+        if not new_config:
+            return
+        # Under the lock, as a delayed save may be writing config_data out on its timer thread
+        with self._lock:
+            changed = self.changed_settings(new_config)
+            self.config_data.update(new_config)
+        self.ensure_directories([key for key in DIRECTORY_SETTINGS if key in changed])
+
+    def save_config(self, new_config=None):
+        # Saves the current configuration to the JSON file straight away
+        self._update(new_config)
+        self._write()
+
+    def save_config_later(self, new_config=None, delay=SAVE_DELAY_SECONDS):
+        # Applies new settings in memory now and writes the file once they've stopped
+        # changing for delay seconds, so a burst of changes is only written once
+        self._update(new_config)
+        with self._lock:
+            if self._pending_save:
+                self._pending_save.cancel()
+            self._pending_save = threading.Timer(delay, self._write)
+            self._pending_save.daemon = True
+            self._pending_save.start()
+        with _pending_lock:
+            _pending_configs.add(self)
+
+    def flush(self):
+        # Writes a pending save_config_later now, if there is one
+        with self._lock:
+            pending = self._pending_save
+        if pending:
+            self._write()
+
+    def _write(self):
+        # Written to a temp file and renamed so a crash never leaves a half-written config
+        with self._lock:
+            if self._pending_save:
+                self._pending_save.cancel()
+                self._pending_save = None
+            with _pending_lock:
+                _pending_configs.discard(self)
+            temp_path = f"{self.config_file}.tmp"
+            try:
+                with open(temp_path, 'w') as f:
+                    json.dump(dict(self.config_data), f, indent=4)
+                os.replace(temp_path, self.config_file)
+                print(f"Configuration saved to {self.config_file}")
+            except IOError as e:
+                print(f"Error saving config file {self.config_file}: {e}")
\ No newline at end of file
@@ -1,43 +1,386 @@
+import hashlib
+import json
+import os
 import requests
 import shutil
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from pathlib import Path
+from requests.adapters import HTTPAdapter
+
+import tracing
+from catalog import read_catalog, read_snapshot, write_snapshot
+from patch_cache import PatchCache
+from progress import PHASE_DOWNLOAD, PHASE_VERIFY, ByteCounter, report
+
+# Connections kept open per host, also the cap on parallel download segments
+MAX_POOL_SIZE = 16
 
 # Create a single, reusable session object for all requests
 # This enables connection pooling and is much more efficient
 session = requests.Session()
+session.mount("http://", HTTPAdapter(pool_maxsize=MAX_POOL_SIZE))
+session.mount("https://", HTTPAdapter(pool_maxsize=MAX_POOL_SIZE))
+
+DOWNLOAD_CHUNK_SIZE = 64 * 1024
+DOWNLOAD_RETRIES = 3
+# Files smaller than this aren't worth splitting into segments
+SEGMENT_MIN_SIZE = 8 * 1024 * 1024
+
+class DownloadCancelled(Exception):
+    # Raised from inside a download when its cancel event is set.
+    pass
+
+
+class _SegmentAborted(Exception):
+    # Stops a segment once another one has failed, as the whole file is thrown away.
+    pass
+
+
+def _check_cancelled(cancel_event):
+    if cancel_event is not None and cancel_event.is_set():
+        raise DownloadCancelled()
+
+
+def _catalog_cache_paths(config):
+    # The catalog is cached exactly as the server sent it, with its validators kept
+    # in a small separate file so revalidating doesn't have to parse the catalog.
+    cache_dir = Path(config.get_setting("cache_dir", "cache"))
+    return cache_dir / "hacks.json", cache_dir / "hacks.meta.json"
+
+
+def _catalog_snapshot_path(config):
+    # The cached catalog already parsed, see catalog.write_snapshot.
+    return Path(config.get_setting("cache_dir", "cache")) / "hacks.snapshot"
+
+
+def _snapshot_key(cache_path):
+    # Ties a snapshot to the exact hacks.json it was made from.
+    stat = cache_path.stat()
+    return f"{stat.st_size}:{stat.st_mtime_ns}"
+
+
+def _save_catalog_snapshot(config, catalog):
+    cache_path, _ = _catalog_cache_paths(config)
+    snapshot_path = _catalog_snapshot_path(config)
+    try:
+        write_snapshot(snapshot_path, catalog, _snapshot_key(cache_path))
+    except (OSError, TypeError, ValueError) as e:
+        print(f"Could not save catalog snapshot {snapshot_path}: {e}")
+
+
+def _load_catalog_meta(config):
+    _, meta_path = _catalog_cache_paths(config)
+    try:
+        with open(meta_path, "r") as f:
+            meta = json.load(f)
+    except (FileNotFoundError, json.JSONDecodeError, OSError):
+        return None
+    # A cache from a different server is no use to us.
+    if meta.get("server_url") != config.get_setting("server_url"):
+        return None
+    return meta
+
+
+def _write_atomic(path, data):
+    # Written to a temp file and renamed so a crash never leaves a half-written file.
+    temp_path = path.with_name(path.name + ".tmp")
+    with open(temp_path, "wb") as f:
+        f.write(data)
+    os.replace(temp_path, path)
+
+
+def load_cached_hack_list(config):
+    # Loads the last catalog we got from the server as a Catalog, so we can start
+    # (or run offline) without waiting on the network. Read from its snapshot when
+    # that's up to date, otherwise parsed from hacks.json and snapshotted for next time.
+    if _load_catalog_meta(config) is None:
+        return None
+    cache_path, _ = _catalog_cache_paths(config)
+    try:
+        source_key = _snapshot_key(cache_path)
+        with tracing.span("catalog.load_snapshot", "catalog"):
+            catalog = read_snapshot(_catalog_snapshot_path(config), source_key)
+        if catalog is not None:
+            return catalog
+        with tracing.span("catalog.parse", "catalog"):
+            with open(cache_path, "rb") as f:
+                catalog = read_catalog(f.read())
+    except FileNotFoundError:
+        return None
+    except (json.JSONDecodeError, UnicodeDecodeError, OSError) as e:
+        print(f"Ignoring unreadable catalog cache {cache_path}: {e}")
+        return None
+    _save_catalog_snapshot(config, catalog)
+    return catalog
+
+
+def _save_cached_hack_list(config, content, etag, last_modified):
+    cache_path, meta_path = _catalog_cache_paths(config)
+    meta = {
+        "server_url": config.get_setting("server_url"),
+        "etag": etag,
+        "last_modified": last_modified,
+    }
+    try:
+        cache_path.parent.mkdir(parents=True, exist_ok=True)
+        _write_atomic(cache_path, content)
+        _write_atomic(meta_path, json.dumps(meta).encode("utf-8"))
+        return True
+    except OSError as e:
+        print(f"Could not save catalog cache {cache_path}: {e}")
+        return False
+
+
+def _cached_validators(config):
+    # Conditional request headers so the server can answer 304 if nothing changed.
+    meta = _load_catalog_meta(config)
+    cache_path, _ = _catalog_cache_paths(config)
+    if meta is None or not cache_path.exists():
+        return {}
+    headers = {}
+    if meta.get("etag"):
+        headers["If-None-Match"] = meta["etag"]
+    if meta.get("last_modified"):
+        headers["If-Modified-Since"] = meta["last_modified"]
+    return headers
+
 
 def fetch_hack_list_from_server(config):
-    # Gets the hacks.json file from the server
+    # Gets the hacks.json file from the server, revalidating our cached copy.
+    # Returns (hacks, modified). hacks is None if the server says our cached copy
+    # is still current (304) or if the request failed, and the cache should be used.
     server_url = config.get_setting("server_url")
     if not server_url:
         print("Error: Server URL not configured.")
-        return None
+        return None, False
 
     list_url = server_url.rstrip('/') + "/hacks.json" 
 
     try:
         # Use the shared session object for the request
-        response = session.get(list_url, timeout=15) 
+        with tracing.span("fetch.catalog", "network", url=list_url) as span:
+            response = session.get(list_url, headers=_cached_validators(config), timeout=15) 
+            span.set(status=response.status_code, bytes=len(response.content))
+        if response.status_code == 304:
+            tracing.count("catalog.cache_hit")
+            return None, False
         response.raise_for_status()
-        return response.json()
+        tracing.count("catalog.cache_miss")
+        tracing.count("download.bytes", len(response.content))
+        with tracing.span("catalog.parse", "catalog"):
+            hacks = read_catalog(response.content)
+        if _save_cached_hack_list(config, response.content, response.headers.get("ETag"), response.headers.get("Last-Modified")):
+            _save_catalog_snapshot(config, hacks)
+        return hacks, True
     except requests.exceptions.RequestException as e:
         print(f"Error fetching hack list from {list_url}: {e}")
     except Exception as e: 
         print(f"An unexpected error occurred fetching hack list: {e}")
-    return None
+    return None, False
 
 
-def download_patch_from_server(patch_url, config):
-    # Downloads a patch file from the server if it doesn't exist locally
-    patch_cache_dir = Path(config.get_setting("patch_dir", "downloaded_patches"))
-    patch_cache_dir.mkdir(parents=True, exist_ok=True)
+def _expected_total(response, offset):
+    # Works out how big the finished file should be, if the server tells us.
+    if response.headers.get("Content-Encoding", "identity") != "identity":
+        return None
+    if response.status_code == 206:
+        content_range = response.headers.get("Content-Range", "")
+        total = content_range.rpartition("/")[2]
+        return int(total) if total.isdigit() else None
+    length = response.headers.get("Content-Length")
+    return int(length) if length and length.isdigit() else None
 
-    local_patch_filename = Path(patch_url).name
-    local_patch_path = patch_cache_dir / local_patch_filename
 
-    if local_patch_path.exists():
-        print(f"Patch already exists: {local_patch_path}")
-        return str(local_patch_path)
+def download_file_resumable(url, part_path, timeout=30, retries=DOWNLOAD_RETRIES, cancel_event=None, progress=None):
+    # Streams url into part_path in chunks, resuming with a Range request from
+    # whatever is already in the part file. Returns the sha256 of the whole file.
+    # Setting cancel_event stops the download between chunks with DownloadCancelled.
+    part_path = Path(part_path)
+    for attempt in range(retries + 1):
+        hasher = hashlib.sha256()
+        offset = 0
+        if part_path.exists():
+            with open(part_path, "rb") as f:
+                for chunk in iter(lambda: f.read(DOWNLOAD_CHUNK_SIZE), b""):
+                    hasher.update(chunk)
+                    offset += len(chunk)
+
+        headers = {"Accept-Encoding": "identity"}
+        if offset:
+            headers["Range"] = f"bytes={offset}-"
+
+        received = offset
+        try:
+            with tracing.span("download.stream", "network", url=url, offset=offset), \
+                    session.get(url, headers=headers, stream=True, timeout=timeout) as response:
+                if response.status_code == 416:
+                    # Nothing left to send means the part file is already complete.
+                    total = response.headers.get("Content-Range", "").rpartition("/")[2]
+                    if total.isdigit() and int(total) == offset:
+                        return hasher.hexdigest()
+                    part_path.unlink()
+                    continue
+                response.raise_for_status()
+
+                if offset and response.status_code != 206:
+                    # The server ignored the Range header, so start again from zero.
+                    print(f"Server doesn't support resuming, restarting download of {url}")
+                    hasher = hashlib.sha256()
+                    offset = 0
+                    received = 0
+
+                expected = _expected_total(response, offset)
+                with open(part_path, "ab" if offset else "wb") as f:
+                    for chunk in response.iter_content(DOWNLOAD_CHUNK_SIZE):
+                        _check_cancelled(cancel_event)
+                        f.write(chunk)
+                        hasher.update(chunk)
+                        offset += len(chunk)
+                        report(progress, PHASE_DOWNLOAD, offset, expected)
+
+                if expected is not None and offset != expected:
+                    raise requests.exceptions.ConnectionError(f"Download stopped at {offset} of {expected} bytes")
+                return hasher.hexdigest()
+        except requests.exceptions.RequestException as e:
+            if attempt == retries:
+                raise
+            tracing.count("download.retries")
+            print(f"Download of {url} interrupted ({e}), resuming...")
+            time.sleep(attempt + 1)
+        finally:
+            tracing.count("download.bytes", offset - received)
+    raise requests.exceptions.RetryError(f"Could not download {url} after {retries + 1} attempts")
+
+
+def _hash_file(path, progress=None):
+    hasher = hashlib.sha256()
+    total = os.path.getsize(path)
+    done = 0
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(DOWNLOAD_CHUNK_SIZE * 16), b""):
+            hasher.update(chunk)
+            done += len(chunk)
+            report(progress, PHASE_VERIFY, done, total)
+    return hasher.hexdigest()
+
+
+def _probe_download(url, timeout):
+    # HEAD request for the file size and whether the server accepts byte ranges.
+    with tracing.span("download.probe", "network", url=url):
+        response = session.head(url, allow_redirects=True, timeout=timeout, headers={"Accept-Encoding": "identity"})
+    response.raise_for_status()
+    length = response.headers.get("Content-Length")
+    size = int(length) if length and length.isdigit() else None
+    return size, response.headers.get("Accept-Ranges", "").lower() == "bytes"
+
+
+def _download_segment(url, part_path, start, end, timeout, retries, cancel_event=None, counter=None, abort_event=None):
+    # Fetches bytes start..end (inclusive) into the same range of the preallocated file.
+    # Setting abort_event stops it between chunks with _SegmentAborted.
+    pos = start
+    for attempt in range(retries + 1):
+        if abort_event is not None and abort_event.is_set():
+            raise _SegmentAborted()
+        headers = {"Range": f"bytes={pos}-{end}", "Accept-Encoding": "identity"}
+        received = pos
+        try:
+            with tracing.span("download.segment", "network", url=url, start=pos, end=end), \
+                    session.get(url, headers=headers, stream=True, timeout=timeout) as response:
+                response.raise_for_status()
+                if response.status_code != 206:
+                    raise requests.exceptions.InvalidHeader(f"Server ignored the range request for bytes {pos}-{end}")
+                with open(part_path, "r+b") as f:
+                    f.seek(pos)
+                    for chunk in response.iter_content(DOWNLOAD_CHUNK_SIZE):
+                        _check_cancelled(cancel_event)
+                        if abort_event is not None and abort_event.is_set():
+                            raise _SegmentAborted()
+                        chunk = chunk[:end + 1 - pos]
+                        f.write(chunk)
+                        pos += len(chunk)
+                        if counter:
+                            counter.add(len(chunk))
+            if pos == end + 1:
+                return
+            raise requests.exceptions.ConnectionError(f"Segment stopped at byte {pos} of {start}-{end}")
+        except requests.exceptions.InvalidHeader:
+            raise
+        except requests.exceptions.RequestException as e:
+            if attempt == retries:
+                raise
+            tracing.count("download.retries")
+            print(f"Segment {start}-{end} of {url} interrupted ({e}), resuming...")
+            time.sleep(attempt + 1)
+        finally:
+            tracing.count("download.bytes", pos - received)
+
+
+def download_file_segmented(url, part_path, segments, timeout=30, retries=DOWNLOAD_RETRIES, cancel_event=None, progress=None):
+    # Splits a large download into byte ranges fetched in parallel over the shared
+    # session, written straight into their place in a preallocated file next to the
+    # part file, which is only renamed to the part file once every range is in.
+    # Falls back to one resumable stream if the server can't do ranges.
+    # Returns the sha256 of the whole file.
+    part_path = Path(part_path)
+    segments = min(segments, MAX_POOL_SIZE)
+
+    # A part file only ever comes from an interrupted single stream, so resume that instead.
+    if segments > 1 and not part_path.exists():
+        try:
+            size, accepts_ranges = _probe_download(url, timeout)
+        except requests.exceptions.RequestException as e:
+            print(f"Could not probe {url} ({e}), downloading as a single stream.")
+            size, accepts_ranges = None, False
+
+        if accepts_ranges and size and size >= SEGMENT_MIN_SIZE:
+            segment_size = -(-size // segments)
+            bounds = [(start, min(start + segment_size, size) - 1) for start in range(0, size, segment_size)]
+            # Until every range is in it has holes, so it must never be taken for a part file.
+            segments_path = part_path.with_name(part_path.name + ".segments")
+            with open(segments_path, "wb") as f:
+                f.truncate(size)
+            # Every segment adds to the one byte count, so progress covers the whole file.
+            counter = ByteCounter(progress, PHASE_DOWNLOAD, size)
+            abort_event = threading.Event()
+            try:
+                with ThreadPoolExecutor(max_workers=len(bounds)) as pool:
+                    futures = [pool.submit(_download_segment, url, segments_path, start, end, timeout, retries, cancel_event, counter, abort_event) for start, end in bounds]
+                    try:
+                        for future in as_completed(futures):
+                            future.result()
+                    except BaseException:
+                        # The first failure stops the rest, rather than waiting for
+                        # them to download ranges that are about to be thrown away.
+                        abort_event.set()
+                        raise
+                os.replace(segments_path, part_path)
+                return _hash_file(part_path, progress)
+            except requests.exceptions.RequestException as e:
+                print(f"Segmented download of {url} failed ({e}), falling back to a single stream.")
+            finally:
+                # Ranges can't be resumed, so whatever was left unfinished goes.
+                segments_path.unlink(missing_ok=True)
+
+    return download_file_resumable(url, part_path, timeout, retries, cancel_event, progress)
+
+
+def download_patch_from_server(patch_url, config, expected_sha256=None, cancel_event=None, progress=None, cache=None):
+    # Returns a local copy of a patch, from the patch cache if it's there and
+    # passes verification, otherwise downloaded from the server into the cache.
+    # The download goes to a .part file and is only moved into the cache once it's
+    # complete, so an interrupted download is resumed instead of mistaken for a cache hit.
+    # A cancelled download returns None and leaves nothing behind.
+    # The returned path is in use until cache.release() is called on it.
+    cache = cache or PatchCache(config)
+    cached_path = cache.get(patch_url, expected_sha256, progress)
+    if cached_path:
+        return cached_path
+
+    cache.directory.mkdir(parents=True, exist_ok=True)
+    local_patch_filename = Path(patch_url).name
+    part_path = cache.part_path(patch_url)
 
     server_url = config.get_setting("server_url")
     if not server_url:
@@ -48,17 +391,23 @@ def download_patch_from_server(patch_url, config):
     print(f"Downloading patch: {download_url}")
 
     try:
-        # Use the shared session object for the request
-        response = session.get(download_url, timeout=30) # Increased timeout for larger files
-        response.raise_for_status()
-        with open(local_patch_path, "wb") as f:
-            f.write(response.content)
+        segments = int(config.get_setting("download_segments", 4))
+        with tracing.span("download.patch", "network", url=download_url, segments=segments):
+            digest = download_file_segmented(download_url, part_path, segments, cancel_event=cancel_event, progress=progress)
+        if expected_sha256 and digest != expected_sha256.lower():
+            print(f"Error: Patch {local_patch_filename} failed its checksum check, discarding it.")
+            part_path.unlink()
+            return None
+        local_patch_path = cache.add(patch_url, part_path, digest)
         print(f"Patch downloaded to: {local_patch_path}")
-        return str(local_patch_path)
+        return local_patch_path
+    except DownloadCancelled:
+        print(f"Download of {local_patch_filename} cancelled.")
+        part_path.unlink(missing_ok=True)
     except requests.exceptions.RequestException as e:
         print(f"Error downloading patch from {download_url}: {e}")
     except Exception as e:
-        print(f"An unexpected error occurred downloading patch to {local_patch_path}: {e}")
+        print(f"An unexpected error occurred downloading patch {local_patch_filename}: {e}")
     return None
 
 
@@ -84,10 +433,12 @@ def download_image_from_server(image_url, config):
 
     try:
         # Use the shared session and stream the response for efficiency
-        response = session.get(download_url, stream=True, timeout=15)
-        response.raise_for_status()
-        with open(local_image_path, "wb") as f:
-            shutil.copyfileobj(response.raw, f)
+        with tracing.span("download.image", "network", url=download_url):
+            response = session.get(download_url, stream=True, timeout=15)
+            response.raise_for_status()
+            with open(local_image_path, "wb") as f:
+                shutil.copyfileobj(response.raw, f)
+        tracing.count("download.bytes", local_image_path.stat().st_size)
         # We don't print success here to avoid cluttering the console during bulk downloads
         return str(local_image_path)
     except requests.exceptions.RequestException as e:
@@ -2,12 +2,18 @@ import customtkinter
 from customtkinter import CTkFont, CTkImage
 import tkinter as tk
 from tkinter import filedialog, messagebox
+import sys
 import threading
+import queue
 from pathlib import Path
 from PIL import Image
 
-from populate_roms import RomListItemController, load_button_images
+from populate_roms import ROW_HEIGHT, RomListItemController, load_button_images
 from app import RomLauncherService
+from thumbnails import ThumbnailCache
+from art_scheduler import ArtDownloadScheduler, PRIORITY_OFFSCREEN, PRIORITY_VISIBLE
+from install_queue import CANCELLED, DONE, FAILED
+import tracing
 
 # --- Configuration ---
 OUTPUT_PATH = Path(__file__).parent
@@ -19,6 +25,17 @@ HEADER_BG = "#8C1919"
 CONTENT_BG = "#E7E7E7"
 HEADER_FG = "#FFFFFF"
 
+# How long to wait after the last keystroke before searching.
+SEARCH_DEBOUNCE_MS = 150
+
+# Extra rows kept bound above and below the viewport, so scrolling doesn't show gaps.
+LIST_OVERSCAN = 2
+# How often install progress is checked while installs are running.
+INSTALL_POLL_MS = 100
+FINISHED_INSTALL_STATES = (DONE, FAILED, CANCELLED)
+# Pixels scrolled per mouse wheel step.
+SCROLL_UNIT = 40
+
 def relative_to_assets(path: str) -> Path:
     # A little helper to get the full path to an asset file.
     full_path = ASSETS_PATH / Path(path)
@@ -33,11 +50,13 @@ class MainApplication(customtkinter.CTk):
         super().__init__(*args, **kwargs)
 
         # --- Core Application Logic ---
-        self.service = RomLauncherService()
+        # The catalog is loaded in the background so the window appears straight away.
+        self.service = RomLauncherService(sync_on_start=False)
 
         # --- Window Setup ---
         self.title("PokeROM Launcher")
         self.geometry("1024x768")
+        self.protocol("WM_DELETE_WINDOW", self._on_close)
         customtkinter.set_appearance_mode("Light")
         customtkinter.set_default_color_theme("blue")
 
@@ -52,6 +71,23 @@ class MainApplication(customtkinter.CTk):
 
         # --- Initial Data Load ---
         self.refresh_lists()
+        self._start_catalog_load()
+
+    def _on_close(self):
+        # Stops the background workers before the window goes, so none of them
+        # try to call back into a destroyed Tk.
+        if self.search_job:
+            self.after_cancel(self.search_job)
+        self.service.installs.shutdown()
+        self.art_scheduler.shutdown()
+        self.thumbnail_cache.shutdown()
+        trace_file = self.service.config.get_setting("trace_file", "")
+        if tracing.is_enabled() and trace_file:
+            try:
+                tracing.export_chrome_trace(trace_file)
+            except OSError as e:
+                print(f"Could not save trace to {trace_file}: {e}")
+        self.destroy()
 
     def _setup_state_variables(self):
         # Set up the Tkinter variables and other internal state.
@@ -60,25 +96,48 @@ class MainApplication(customtkinter.CTk):
         self.current_base_rom_filter = tk.StringVar(value="All")
 
         # Keep references to any toplevel windows we create.
-        self.install_window = None
         self.filter_window = None
         self.settings_window = None
-        self.scrollable_frame = None
+        self.list_viewport = None
+
+        # The ROM list is virtualized: visible_roms is everything that matches, but only
+        # the rows in view (plus overscan) have widgets, recycled from row_pool.
+        self.visible_roms = []
+        self.row_pool = []
+        self.scroll_offset = 0
+        self.list_key = None
+        self.render_pending = False
+
+        # Catalog loading happens on a worker thread, which hands catalogs back through this queue.
+        self.catalog_loading = False
+
+        # Search-as-you-type waits for a pause in typing before searching.
+        self.search_job = None
+        self.catalog_queue = queue.Queue()
+        self.loading_label = None
+
+        # Installs run on the service's install queue, which reports back through this queue.
+        self.install_updates = queue.Queue()
+        self.installs_pending = set()
 
     def _setup_callbacks_and_caches(self):
         # Pre-load assets and set up callback dicts to be more efficient.
-        self.rom_list_item_controllers = {}
-        
         self.button_image_cache = {
             "installed": load_button_images(["Play", "Delete"], 2, ASSETS_PATH),
             "available": load_button_images(["Install"], 2, ASSETS_PATH)
         }
         
+        self.thumbnail_cache = ThumbnailCache(self.service.config)
+        # One scheduler for all box art, so rows in view are fetched first.
+        self.art_scheduler = ArtDownloadScheduler(self, self.thumbnail_cache)
+
         self.list_item_callbacks = {
-            "play": self.service.play_rom,
+            "play": self._play_rom,
             "delete": self._handle_delete_action,
-            "install": self.start_install_process
+            "install": self.start_install_process,
+            "cancel_install": self._cancel_install
         }
+        self.service.installs.add_listener(self._on_install_update)
 
     def _create_fonts(self):
         # Creates and stores all the fonts we'll need.
@@ -163,6 +222,7 @@ class MainApplication(customtkinter.CTk):
         self.search_entry = customtkinter.CTkEntry(search_frame, placeholder_text="Search...")
         self.search_entry.grid(row=0, column=0, sticky="ew", padx=(0, 5))
         self.search_entry.bind("<Return>", lambda event: self.refresh_lists())
+        self.search_entry.bind("<KeyRelease>", self._on_search_typed)
 
         search_button = self._create_image_hover_button(search_frame, "Search", self.refresh_lists)
         search_button.grid(row=0, column=1, padx=(2, 2))
@@ -173,9 +233,21 @@ class MainApplication(customtkinter.CTk):
         self.title_label = customtkinter.CTkLabel(self.main_content_frame, text="", font=self.fonts["header_title"])
         self.title_label.grid(row=1, column=0, sticky="w", padx=10, pady=5)
         
-        # Create the scrollable frame once here and we're done with it.
-        self.scrollable_frame = customtkinter.CTkScrollableFrame(self.main_content_frame, fg_color=CONTENT_BG, corner_radius=0)
-        self.scrollable_frame.grid(row=2, column=0, sticky="nsew", padx=10, pady=(0, 10))
+        # The list is a plain frame we place rows into ourselves, with our own scrollbar.
+        list_frame = customtkinter.CTkFrame(self.main_content_frame, fg_color=CONTENT_BG, corner_radius=0)
+        list_frame.grid(row=2, column=0, sticky="nsew", padx=10, pady=(0, 10))
+        list_frame.grid_rowconfigure(0, weight=1)
+        list_frame.grid_columnconfigure(0, weight=1)
+
+        self.list_viewport = customtkinter.CTkFrame(list_frame, fg_color=CONTENT_BG, corner_radius=0)
+        self.list_viewport.grid(row=0, column=0, sticky="nsew")
+        self.list_scrollbar = customtkinter.CTkScrollbar(list_frame, command=self._on_scrollbar)
+        self.list_scrollbar.grid(row=0, column=1, sticky="ns")
+
+        self.list_viewport.bind("<Configure>", lambda event: self._schedule_list_render())
+        # Only grab the mouse wheel while the pointer is over the list.
+        self.list_viewport.bind("<Enter>", lambda event: self._bind_mouse_wheel(True))
+        self.list_viewport.bind("<Leave>", lambda event: self._bind_mouse_wheel(False))
 
     # --- UI Action Handlers ---
     def _change_view(self, new_view):
@@ -183,12 +255,30 @@ class MainApplication(customtkinter.CTk):
         self.current_view.set(new_view)
         self.refresh_lists()
         
+    def _play_rom(self, rom_id):
+        # Launching can mean rebuilding the ROM from its patch first (patch-only
+        # storage), so it's done off the Tk thread.
+        threading.Thread(target=self.service.play_rom, args=(rom_id,), daemon=True).start()
+
     def _handle_delete_action(self, rom_id, rom_name):
         # Handles the delete logic, including the confirmation box and list refresh.
         if messagebox.askyesno("Confirm Delete", f"Are you sure you want to permanently delete '{rom_name}'?", icon="warning", parent=self):
             self.service.delete_rom(rom_id)
             self.refresh_lists() # Refresh the list after deleting something
 
+    def _on_search_typed(self, event):
+        # Restarts the debounce timer on every keystroke, so a search that's already
+        # out of date by the time it would run is cancelled and never rendered.
+        if event.keysym == "Return":
+            return
+        if self.search_job:
+            self.after_cancel(self.search_job)
+        self.search_job = self.after(SEARCH_DEBOUNCE_MS, self._run_typed_search)
+
+    def _run_typed_search(self):
+        self.search_job = None
+        self.refresh_lists()
+
     # --- Helper & Utility Methods ---
 
     def _create_image_hover_button(self, parent, base_name, command):
@@ -235,9 +325,15 @@ class MainApplication(customtkinter.CTk):
 
     # --- Core UI Functionality ---
 
+    @tracing.traced("gui.refresh_lists", "gui")
     def refresh_lists(self):
         # This is how we refresh the list of ROMs without destroying everything.
-        # It just hides all the widgets, then shows the ones we need for the current view.
+        # It works out which ROMs match, then the list only renders the ones in view.
+        if self.search_job:
+            # An explicit refresh supersedes any search still waiting on the debounce.
+            self.after_cancel(self.search_job)
+            self.search_job = None
+
         view = self.current_view.get()
         query = self.search_entry.get()
         system = self.current_system_filter.get()
@@ -247,78 +343,211 @@ class MainApplication(customtkinter.CTk):
         base_rom_parameter = base_rom if base_rom != "All" else None
 
         # 1. Figure out which data to show.
+        loading_suffix = " (loading...)" if self.catalog_loading else ""
         if view == "installed":
-            self.title_label.configure(text="My Installed Hacks")
+            self.title_label.configure(text="My Installed Hacks" + loading_suffix)
             hacks = self.service.get_installed_hacks(query, system_parameter, base_rom_parameter)
         else: # "available"
-            self.title_label.configure(text="Available Hacks")
+            self.title_label.configure(text="Available Hacks" + loading_suffix)
             hacks = self.service.get_available_hacks(query, system_parameter, base_rom_parameter)
 
         self.title_label.update()
+        self._update_loading_label(not hacks)
+
+        # 2. Start back at the top if this is a different list, not just a refresh of the same one.
+        list_key = (view, query, system, base_rom)
+        if list_key != self.list_key:
+            self.list_key = list_key
+            self.scroll_offset = 0
+
+        # 3. Render whichever rows are in view.
+        self.visible_roms = hacks or []
+        self._render_list()
+
+    def _list_viewport_height(self):
+        # The viewport height in the same unscaled units that place() takes.
+        scaling = customtkinter.ScalingTracker.get_widget_scaling(self.list_viewport)
+        return max(1, int(self.list_viewport.winfo_height() / scaling))
+
+    def _schedule_list_render(self):
+        # Coalesces bursts of scroll and resize events into one render.
+        if not self.render_pending:
+            self.render_pending = True
+            self.after_idle(self._render_list)
+
+    @tracing.traced("gui.render_list", "gui")
+    def _render_list(self):
+        # Binds pooled rows to the ROMs that are in view and places them. Index i always
+        # goes to pool slot i % pool size, so rows that stay in view keep their widgets
+        # and only rows scrolling in get rebound.
+        self.render_pending = False
+        view = self.current_view.get()
+        viewport_height = self._list_viewport_height()
+        total_height = len(self.visible_roms) * ROW_HEIGHT
+        self.scroll_offset = min(max(0, self.scroll_offset), max(0, total_height - viewport_height))
+
+        pool_size = -(-viewport_height // ROW_HEIGHT) + 1 + 2 * LIST_OVERSCAN
+        while len(self.row_pool) < pool_size:
+            self.row_pool.append(RomListItemController(self.list_viewport, self.list_item_callbacks, self.fonts, self.thumbnail_cache, self.art_scheduler))
+
+        first_visible = self.scroll_offset // ROW_HEIGHT
+        last_visible = (self.scroll_offset + viewport_height) // ROW_HEIGHT
+        first = max(0, first_visible - LIST_OVERSCAN)
+        last = min(len(self.visible_roms), last_visible + 1 + LIST_OVERSCAN)
+        used_slots = set()
+        for index in range(first, last):
+            slot = index % len(self.row_pool)
+            controller = self.row_pool[slot]
+            # Overscan rows' art is only fetched once everything in view has been.
+            priority = PRIORITY_VISIBLE if first_visible <= index <= last_visible else PRIORITY_OFFSCREEN
+            rom = self.visible_roms[index]
+            controller.bind(rom, view, self.button_image_cache[view], priority, self.service.install_job(rom.id))
+            controller.place_at(index * ROW_HEIGHT - self.scroll_offset)
+            used_slots.add(slot)
+        for slot, controller in enumerate(self.row_pool):
+            if slot not in used_slots:
+                controller.hide()
+
+        if total_height > viewport_height:
+            self.list_scrollbar.set(self.scroll_offset / total_height, (self.scroll_offset + viewport_height) / total_height)
+        else:
+            self.list_scrollbar.set(0, 1)
+
+    def _on_scrollbar(self, action, amount, unit=None):
+        # Handles the scrollbar's moveto/scroll commands, the same ones a Tk canvas gets.
+        total_height = len(self.visible_roms) * ROW_HEIGHT
+        if action == "moveto":
+            self.scroll_offset = int(float(amount) * total_height)
+        elif unit == "pages":
+            self.scroll_offset += int(amount) * self._list_viewport_height()
+        else:
+            self.scroll_offset += int(amount) * SCROLL_UNIT
+        self._schedule_list_render()
+
+    def _bind_mouse_wheel(self, active):
+        if active:
+            self.bind_all("<MouseWheel>", self._on_mouse_wheel)
+            self.bind_all("<Button-4>", self._on_mouse_wheel)
+            self.bind_all("<Button-5>", self._on_mouse_wheel)
+        else:
+            self.unbind_all("<MouseWheel>")
+            self.unbind_all("<Button-4>")
+            self.unbind_all("<Button-5>")
+
+    def _on_mouse_wheel(self, event):
+        if event.num == 4:
+            steps = -1
+        elif event.num == 5:
+            steps = 1
+        elif sys.platform == "darwin":
+            steps = -event.delta
+        else:
+            steps = -int(event.delta / 120) or (-1 if event.delta > 0 else 1)
+        self._on_scrollbar("scroll", steps, "units")
+
+    def _update_loading_label(self, list_is_empty):
+        # Shows a placeholder in the empty list while the catalog is still on its way.
+        if self.catalog_loading and list_is_empty:
+            if not self.loading_label:
+                self.loading_label = customtkinter.CTkLabel(self.list_viewport, text="Loading hacks...", font=self.fonts["body"], text_color="#555555")
+            self.loading_label.place(relx=0.5, y=20, anchor="n")
+        elif self.loading_label:
+            self.loading_label.place_forget()
+
+    def _start_catalog_load(self):
+        # Reads the cached catalog and revalidates it with the server on a worker thread.
+        # Nothing here touches Tk, the results are applied on the main thread by _poll_catalog_queue.
+        self.catalog_loading = True
+        self.refresh_lists()
 
-        # 2. Hide all the list items.
-        for controller in self.rom_list_item_controllers.values():
-            controller.hide()
-
-        # 3. Now, create, update, and show only the widgets we need.
-        if not hacks:
-            # If we didn't find anything, we can just show an empty list.
+        def worker():
+            cached = self.service.load_cached_catalog()
+            if cached:
+                self.catalog_queue.put(cached)
+            hacks, modified = self.service.fetch_catalog()
+            if modified and hacks:
+                self.catalog_queue.put(hacks)
+            self.catalog_queue.put(None) # Done
+
+        threading.Thread(target=worker, daemon=True).start()
+        self._poll_catalog_queue()
+
+    def _poll_catalog_queue(self):
+        try:
+            hacks = self.catalog_queue.get_nowait()
+        except queue.Empty:
+            self.after(50, self._poll_catalog_queue)
             return
 
-        for rom in hacks:
-            if rom.id not in self.rom_list_item_controllers:
-                # We only create a controller for a ROM the first time we see it.
-                self.rom_list_item_controllers[rom.id] = RomListItemController(
-                    parent=self.scrollable_frame,
-                    rom=rom,
-                    callbacks=self.list_item_callbacks,
-                    fonts=self.fonts
-                )
-            
-            # Grab the controller and tell it to show itself with the right buttons.
-            controller = self.rom_list_item_controllers[rom.id]
-            controller.update_view(view, self.button_image_cache[view])
-            controller.show()
-
-    def start_install_process(self, rom_id, rom_name):
-        if self.install_window and self.install_window.winfo_exists():
-            self.install_window.focus()
+        if hacks is None:
+            self.catalog_loading = False
+            self.refresh_lists()
+            return
+        self._apply_catalog_batches(self.service.sync_in_batches(hacks))
+
+    def _apply_catalog_batches(self, batches):
+        # Merges one batch per event loop callback so the window stays responsive,
+        # showing what we have so far after each one.
+        with tracing.span("gui.catalog_batch", "gui"):
+            changes = next(batches, None)
+        if changes is None:
+            self._poll_catalog_queue()
             return
+        self._invalidate_list_items(changes)
+        if any(changes.values()):
+            self.refresh_lists()
+        self.after(1, self._apply_catalog_batches, batches)
 
-        self.install_window = customtkinter.CTkToplevel(self)
-        self.install_window.title("Installing")
-        self.center_toplevel(self.install_window, 300, 100)
-        self.install_window.transient(self)
-        self.install_window.grab_set()
-        self.install_window.protocol("WM_DELETE_WINDOW", lambda: None)
-        self.install_window.resizable(False, False)
+    def _invalidate_list_items(self, changes):
+        # Marks rows showing hacks whose catalog entry changed as stale,
+        # so they're filled in again from the updated ROM next render.
+        if not changes:
+            return
+        changed_ids = set(changes["updated"])
+        for controller in self.row_pool:
+            if controller.rom and controller.rom.id in changed_ids:
+                controller.stale = True
 
-        label = customtkinter.CTkLabel(self.install_window, text=f"Installing {rom_name}...", font=self.fonts["body"])
-        label.pack(expand=True, padx=20, pady=20)
+    def start_install_process(self, rom_id, rom_name):
+        # Queues the install in the background, its progress shows on the ROM's row.
+        if self.service.queue_install(rom_id):
+            if not self.installs_pending:
+                self.after(INSTALL_POLL_MS, self._poll_install_updates)
+            self.installs_pending.add(rom_id)
+            self._render_list()
+
+    def _cancel_install(self, rom_id):
+        if self.service.cancel_install(rom_id):
+            self._render_list()
+
+    def _on_install_update(self, job):
+        # Runs on an install worker thread for every state change and (rate limited)
+        # progress report, so just pass it over to the Tk thread, which drains the
+        # queue with after() while any installs are running.
+        self.install_updates.put((job.rom.id, job.state))
+
+    def _poll_install_updates(self):
+        # Drains the install updates. A finished install moves a ROM between
+        # lists so needs a full refresh, anything else (including progress) only
+        # changes rows in view.
+        states = set()
+        while True:
+            try:
+                rom_id, state = self.install_updates.get_nowait()
+            except queue.Empty:
+                break
+            states.add(state)
+            if state in FINISHED_INSTALL_STATES:
+                self.installs_pending.discard(rom_id)
+
+        if DONE in states:
+            self.refresh_lists()
+        elif states:
+            self._render_list()
 
-        result_container = []
-        def worker():
-            result = self.service.install_hack(rom_id)
-            result_container.append(result)
-
-        def check_thread():
-            if install_thread.is_alive():
-                self.after(100, check_thread)
-            else:
-                self.install_window.destroy()
-                if result_container:
-                    result = result_container[0]
-                    if result:
-                        messagebox.showinfo("Success", "Installed successfully!", parent=self)
-                    else:
-                        messagebox.showerror("Error", "Could not install patch.", parent=self)
-                else:
-                    messagebox.showerror("Error", "An unknown error occurred.", parent=self)
-                self.refresh_lists()
-        
-        install_thread = threading.Thread(target=worker)
-        install_thread.start()
-        check_thread()
+        # Every job reports exactly one finished state, so this stops once they all have.
+        if self.installs_pending:
+            self.after(INSTALL_POLL_MS, self._poll_install_updates)
 
     def open_filter_menu(self):
         # Allows users to filter by base ROM or system.
@@ -394,7 +623,7 @@ class MainApplication(customtkinter.CTk):
 
         self.settings_window = customtkinter.CTkToplevel(self)
         self.settings_window.title("Settings")
-        self.settings_window.geometry("650x450")
+        self.settings_window.geometry("650x720")
         self.settings_window.transient(self)
         self.settings_window.grab_set()
 
@@ -433,15 +662,65 @@ class MainApplication(customtkinter.CTk):
                 "emulator_path": entries["emulator"].get(),
                 "patched_roms_dir": entries["patched"].get(),
                 "box_art_dir": entries["box_art"].get(),
-                "base_roms": new_base_roms
+                "base_roms": new_base_roms,
+                "tracing_enabled": tracing_enabled.get()
             }
+            tracing.configure(tracing_enabled.get())
             result = self.service.update_settings(settings_to_update)
+            self._invalidate_list_items(result.get("changes"))
             messagebox.showinfo("Settings", result["message"], parent=self.settings_window)
             self.settings_window.destroy()
             self.refresh_lists()
 
+        tracing_enabled = self._create_diagnostics_panel(frame, row=4)
+
         save_button = customtkinter.CTkButton(frame, text="Save Settings", command=save_settings_action)
-        save_button.grid(row=4, column=0, columnspan=3, pady=20)
+        save_button.grid(row=5, column=0, columnspan=3, pady=20)
+
+    def _create_diagnostics_panel(self, parent, row):
+        # Timings and counters from the tracing module, with a switch to turn it on
+        # and a button to save everything recorded as a Chrome trace.
+        # Returns the switch's variable, which is saved with the rest of the settings.
+        diagnostics_frame = customtkinter.CTkFrame(parent)
+        diagnostics_frame.grid(row=row, column=0, columnspan=3, sticky="nsew", pady=(20, 5))
+        diagnostics_frame.grid_columnconfigure(0, weight=1)
+        customtkinter.CTkLabel(diagnostics_frame, text="Diagnostics", font=self.fonts["bold_body"]).grid(row=0, column=0, sticky="w", padx=10, pady=(5, 5))
+
+        tracing_enabled = tk.BooleanVar(value=tracing.is_enabled())
+        customtkinter.CTkSwitch(diagnostics_frame, text="Record timings", variable=tracing_enabled,
+                                command=lambda: (tracing.configure(tracing_enabled.get()), show_summary())).grid(row=0, column=1, sticky="e", padx=10)
+
+        summary_box = customtkinter.CTkTextbox(diagnostics_frame, height=180, font=("Courier", 12), wrap="none")
+        summary_box.grid(row=1, column=0, columnspan=2, sticky="nsew", padx=10, pady=5)
+
+        def show_summary():
+            summary_box.configure(state="normal")
+            summary_box.delete("1.0", tk.END)
+            summary_box.insert("1.0", tracing.format_summary())
+            summary_box.configure(state="disabled")
+
+        def export_trace():
+            path = filedialog.asksaveasfilename(parent=self.settings_window, defaultextension=".json",
+                                                initialfile="romhack-trace.json", filetypes=[("Chrome trace", "*.json")])
+            if not path:
+                return
+            try:
+                tracing.export_chrome_trace(path)
+                messagebox.showinfo("Diagnostics", f"Trace saved to {path}. Open it in chrome://tracing or ui.perfetto.dev.", parent=self.settings_window)
+            except OSError as e:
+                messagebox.showerror("Diagnostics", f"Could not save the trace: {e}", parent=self.settings_window)
+
+        def reset_trace():
+            tracing.reset()
+            show_summary()
+
+        button_frame = customtkinter.CTkFrame(diagnostics_frame, fg_color="transparent")
+        button_frame.grid(row=2, column=0, columnspan=2, pady=(0, 5))
+        customtkinter.CTkButton(button_frame, text="Refresh", width=90, command=show_summary).pack(side="left", padx=5)
+        customtkinter.CTkButton(button_frame, text="Export Trace...", width=120, command=export_trace).pack(side="left", padx=5)
+        customtkinter.CTkButton(button_frame, text="Reset", width=90, fg_color="#555", hover_color="#777", command=reset_trace).pack(side="left", padx=5)
+        show_summary()
+        return tracing_enabled
 
 
 if __name__ == "__main__":
@@ -0,0 +1,192 @@
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from progress import ThrottledProgress
+
+# Queue of ROM installs run in the background. Downloads and patching have their
+# own worker pools, so one hack's patch is applied while the next is downloading.
+# Every job can be cancelled, and listeners are told each time a job changes state
+# or makes progress (rate limited, so a fast download can't flood them).
+
+QUEUED = "queued"
+DOWNLOADING = "downloading"
+PATCHING = "patching"
+DONE = "done"
+FAILED = "failed"
+CANCELLED = "cancelled"
+
+ACTIVE_STATES = (QUEUED, DOWNLOADING, PATCHING)
+
+
+class InstallJob:
+
+    def __init__(self, rom):
+        self.rom = rom
+        self.state = QUEUED
+        self.cancel_event = threading.Event()
+        self.future = None
+        self.patch_path = None # Set once downloaded, until patching takes it over
+        # Progress through the current phase (download, patch or verify)
+        self.phase = None
+        self.done = 0
+        self.total = None
+        self.phase_started = None
+
+    @property
+    def is_active(self):
+        return self.state in ACTIVE_STATES
+
+    @property
+    def cancelled(self):
+        return self.cancel_event.is_set()
+
+    @property
+    def fraction(self):
+        # How far through the current phase we are, or None if we can't tell.
+        if not self.total:
+            return None
+        return min(1.0, self.done / self.total)
+
+    @property
+    def eta(self):
+        # Seconds left in the current phase at the rate it's gone so far, or None.
+        if not self.total or not self.done or self.phase_started is None:
+            return None
+        elapsed = time.monotonic() - self.phase_started
+        return elapsed * (self.total - self.done) / self.done
+
+    def _update_progress(self, phase, done, total):
+        if phase != self.phase:
+            self.phase = phase
+            self.phase_started = time.monotonic()
+        self.done = done
+        self.total = total
+
+
+class InstallQueue:
+
+    def __init__(self, config, concurrency=None):
+        # concurrency overrides install_concurrency from the config
+        self.config = config
+        concurrency = max(1, int(concurrency or config.get_setting("install_concurrency", 2)))
+        self._lock = threading.Lock()
+        self._download_pool = ThreadPoolExecutor(max_workers=concurrency)
+        self._patch_pool = ThreadPoolExecutor(max_workers=concurrency)
+        self._jobs = {} # hack_id -> latest job for that hack
+        self._listeners = []
+
+    def add_listener(self, listener):
+        # listener(job) is called on the worker thread every time a job changes
+        # state or reports progress.
+        self._listeners.append(listener)
+
+    def _set_state(self, job, state):
+        with self._lock:
+            if job.state in (DONE, FAILED, CANCELLED):
+                return
+            job.state = state
+        self._notify(job)
+
+    def _progress_callback(self, job):
+        # The progress callback handed down to the download and patch code for a job.
+        def on_progress(phase, done, total):
+            job._update_progress(phase, done, total)
+            self._notify(job)
+        return ThrottledProgress(on_progress)
+
+    def _notify(self, job):
+        for listener in self._listeners:
+            try:
+                listener(job)
+            except Exception as e:
+                print(f"Error in install listener: {e}")
+
+    def submit(self, rom):
+        # Queues a ROM for install, unless it's already queued or installing.
+        with self._lock:
+            job = self._jobs.get(rom.id)
+            if job and job.is_active:
+                return job
+            job = InstallJob(rom)
+            self._jobs[rom.id] = job
+        self._set_state(job, QUEUED)
+        job.future = self._download_pool.submit(self._download, job)
+        return job
+
+    def cancel(self, hack_id):
+        # Cancels a job wherever it's got to. Anything it had downloaded or
+        # written so far is cleaned up by the step it's in.
+        with self._lock:
+            job = self._jobs.get(hack_id)
+        if not job or not job.is_active:
+            return False
+        job.cancel_event.set()
+        if job.future and job.future.cancel():
+            # That step never started, so all there is to clean up is a patch
+            # that was waiting to be applied.
+            if job.patch_path:
+                job.rom.patch_cache.release(job.patch_path)
+            self._set_state(job, CANCELLED)
+        return True
+
+    def get(self, hack_id):
+        with self._lock:
+            return self._jobs.get(hack_id)
+
+    def forget(self, hack_id):
+        # Drops a finished job, so a hack that's since been deleted doesn't still
+        # show its old install as done. Returns False if the job is still running.
+        with self._lock:
+            job = self._jobs.get(hack_id)
+            if job and job.is_active:
+                return False
+            self._jobs.pop(hack_id, None)
+        return True
+
+    def active_jobs(self):
+        with self._lock:
+            return [job for job in self._jobs.values() if job.is_active]
+
+    def _download(self, job):
+        if job.cancelled:
+            self._set_state(job, CANCELLED)
+            return
+        self._set_state(job, DOWNLOADING)
+        try:
+            patch_path = job.rom.download_patch(job.cancel_event, self._progress_callback(job))
+        except Exception as e:
+            print(f"Error downloading {job.rom.name}: {e}")
+            patch_path = None
+
+        if patch_path and job.cancelled:
+            job.rom.patch_cache.release(patch_path)
+        if job.cancelled:
+            self._set_state(job, CANCELLED)
+        elif not patch_path:
+            self._set_state(job, FAILED)
+        else:
+            # Hand over to the patch pool, freeing this worker for the next download.
+            job.patch_path = patch_path
+            job.future = self._patch_pool.submit(self._patch, job, patch_path)
+
+    def _patch(self, job, patch_path):
+        self._set_state(job, PATCHING)
+        try:
+            success = job.rom.apply_downloaded_patch(patch_path, job.cancel_event, self._progress_callback(job))
+        except Exception as e:
+            print(f"Error patching {job.rom.name}: {e}")
+            success = False
+
+        # A cancel that arrives after the ROM was renamed into place is too late to matter.
+        if success:
+            self._set_state(job, DONE)
+        else:
+            self._set_state(job, CANCELLED if job.cancelled else FAILED)
+
+    def shutdown(self):
+        # Cancels everything outstanding and stops the worker pools.
+        for job in self.active_jobs():
+            job.cancel_event.set()
+        self._download_pool.shutdown(wait=False, cancel_futures=True)
+        self._patch_pool.shutdown(wait=False, cancel_futures=True)
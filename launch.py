@@ -2,6 +2,8 @@
 import subprocess
 import os
 
+import tracing
+
 def launch_mgba_with_rom(emulator_path, rom_path):
     if not os.path.exists(emulator_path):
         raise FileNotFoundError(f"mGBA executable not found at: {emulator_path}")
@@ -10,7 +12,8 @@ def launch_mgba_with_rom(emulator_path, rom_path):
         raise FileNotFoundError(f"ROM file not found at: {rom_path}")
     
     try:
-        subprocess.Popen([emulator_path, rom_path])
+        with tracing.span("launch.emulator", "subprocess", emulator=os.path.basename(emulator_path)):
+            subprocess.Popen([emulator_path, rom_path])
         return True
     except subprocess.CalledProcessError as e:
         print(f"Error launching mGBA: {e}")
@@ -0,0 +1,197 @@
+import hashlib
+import json
+import os
+import threading
+from pathlib import Path
+
+from progress import PHASE_VERIFY, report
+
+# Keeps a manifest of installed ROMs in the patched ROMs directory, so working out
+# what's installed is a set lookup instead of a stat call per ROM.
+
+MANIFEST_FILENAME = "library.json"
+ROM_EXTENSIONS = (".gba", ".nds")
+# Compressed ROMs are <id>.zip, or <id>.<system>.zst
+ARCHIVE_EXTENSIONS = (".zip", ".zst")
+
+# How an installed hack is stored: the whole patched ROM, just its patch, or the
+# ROM in an archive
+STORAGE_ROM = "rom"
+STORAGE_PATCH = "patch"
+STORAGE_COMPRESSED = "compressed"
+
+# Results of LibraryManifest.verify
+VERIFY_OK = "ok"
+VERIFY_CORRUPT = "corrupt"
+VERIFY_MISSING = "missing"
+VERIFY_UNVERIFIED = "unverified"
+HASH_CHUNK_SIZE = 1024 * 1024
+
+
+def hash_file(path, progress=None):
+    hasher = hashlib.sha256()
+    total = os.path.getsize(path)
+    done = 0
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(HASH_CHUNK_SIZE), b""):
+            hasher.update(chunk)
+            done += len(chunk)
+            report(progress, PHASE_VERIFY, done, total)
+    return hasher.hexdigest()
+
+
+def _identify(filename):
+    # Works out (rom_id, storage) for a file found in the patched ROMs directory,
+    # or None if it isn't an installed ROM.
+    name = filename.lower()
+    if name.endswith(ROM_EXTENSIONS):
+        return Path(filename).stem, STORAGE_ROM
+    if name.endswith(ARCHIVE_EXTENSIONS):
+        stem = Path(filename).stem
+        if stem.lower().endswith(ROM_EXTENSIONS):
+            stem = Path(stem).stem
+        return stem, STORAGE_COMPRESSED
+    return None
+
+
+class LibraryManifest:
+
+    def __init__(self, config):
+        self.config = config
+        self._lock = threading.Lock()
+        self._entries = {} # Manifest entries, keyed by hack_id
+        self._directory = None
+
+    @property
+    def directory(self):
+        return Path(self.config.get_setting("patched_roms_dir"))
+
+    @property
+    def manifest_path(self):
+        return self.directory / MANIFEST_FILENAME
+
+    def _ensure_current(self):
+        # Reloads if the patched ROMs directory was changed in the settings.
+        # Callers must hold the lock.
+        if self._directory != self.directory:
+            self._reconcile_locked()
+
+    def _load(self):
+        try:
+            with open(self.manifest_path, "r") as f:
+                return json.load(f).get("roms", {})
+        except FileNotFoundError:
+            return {}
+        except (json.JSONDecodeError, OSError, AttributeError) as e:
+            print(f"Library manifest {self.manifest_path} is unreadable, rebuilding it: {e}")
+            return {}
+
+    def _save(self):
+        # Written to a temp file and renamed so a crash never leaves a half-written manifest.
+        try:
+            self.directory.mkdir(parents=True, exist_ok=True)
+            temp_path = self.manifest_path.with_name(MANIFEST_FILENAME + ".tmp")
+            with open(temp_path, "w") as f:
+                json.dump({"version": 1, "roms": self._entries}, f, indent=4)
+            os.replace(temp_path, self.manifest_path)
+        except OSError as e:
+            print(f"Could not save library manifest {self.manifest_path}: {e}")
+
+    def reconcile(self):
+        # Checks the manifest against a single listing of the directory. Entries whose
+        # file is gone are dropped, ROM files we don't know about are added, and
+        # files that changed on disk lose their (now stale) hash.
+        with self._lock:
+            self._reconcile_locked()
+
+    def _reconcile_locked(self):
+        self._directory = self.directory
+        entries = self._load()
+        on_disk = {}
+        try:
+            with os.scandir(self._directory) as scan:
+                for item in scan:
+                    if item.is_file() and item.name != MANIFEST_FILENAME:
+                        on_disk[item.name] = item.stat()
+        except OSError:
+            pass
+
+        reconciled = {}
+        for rom_id, entry in entries.items():
+            stat = on_disk.pop(entry.get("file"), None)
+            if stat is None:
+                continue
+            if stat.st_size != entry.get("size") or stat.st_mtime_ns != entry.get("mtime_ns"):
+                entry.update(size=stat.st_size, mtime_ns=stat.st_mtime_ns, sha256=None)
+            reconciled[rom_id] = entry
+
+        # Only ROMs and compressed ROMs are picked up, stored patches and saves
+        # don't mean anything without their manifest entry.
+        for filename, stat in on_disk.items():
+            identified = _identify(filename)
+            if identified is None:
+                continue
+            rom_id, storage = identified
+            if rom_id not in reconciled:
+                reconciled[rom_id] = {"file": filename, "size": stat.st_size, "mtime_ns": stat.st_mtime_ns, "sha256": None, "source_patch": None, "storage": storage}
+
+        changed = reconciled != entries
+        self._entries = reconciled
+        if changed:
+            self._save()
+
+    def installed_ids(self):
+        with self._lock:
+            self._ensure_current()
+            return set(self._entries)
+
+    def is_installed(self, rom_id):
+        with self._lock:
+            self._ensure_current()
+            return rom_id in self._entries
+
+    def get(self, rom_id):
+        with self._lock:
+            self._ensure_current()
+            entry = self._entries.get(rom_id)
+            return dict(entry) if entry else None
+
+    def record_install(self, rom_id, rom_path, source_patch=None, progress=None, storage=STORAGE_ROM, sha256=None):
+        # Called once a ROM has been patched successfully. Hashing the new file is
+        # reported as the install's verify phase, and skipped if sha256 is given.
+        # For patch-only and compressed installs rom_path is the stored patch or archive.
+        rom_path = Path(rom_path)
+        stat = rom_path.stat()
+        entry = {
+            "file": rom_path.name,
+            "size": stat.st_size,
+            "mtime_ns": stat.st_mtime_ns,
+            "sha256": sha256 or hash_file(rom_path, progress),
+            "source_patch": source_patch,
+            "storage": storage,
+        }
+        with self._lock:
+            self._ensure_current()
+            self._entries[rom_id] = entry
+            self._save()
+
+    def verify(self, rom_id):
+        # Re-hashes an installed file and compares it with the hash recorded at install.
+        # Files found by reconcile, or changed since install, have no hash to compare
+        # with and come back VERIFY_UNVERIFIED.
+        entry = self.get(rom_id)
+        if not entry:
+            return VERIFY_MISSING
+        try:
+            digest = hash_file(self.directory / entry["file"])
+        except OSError:
+            return VERIFY_MISSING
+        if not entry.get("sha256"):
+            return VERIFY_UNVERIFIED
+        return VERIFY_OK if digest == entry["sha256"] else VERIFY_CORRUPT
+
+    def record_delete(self, rom_id):
+        with self._lock:
+            self._ensure_current()
+            if self._entries.pop(rom_id, None) is not None:
+                self._save()
@@ -0,0 +1,89 @@
+import os
+import sys
+import tempfile
+import threading
+from pathlib import Path
+
+# Cache of ROMs rebuilt from their patch for launching, used when hacks are
+# installed in patch-only storage mode. It lives on tmpfs where there is one,
+# and the least recently launched ROMs are dropped once it passes
+# materialized_cache_mb, so a big library only ever takes up a few ROMs of space.
+
+TMPFS_DIR = Path("/dev/shm")
+MATERIALIZED_DIRNAME = "romhack-launcher"
+
+
+def default_materialized_dir(config):
+    # tmpfs on Linux, otherwise a folder in the cache directory.
+    if sys.platform.startswith("linux") and TMPFS_DIR.is_dir() and os.access(TMPFS_DIR, os.W_OK):
+        return TMPFS_DIR / MATERIALIZED_DIRNAME
+    return Path(config.get_setting("cache_dir", "cache")) / "materialized"
+
+
+class MaterializedCache:
+
+    def __init__(self, config):
+        self.config = config
+        self._lock = threading.Lock()
+
+    @property
+    def directory(self):
+        configured = self.config.get_setting("materialized_dir", "")
+        return Path(configured) if configured else default_materialized_dir(self.config)
+
+    @property
+    def max_bytes(self):
+        return int(float(self.config.get_setting("materialized_cache_mb", 1024)) * 1024 * 1024)
+
+    def path_for(self, filename):
+        return self.directory / filename
+
+    def lookup(self, filename):
+        # Returns the path of an already materialized ROM, or None.
+        path = self.path_for(filename)
+        try:
+            # Touching the file keeps it at the fresh end of the LRU order.
+            os.utime(path)
+        except OSError:
+            return None
+        return path
+
+    def temp_path(self, filename):
+        # A fresh file in the cache directory to build a ROM in before commit().
+        self.directory.mkdir(parents=True, exist_ok=True)
+        fd, temp_path = tempfile.mkstemp(prefix=filename + ".", suffix=".part", dir=self.directory)
+        os.close(fd)
+        return Path(temp_path)
+
+    def commit(self, temp_path, filename):
+        # Moves a finished ROM into place and makes room for it.
+        path = self.path_for(filename)
+        os.replace(temp_path, path)
+        with self._lock:
+            self._evict(keep=path)
+        return path
+
+    def remove(self, filename):
+        self.path_for(filename).unlink(missing_ok=True)
+
+    def _evict(self, keep):
+        # Deletes the least recently used ROMs until we're under the size cap.
+        # Callers must hold the lock.
+        try:
+            with os.scandir(self.directory) as scan:
+                files = [(entry.stat().st_mtime_ns, entry.stat().st_size, Path(entry.path)) for entry in scan
+                         if entry.is_file(follow_symlinks=False) and not entry.name.endswith(".part")]
+        except OSError:
+            return
+        total = sum(size for _, size, _ in files)
+        for _, size, path in sorted(files):
+            if total <= self.max_bytes:
+                break
+            if path == keep:
+                continue
+            try:
+                path.unlink()
+                total -= size
+            except OSError:
+                # Probably still open in an emulator on Windows, try again next time.
+                pass
@@ -1,16 +1,33 @@
+import os
+import signal
 import subprocess
 import sys
 import shutil
 
-def apply_patch(patch_type, patcher_path, patch_file, input_file, output_file):
-    # Calls the patcher with the correct command-line arguments to apply a patch
-    if patch_type in ["bps","ips"]:
-        # Flips (for .ips and .bps) uses this command structure
-        cmd = [patcher_path, "--apply", patch_file, input_file, output_file]
-    elif patch_type == "ups":
-        # UPS Patcher uses this command structure
-        cmd = [patcher_path, "apply", "--base", input_file, "--patch", patch_file, "--output", output_file]
+import tracing
+from patch_engine import IN_PLACE_PATCHERS, PATCHERS, PatchError, share_source
+from reflink import CLONE_REFLINK, clone_file, describe_savings
+from vcdiff import DEFAULT_MEMORY_LIMIT, UnsupportedPatchError, apply_vcdiff
+
+def apply_patch(patch_type, patcher_path, patch_file, input_file, output_file, memory_limit=DEFAULT_MEMORY_LIMIT, progress=None, in_place=False):
+    # Applies a patch, using the built-in engine where we have one and
+    # falling back to calling the external patcher otherwise.
+    # progress(phase, done, total) is called as the built-in engine works,
+    # the external patcher can't report progress
+    # With in_place, formats that support it are applied to a (reflinked if
+    # possible) copy of the input, writing only what the patch changes
+    if in_place and patch_type in IN_PLACE_PATCHERS:
+        return apply_in_place(IN_PLACE_PATCHERS[patch_type], patch_file, input_file, output_file, progress)
+    if patch_type in PATCHERS:
+        return apply_builtin(PATCHERS[patch_type], patch_file, input_file, output_file, progress=progress)
     elif patch_type == "patch":
+        try:
+            return apply_builtin(apply_vcdiff, patch_file, input_file, output_file, memory_limit=memory_limit, progress=progress)
+        except UnsupportedPatchError as e:
+            if not patcher_path:
+                print(f"Error during patching: {e}")
+                return False
+            print(f"{e} Falling back to {patcher_path}.")
         # Correct command structure for applying an xdelta patch
         cmd = [patcher_path, "patch", patch_file, input_file, output_file]
     else:
@@ -19,10 +36,65 @@ def apply_patch(patch_type, patcher_path, patch_file, input_file, output_file):
 
     return execute_cli(cmd)
 
+def share_base_roms(paths):
+    # Initializer for the worker processes of a batch install. Each base ROM is
+    # mapped once for all the patches the worker applies to it, see share_source.
+    # Workers leave Ctrl+C to the main process, which cancels the batch, and print
+    # to stderr so nothing ends up mixed in with the CLI's results.
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    sys.stdout = sys.stderr
+    for path in paths:
+        try:
+            share_source(path)
+        except OSError as e:
+            # Patches against it fail with the same error when they get there.
+            print(f"Could not map base ROM {path}: {e}")
+
+def apply_builtin(patcher, patch_file, input_file, output_file, **kwargs):
+    # Runs one of the built-in patchers. Unsupported features are re-raised
+    # so the caller can fall back to an external tool.
+    try:
+        with tracing.span("patch.apply", "patch", patcher=patcher.__name__, patch=os.path.basename(patch_file)):
+            patcher(patch_file, input_file, output_file, **kwargs)
+        print(f"Patching successful! Patched file saved to: {output_file}")
+        return True
+    except UnsupportedPatchError:
+        raise
+    except PatchError as e:
+        print(f"Error during patching: {e}")
+        return False
+    except OSError as e:
+        print(f"Error reading or writing files while patching: {e}")
+        return False
+
+def apply_in_place(patcher, patch_file, input_file, output_file, progress=None):
+    # Clones the input to the output and runs one of the in-place patchers on it.
+    try:
+        with tracing.span("patch.clone", "patch") as span:
+            method = clone_file(input_file, output_file)
+            span.set(method=method)
+        with tracing.span("patch.apply", "patch", patcher=patcher.__name__, patch=os.path.basename(patch_file)) as span:
+            written = patcher(patch_file, input_file, output_file, progress=progress)
+            span.set(written=written)
+        size = os.path.getsize(output_file)
+        tracing.count("patch.bytes_written", written)
+        if method == CLONE_REFLINK:
+            tracing.count("patch.bytes_shared", max(0, size - written))
+    except PatchError as e:
+        print(f"Error during patching: {e}")
+        return False
+    except OSError as e:
+        print(f"Error reading or writing files while patching: {e}")
+        return False
+    print(f"Patching successful! Patched file saved to: {output_file}")
+    print(describe_savings(method, size, written))
+    return True
+
 def execute_cli(cmd):
     try:
         # Run the patcher as a subprocess, hiding console output unless an error occurs
-        result = subprocess.run(cmd, check=True, capture_output=True, text=True, creationflags=subprocess.CREATE_NO_WINDOW if sys.platform == "win32" else 0)
+        with tracing.span("patch.subprocess", "subprocess", command=os.path.basename(cmd[0])):
+            result = subprocess.run(cmd, check=True, capture_output=True, text=True, creationflags=subprocess.CREATE_NO_WINDOW if sys.platform == "win32" else 0)
         print(f"Patching successful! Patched file saved to: {cmd[-1]}")
         return True
     except FileNotFoundError:
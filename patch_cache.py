@@ -0,0 +1,163 @@
+import json
+import os
+import re
+import threading
+from pathlib import Path
+
+import tracing
+from library import hash_file
+
+# Cache of downloaded patches in patch_dir, stored under the sha256 of their
+# contents so two hacks whose patches share a filename can't collide. An index
+# maps each patch URL to the hash it last downloaded as, so a reinstall finds its
+# patch without touching the network. Kept under patch_cache_mb, least recently
+# used first, and every cached patch is re-hashed before it's handed out.
+
+INDEX_FILENAME = "index.json"
+OBJECT_PATTERN = re.compile(r"^[0-9a-f]{64}(\.\w+)?$")
+
+
+class PatchCache:
+
+    def __init__(self, config):
+        self.config = config
+        self._lock = threading.Lock()
+        self._index = None # Patch URL -> sha256
+        self._in_use = {} # Path -> number of installs using it, these are never evicted
+
+    @property
+    def directory(self):
+        return Path(self.config.get_setting("patch_dir", "downloaded_patches"))
+
+    @property
+    def max_bytes(self):
+        return int(float(self.config.get_setting("patch_cache_mb", 512)) * 1024 * 1024)
+
+    def _load_index(self):
+        # Callers must hold the lock.
+        if self._index is None:
+            try:
+                with open(self.directory / INDEX_FILENAME, "r") as f:
+                    self._index = json.load(f)
+            except (FileNotFoundError, json.JSONDecodeError, OSError):
+                self._index = {}
+        return self._index
+
+    def _save_index(self):
+        # Callers must hold the lock.
+        index_path = self.directory / INDEX_FILENAME
+        temp_path = index_path.with_name(INDEX_FILENAME + ".tmp")
+        try:
+            self.directory.mkdir(parents=True, exist_ok=True)
+            with open(temp_path, "w") as f:
+                json.dump(self._index, f, indent=4)
+            os.replace(temp_path, index_path)
+        except OSError as e:
+            print(f"Could not save patch cache index: {e}")
+
+    def reload(self):
+        # Forgets the loaded index, for when patch_dir has been changed in the settings.
+        with self._lock:
+            self._index = None
+
+    def _object_path(self, patch_url, sha256):
+        # The extension is kept, as it's how the patch type is worked out.
+        return self.directory / f"{sha256.lower()}{Path(patch_url).suffix.lower()}"
+
+    def part_path(self, patch_url):
+        # Where an in-progress download of this URL goes. Named after the whole URL,
+        # not just the filename, so it can't be mixed up with another hack's patch.
+        name = re.sub(r"[^\w.-]", "_", patch_url.strip("/"))
+        return self.directory / f"{name}.part"
+
+    def get(self, patch_url, expected_sha256=None, progress=None):
+        # Returns the path of a cached, verified copy of the patch, or None. The
+        # path is marked in use until release() is called on it.
+        with self._lock:
+            sha256 = (expected_sha256 or self._load_index().get(patch_url) or "").lower()
+        if not sha256:
+            tracing.count("patch_cache.miss")
+            return None
+
+        path = self._object_path(patch_url, sha256)
+        if not path.is_file():
+            tracing.count("patch_cache.miss")
+            return None
+        try:
+            if hash_file(path, progress) != sha256:
+                print(f"Cached patch {path.name} is corrupt, downloading it again.")
+                tracing.count("patch_cache.corrupt")
+                path.unlink()
+                return None
+            # Touching the file keeps it at the fresh end of the LRU order.
+            os.utime(path)
+        except OSError as e:
+            print(f"Could not read cached patch {path}: {e}")
+            return None
+
+        with self._lock:
+            index = self._load_index()
+            if index.get(patch_url) != sha256:
+                index[patch_url] = sha256
+                self._save_index()
+            self._acquire(path)
+        tracing.count("patch_cache.hit")
+        print(f"Using cached patch: {path}")
+        return str(path)
+
+    def add(self, patch_url, file_path, sha256):
+        # Moves a freshly downloaded patch into the cache and returns its new path,
+        # marked in use until release() is called on it.
+        path = self._object_path(patch_url, sha256)
+        os.replace(file_path, path)
+        with self._lock:
+            self._load_index()[patch_url] = sha256.lower()
+            self._save_index()
+            self._acquire(path)
+            self._evict()
+        return str(path)
+
+    def _acquire(self, path):
+        # Callers must hold the lock.
+        self._in_use[path] = self._in_use.get(path, 0) + 1
+
+    def release(self, path):
+        # Called once an install has finished with a patch from get() or add().
+        path = Path(path)
+        with self._lock:
+            count = self._in_use.get(path, 0) - 1
+            if count > 0:
+                self._in_use[path] = count
+            else:
+                self._in_use.pop(path, None)
+
+    def _evict(self):
+        # Deletes the least recently used patches until we're under the size cap.
+        # Callers must hold the lock.
+        try:
+            with os.scandir(self.directory) as scan:
+                files = [(entry.stat().st_mtime_ns, entry.stat().st_size, Path(entry.path)) for entry in scan if entry.is_file() and OBJECT_PATTERN.match(entry.name)]
+        except OSError:
+            return
+        total = sum(size for _, size, _ in files)
+        if total <= self.max_bytes:
+            return
+
+        evicted = set()
+        for _, size, path in sorted(files):
+            if path in self._in_use:
+                continue
+            try:
+                path.unlink()
+                total -= size
+                evicted.add(path.stem)
+            except OSError:
+                pass
+            if total <= self.max_bytes:
+                break
+
+        if evicted:
+            index = self._load_index()
+            for url in [url for url, sha256 in index.items() if sha256 in evicted]:
+                del index[url]
+            self._save_index()
@@ -0,0 +1,497 @@
+import mmap
+import os
+import zlib
+
+from progress import PHASE_PATCH, report
+
+# Pure Python IPS, BPS and UPS patching.
+# The base ROM is memory mapped rather than read into memory, and the output is
+# written front to back in a single pass, so no external patcher is needed.
+# The *_in_place variants patch an existing copy of the base ROM instead, touching
+# only the bytes the patch changes, which on a reflinked copy leaves the rest of
+# the file sharing its disk blocks with the base ROM.
+
+COPY_CHUNK_SIZE = 1024 * 1024
+# Output bytes between progress reports, so the per-action loops stay cheap
+PROGRESS_STEP = 256 * 1024
+
+# Base ROMs mapped once by share_source and handed out by MappedFile from then on,
+# for a process that applies many patches to the same few base ROMs
+_shared_sources = {} # Real path -> read-only map
+_shared_crcs = {} # id of a shared map -> its CRC32, once something has checked it
+
+
+class PatchError(Exception):
+    # Raised when a patch file is malformed or doesn't match the base ROM.
+    pass
+
+
+def share_source(path):
+    # Maps a base ROM for every patch this process applies to it after this, rather
+    # than each one mapping it again. The map is read-only, so processes sharing a
+    # base ROM this way all read the same pages of it from the page cache.
+    # Returns the map, or None for an empty file, which can't be mapped.
+    key = os.path.realpath(path)
+    if key not in _shared_sources:
+        with open(key, "rb") as f:
+            try:
+                source = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            except ValueError:
+                return None
+        _shared_sources[key] = source
+        _shared_crcs[id(source)] = None
+    return _shared_sources[key]
+
+
+def release_shared_sources():
+    for source in _shared_sources.values():
+        source.close()
+    _shared_sources.clear()
+    _shared_crcs.clear()
+
+
+class MappedFile:
+    # Read-only memory map of a file that also works for empty files,
+    # which mmap refuses to map. Hands out the shared map for base ROMs
+    # passed to share_source.
+
+    def __init__(self, path):
+        self.path = path
+        self._file = None
+        self._map = None
+
+    def __enter__(self):
+        if _shared_sources:
+            shared = _shared_sources.get(os.path.realpath(self.path))
+            if shared is not None:
+                return shared
+        self._file = open(self.path, "rb")
+        try:
+            self._map = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        except ValueError:
+            self._map = b""
+        return self._map
+
+    def __exit__(self, *exc_info):
+        if self._file is None:
+            return False
+        if isinstance(self._map, mmap.mmap):
+            self._map.close()
+        self._file.close()
+        return False
+
+
+class _PatchReader:
+    # Cursor over the patch bytes with the helpers the formats need.
+
+    def __init__(self, data):
+        self.data = data
+        self.pos = 0
+
+    def read(self, length):
+        if self.pos + length > len(self.data):
+            raise PatchError("Patch file is truncated.")
+        chunk = self.data[self.pos:self.pos + length]
+        self.pos += length
+        return chunk
+
+    def read_byte(self):
+        if self.pos >= len(self.data):
+            raise PatchError("Patch file is truncated.")
+        value = self.data[self.pos]
+        self.pos += 1
+        return value
+
+    def read_varint(self):
+        # BPS/UPS variable-length integer: 7 bits per byte, high bit ends the number.
+        value, shift = 0, 1
+        while True:
+            byte = self.read_byte()
+            value += (byte & 0x7F) * shift
+            if byte & 0x80:
+                return value
+            shift <<= 7
+            value += shift
+
+
+class _CrcWriter:
+    # Buffered output file that keeps a running CRC32 of everything written.
+
+    def __init__(self, f):
+        self.f = f
+        self.crc = 0
+        self.written = 0
+
+    def write(self, data):
+        self.f.write(data)
+        self.crc = zlib.crc32(data, self.crc)
+        self.written += len(data)
+
+
+def _copy_source(out, source, start, length):
+    # Streams a range of the source map to the output, padding with zeros past the end.
+    end = start + length
+    pos = start
+    while pos < end and pos < len(source):
+        chunk_end = min(end, pos + COPY_CHUNK_SIZE, len(source))
+        out.write(source[pos:chunk_end])
+        pos = chunk_end
+    if pos < end:
+        out.write(bytes(end - pos))
+
+
+def _check_patch_crc(data, name):
+    # BPS and UPS end with a CRC32 of the patch itself.
+    expected = int.from_bytes(data[-4:], "little")
+    if zlib.crc32(data[:-4]) != expected:
+        raise PatchError(f"{name} patch checksum mismatch, the patch file is corrupt.")
+
+
+def read_source_requirements(patch_file):
+    # Returns {"size", "crc32"} of the base ROM a BPS or UPS patch was made from,
+    # read from its header and footer without loading the rest of the patch.
+    # Returns None for formats that don't record it (IPS).
+    with open(patch_file, "rb") as f:
+        header = f.read(24)
+        if header[:4] not in (b"BPS1", b"UPS1"):
+            return None
+        f.seek(0, 2)
+        if f.tell() < 16:
+            raise PatchError("Patch file is truncated.")
+        f.seek(-12, 2)
+        footer = f.read(4)
+    reader = _PatchReader(header)
+    reader.pos = 4
+    return {"size": reader.read_varint(), "crc32": int.from_bytes(footer, "little")}
+
+
+def _read_ips(patch_file):
+    # IPS is a list of (offset, data) records, with RLE records for repeated bytes.
+    # Returns the records and the size to truncate the output to, if any.
+    with open(patch_file, "rb") as f:
+        reader = _PatchReader(f.read())
+
+    if reader.read(5) != b"PATCH":
+        raise PatchError("Not an IPS patch (missing PATCH header).")
+
+    records = []
+    truncate_to = None
+    while True:
+        offset_bytes = reader.read(3)
+        if offset_bytes == b"EOF":
+            # Optional 3-byte truncation size after the EOF marker.
+            if len(reader.data) - reader.pos >= 3:
+                truncate_to = int.from_bytes(reader.read(3), "big")
+            break
+        offset = int.from_bytes(offset_bytes, "big")
+        size = int.from_bytes(reader.read(2), "big")
+        if size:
+            records.append((offset, reader.read(size)))
+        else:
+            rle_size = int.from_bytes(reader.read(2), "big")
+            records.append((offset, reader.read(1) * rle_size))
+    return records, truncate_to
+
+
+def apply_ips(patch_file, input_file, output_file, progress=None):
+    records, truncate_to = _read_ips(patch_file)
+    with MappedFile(input_file) as source, open(output_file, "wb") as f:
+        # Most IPS patches list records in order without overlaps, in which case
+        # the output is stitched together in one sequential pass over the source.
+        in_order = all(records[i][0] + len(records[i][1]) <= records[i + 1][0] for i in range(len(records) - 1))
+        total = max([len(source)] + [offset + len(data) for offset, data in records])
+        if in_order:
+            pos = 0
+            next_report = 0
+            for offset, data in records:
+                if offset > pos:
+                    _copy_source(f, source, pos, offset - pos)
+                    pos = offset
+                f.write(data)
+                pos = offset + len(data)
+                if pos >= next_report:
+                    report(progress, PHASE_PATCH, pos, total)
+                    next_report = pos + PROGRESS_STEP
+            if pos < len(source):
+                _copy_source(f, source, pos, len(source) - pos)
+        else:
+            # Later records win when they overlap, so apply them on top of a copy.
+            _copy_source(f, source, 0, len(source))
+            for offset, data in records:
+                f.seek(offset)
+                f.write(data)
+        if truncate_to is not None:
+            f.truncate(truncate_to)
+            total = truncate_to
+    report(progress, PHASE_PATCH, total, total)
+    return True
+
+
+def apply_ips_in_place(patch_file, input_file, output_file, progress=None):
+    # output_file must already be a copy of input_file. Returns the bytes written.
+    records, truncate_to = _read_ips(patch_file)
+    written = 0
+    with open(output_file, "r+b") as f:
+        for index, (offset, data) in enumerate(records):
+            f.seek(offset)
+            f.write(data)
+            written += len(data)
+            report(progress, PHASE_PATCH, index + 1, len(records))
+        if truncate_to is not None:
+            f.truncate(truncate_to)
+    report(progress, PHASE_PATCH, len(records), len(records))
+    return written
+
+
+def _read_bps_header(data):
+    # Returns the reader positioned at the first action, and
+    # (source_size, target_size, source_crc, target_crc).
+    if len(data) < 16 or data[:4] != b"BPS1":
+        raise PatchError("Not a BPS patch (missing BPS1 header).")
+    _check_patch_crc(data, "BPS")
+    reader = _PatchReader(data)
+    reader.pos = 4
+    source_size = reader.read_varint()
+    target_size = reader.read_varint()
+    metadata_size = reader.read_varint()
+    reader.read(metadata_size)
+    source_crc = int.from_bytes(data[-12:-8], "little")
+    target_crc = int.from_bytes(data[-8:-4], "little")
+    return reader, (source_size, target_size, source_crc, target_crc)
+
+
+def _check_source(source, size, crc):
+    if len(source) != size:
+        raise PatchError(f"Base ROM is {len(source)} bytes, patch expects {size}.")
+    # A shared base ROM is only checksummed the first time
+    actual = _shared_crcs.get(id(source))
+    if actual is None:
+        actual = zlib.crc32(source)
+        if id(source) in _shared_crcs:
+            _shared_crcs[id(source)] = actual
+    if actual != crc:
+        raise PatchError("Base ROM checksum doesn't match the one this patch was made for.")
+
+
+def apply_bps(patch_file, input_file, output_file, progress=None):
+    # BPS builds the target from source reads, literal data, and relative copies
+    # out of either the source or the already written target.
+    with open(patch_file, "rb") as f:
+        data = f.read()
+    reader, (source_size, target_size, source_crc, target_crc) = _read_bps_header(data)
+
+    with MappedFile(input_file) as source:
+        _check_source(source, source_size, source_crc)
+        with open(output_file, "w+b") as f:
+            if target_size == 0:
+                return True
+            # The target is mapped writable so TargetCopy can read back what we've written.
+            f.truncate(target_size)
+            with mmap.mmap(f.fileno(), target_size) as target:
+                _run_bps_actions(reader, len(data) - 12, source, target, target_size, target_crc, progress, in_place=False)
+    return True
+
+
+def apply_bps_in_place(patch_file, input_file, output_file, progress=None):
+    # output_file must already be a copy of input_file. Returns the bytes written.
+    with open(patch_file, "rb") as f:
+        data = f.read()
+    reader, (source_size, target_size, source_crc, target_crc) = _read_bps_header(data)
+
+    with MappedFile(input_file) as source:
+        _check_source(source, source_size, source_crc)
+        with open(output_file, "r+b") as f:
+            f.truncate(target_size)
+            if target_size == 0:
+                return 0
+            with mmap.mmap(f.fileno(), target_size) as target:
+                return _run_bps_actions(reader, len(data) - 12, source, target, target_size, target_crc, progress, in_place=True)
+
+
+def _run_bps_actions(reader, actions_end, source, target, target_size, target_crc, progress, in_place):
+    # Applies the BPS actions to a writable map of the target and returns the bytes
+    # written. In place, the target starts as a copy of the source, so SourceReads
+    # are already there and anything else is only written where it differs.
+    output_offset = 0
+    source_relative = 0
+    target_relative = 0
+    crc = 0
+    written = 0
+    next_report = 0
+    while reader.pos < actions_end:
+        action = reader.read_varint()
+        command = action & 3
+        length = (action >> 2) + 1
+        if output_offset + length > target_size:
+            raise PatchError("BPS patch writes past the end of the target.")
+
+        if command == 0:  # SourceRead
+            if output_offset + length > len(source):
+                raise PatchError("BPS SourceRead past the end of the base ROM.")
+            chunk = source[output_offset:output_offset + length]
+        elif command == 1:  # TargetRead
+            chunk = reader.read(length)
+        elif command == 2:  # SourceCopy
+            offset = reader.read_varint()
+            source_relative += -(offset >> 1) if offset & 1 else offset >> 1
+            if source_relative < 0 or source_relative + length > len(source):
+                raise PatchError("BPS SourceCopy outside the base ROM.")
+            chunk = source[source_relative:source_relative + length]
+            source_relative += length
+        else:  # TargetCopy
+            offset = reader.read_varint()
+            target_relative += -(offset >> 1) if offset & 1 else offset >> 1
+            if target_relative < 0 or target_relative >= output_offset:
+                raise PatchError("BPS TargetCopy outside the written target.")
+            distance = output_offset - target_relative
+            if distance >= length:
+                chunk = target[target_relative:target_relative + length]
+            else:
+                # Overlapping copy repeats the last `distance` bytes (RLE style).
+                pattern = target[target_relative:output_offset]
+                chunk = (pattern * (length // distance + 1))[:length]
+            target_relative += length
+
+        if in_place and command == 0:
+            # Nothing before this point has been written past output_offset, so the
+            # copy of the source still has these bytes.
+            pass
+        elif not in_place or target[output_offset:output_offset + length] != chunk:
+            target[output_offset:output_offset + length] = chunk
+            written += length
+        crc = zlib.crc32(chunk, crc)
+        output_offset += length
+        if output_offset >= next_report:
+            report(progress, PHASE_PATCH, output_offset, target_size)
+            next_report = output_offset + PROGRESS_STEP
+
+    if output_offset != target_size:
+        raise PatchError("BPS patch ended before the target was complete.")
+    if crc != target_crc:
+        raise PatchError("Patched ROM checksum mismatch, output is invalid.")
+    return written
+
+
+def _read_ups_header(data):
+    # Returns the reader positioned at the first hunk, and
+    # (input_size, output_size, input_crc, output_crc).
+    if len(data) < 16 or data[:4] != b"UPS1":
+        raise PatchError("Not a UPS patch (missing UPS1 header).")
+    _check_patch_crc(data, "UPS")
+    reader = _PatchReader(data)
+    reader.pos = 4
+    input_size = reader.read_varint()
+    output_size = reader.read_varint()
+    input_crc = int.from_bytes(data[-12:-8], "little")
+    output_crc = int.from_bytes(data[-8:-4], "little")
+    return reader, (input_size, output_size, input_crc, output_crc)
+
+
+def _read_ups_run(reader, data, hunks_end):
+    # The XOR run ends at the next zero byte, which is itself applied.
+    run_end = data.find(b"\x00", reader.pos, hunks_end)
+    if run_end < 0:
+        raise PatchError("UPS hunk is missing its terminator.")
+    run = data[reader.pos:run_end + 1]
+    reader.pos = run_end + 1
+    return run
+
+
+def _xor_with_source(run, source, pos):
+    # A UPS run applied to the source at pos, reading zeros past its end.
+    source_run = source[pos:pos + len(run)]
+    if len(source_run) < len(run):
+        source_run += bytes(len(run) - len(source_run))
+    xored = int.from_bytes(run, "little") ^ int.from_bytes(source_run, "little")
+    return xored.to_bytes(len(run), "little")
+
+
+def apply_ups(patch_file, input_file, output_file, progress=None):
+    # UPS stores runs of bytes XORed against the source, separated by skip counts.
+    with open(patch_file, "rb") as f:
+        data = f.read()
+    reader, (input_size, output_size, input_crc, output_crc) = _read_ups_header(data)
+    hunks_end = len(data) - 12
+
+    with MappedFile(input_file) as source:
+        _check_source(source, input_size, input_crc)
+        with open(output_file, "wb") as f:
+            out = _CrcWriter(f)
+            pos = 0
+            next_report = 0
+            while reader.pos < hunks_end:
+                skip = reader.read_varint()
+                _copy_source(out, source, pos, skip)
+                pos += skip
+
+                run = _read_ups_run(reader, data, hunks_end)
+                out.write(_xor_with_source(run, source, pos))
+                pos += len(run)
+                if pos >= next_report:
+                    report(progress, PHASE_PATCH, min(pos, output_size), output_size)
+                    next_report = pos + PROGRESS_STEP
+
+            if out.written < output_size:
+                _copy_source(out, source, pos, output_size - out.written)
+            elif out.written > output_size:
+                # Hunks may run over the end, the target is clipped to its stated size.
+                f.truncate(output_size)
+                out.written = output_size
+                f.flush()
+                with open(output_file, "rb") as written:
+                    out.crc = zlib.crc32(written.read())
+
+        if out.crc != output_crc:
+            raise PatchError("Patched ROM checksum mismatch, output is invalid.")
+    report(progress, PHASE_PATCH, output_size, output_size)
+    return True
+
+
+def apply_ups_in_place(patch_file, input_file, output_file, progress=None):
+    # output_file must already be a copy of input_file. Returns the bytes written.
+    with open(patch_file, "rb") as f:
+        data = f.read()
+    reader, (input_size, output_size, input_crc, output_crc) = _read_ups_header(data)
+    hunks_end = len(data) - 12
+
+    written = 0
+    with MappedFile(input_file) as source:
+        _check_source(source, input_size, input_crc)
+        with open(output_file, "r+b") as f:
+            # Skipped bytes past the end of the source are zeros, which is what
+            # growing the file fills them with.
+            f.truncate(output_size)
+            if output_size == 0:
+                return 0
+            with mmap.mmap(f.fileno(), output_size) as target:
+                pos = 0
+                next_report = 0
+                while reader.pos < hunks_end:
+                    pos += reader.read_varint()
+                    run = _read_ups_run(reader, data, hunks_end)
+                    # Hunks may run over the end, the target is clipped to its stated size.
+                    end = min(pos + len(run), output_size)
+                    if pos < end:
+                        target[pos:end] = _xor_with_source(run, source, pos)[:end - pos]
+                        written += end - pos
+                    pos += len(run)
+                    if pos >= next_report:
+                        report(progress, PHASE_PATCH, min(pos, output_size), output_size)
+                        next_report = pos + PROGRESS_STEP
+                if zlib.crc32(target) != output_crc:
+                    raise PatchError("Patched ROM checksum mismatch, output is invalid.")
+    report(progress, PHASE_PATCH, output_size, output_size)
+    return written
+
+
+PATCHERS = {
+    "ips": apply_ips,
+    "bps": apply_bps,
+    "ups": apply_ups,
+}
+
+IN_PLACE_PATCHERS = {
+    "ips": apply_ips_in_place,
+    "bps": apply_bps_in_place,
+    "ups": apply_ups_in_place,
+}
@@ -2,9 +2,10 @@ import customtkinter
 from customtkinter import CTkImage
 from pathlib import Path
 from PIL import Image
-from concurrent.futures import ThreadPoolExecutor
 
-from fetch import download_image_from_server
+from art_scheduler import PRIORITY_VISIBLE
+from install_queue import CANCELLED, DONE, DOWNLOADING, FAILED, PATCHING, QUEUED
+from progress import PHASE_VERIFY
 
 # --- Color Constants ---
 EMERALD_GREEN = "#2E8B57"
@@ -15,6 +16,41 @@ HYPERLINK_BLUE = "#00529B"
 BODY_TEXT_COLOR = "#555555"
 BORDER_PURPLE = "#55526f" 
 
+# Rows have a fixed height so the list can work out what's visible without measuring.
+ROW_HEIGHT = 230
+DESCRIPTION_MAX_CHARS = 180
+
+# What a row says while its install is in the queue, or after it went wrong
+INSTALL_STATE_TEXT = {
+    QUEUED: "Queued for install",
+    DOWNLOADING: "Downloading patch...",
+    PATCHING: "Patching...",
+    FAILED: "Install failed",
+}
+
+def describe_install(job):
+    # The status line for a row with an install in the queue, with progress if we have it.
+    text = INSTALL_STATE_TEXT.get(job.state, job.state.title())
+    if job.state not in (DOWNLOADING, PATCHING) or job.phase is None:
+        return text
+    if job.phase == PHASE_VERIFY:
+        text = "Verifying..."
+    fraction = job.fraction
+    if fraction is None:
+        return f"{text} {job.done / (1024 * 1024):.1f} MB"
+    text = f"{text} {fraction:.0%}"
+    eta = job.eta
+    if eta is not None and fraction < 1:
+        text += f", {eta:.0f}s left"
+    return text
+
+def truncate_description(text):
+    # Keeps descriptions to a few lines so they fit in a fixed-height row.
+    text = text or ""
+    if len(text) <= DESCRIPTION_MAX_CHARS:
+        return text
+    return text[:DESCRIPTION_MAX_CHARS].rsplit(" ", 1)[0] + "..."
+
 def load_button_images(image_names, scale_factor, assets_path):
     # A helper function to load and cache our button images.
     image_cache = {}
@@ -34,62 +70,139 @@ def load_button_images(image_names, scale_factor, assets_path):
     return image_cache
 
 class RomListItemController:
-    # This class manages the widgets and state for a single ROM hack in the list.
-    # We create one for each hack and then reuse it, showing or hiding as needed.
+    # This class manages the widgets for one row of the ROM list.
+    # Rows are pooled: the list only keeps enough of them to fill the viewport,
+    # and each one is rebound to whichever ROM scrolls into its slot.
 
-    def __init__(self, parent, rom, callbacks, fonts):
+    def __init__(self, parent, callbacks, fonts, thumbnails, art_scheduler):
         self.parent = parent
-        self.rom = rom
+        self.thumbnails = thumbnails
+        self.art_scheduler = art_scheduler
+        self.rom = None
+        self.stale = False
+        self.art_pending = False # Waiting on the scheduler for this ROM's art
+        self.art_priority = PRIORITY_VISIBLE
         self.callbacks = callbacks
         self.fonts = fonts
         self.widget = None
         self.button_frame = None
         self.last_view = None
-        
-        # Grabs the box art in the background so first load isn't really slow.
-        if self.rom.box_art_url:
-            ThreadPoolExecutor(max_workers=1).submit(
-                download_image_from_server, self.rom.box_art_url, self.rom.config
-            )
+        self.install_status = None
 
         self._create_base_widgets()
 
     def _create_base_widgets(self):
-        # Creates the static parts of the item: frame, art, and text.
-        self.widget = customtkinter.CTkFrame(self.parent, corner_radius=5, border_width=5, border_color=BORDER_PURPLE)
+        # Creates the row's widgets once, their contents are filled in by bind().
+        self.widget = customtkinter.CTkFrame(self.parent, height=ROW_HEIGHT - 10, corner_radius=5, border_width=5, border_color=BORDER_PURPLE)
         self.widget.grid_columnconfigure(1, weight=1)
+        self.widget.grid_propagate(False) # Keep the fixed row height whatever the contents
 
-        try:
-            box_art_dir = Path(self.rom.config.get_setting("box_art_dir"))
-            image_path = box_art_dir / Path(self.rom.box_art_url).name
-            if not image_path.is_file(): raise FileNotFoundError("Box art not on disk yet")
-            box_art_image = CTkImage(Image.open(image_path), size=(160, 160))
-            img_label = customtkinter.CTkLabel(self.widget, image=box_art_image, text="")
-        except Exception as e:
-            print(f"Could not load box art for {self.rom.name}: {e}")
-            img_label = customtkinter.CTkLabel(self.widget, text="No Art", width=160, height=160, fg_color="#E0E0E0", font=self.fonts["body"])
-
-        img_label.grid(row=0, column=0, rowspan=4, padx=10, pady=10, sticky="n")
+        # Two labels for the art, so switching between art and no art never needs image=None.
+        self.art_label = customtkinter.CTkLabel(self.widget, text="")
+        self.art_label.grid(row=0, column=0, rowspan=4, padx=10, pady=10, sticky="n")
+        self.no_art_label = customtkinter.CTkLabel(self.widget, text="No Art", width=160, height=160, fg_color="#E0E0E0", font=self.fonts["body"])
+        self.no_art_label.grid(row=0, column=0, rowspan=4, padx=10, pady=10, sticky="n")
 
         text_button_frame = customtkinter.CTkFrame(self.widget, fg_color="transparent")
         text_button_frame.grid(row=0, column=1, rowspan=4, sticky="nsew", padx=(0, 10), pady=10)
 
-        customtkinter.CTkLabel(text_button_frame, text=self.rom.name, font=self.fonts["title"], anchor="w").pack(fill="x")
-        customtkinter.CTkLabel(text_button_frame, text=self.rom.description, font=self.fonts["body"], text_color=BODY_TEXT_COLOR, wraplength=600, justify="left", anchor="w").pack(fill="x", pady=(0, 8))
+        self.name_label = customtkinter.CTkLabel(text_button_frame, text="", font=self.fonts["title"], anchor="w")
+        self.name_label.pack(fill="x")
+        self.description_label = customtkinter.CTkLabel(text_button_frame, text="", font=self.fonts["body"], text_color=BODY_TEXT_COLOR, wraplength=600, justify="left", anchor="w")
+        self.description_label.pack(fill="x", pady=(0, 8))
         
         info_frame = customtkinter.CTkFrame(text_button_frame, fg_color="transparent")
         info_frame.pack(fill="x", pady=(0, 10))
 
         customtkinter.CTkLabel(info_frame, text="Base:", font=self.fonts["bold_body"]).pack(side="left")
-        base_color = FIRE_RED if self.rom.base_rom_id == "firered" else EMERALD_GREEN if self.rom.base_rom_id == "emerald" else SOUL_SILVER
-        customtkinter.CTkLabel(info_frame, text=self.rom.base_rom_id.title(), text_color=base_color, font=self.fonts["body"]).pack(side="left", padx=(4,0))
+        self.base_label = customtkinter.CTkLabel(info_frame, text="", font=self.fonts["body"])
+        self.base_label.pack(side="left", padx=(4,0))
 
         customtkinter.CTkLabel(info_frame, text="Author:", font=self.fonts["bold_body"]).pack(side="left", padx=(20, 0))
-        customtkinter.CTkLabel(info_frame, text=self.rom.author, font=self.fonts["body"]).pack(side="left", padx=(4,0))
+        self.author_label = customtkinter.CTkLabel(info_frame, text="", font=self.fonts["body"])
+        self.author_label.pack(side="left", padx=(4,0))
 
         self.button_frame = customtkinter.CTkFrame(text_button_frame, fg_color="transparent")
         self.button_frame.pack(fill="x", side="bottom")
 
+        # Shown in place of (or, after a failure, above) the buttons while an install is queued.
+        self.install_status_frame = customtkinter.CTkFrame(text_button_frame, fg_color="transparent")
+        self.install_status_label = customtkinter.CTkLabel(self.install_status_frame, text="", font=self.fonts["bold_body"], text_color=BORDER_PURPLE)
+        self.install_status_label.pack(side="left")
+        self.cancel_install_button = customtkinter.CTkButton(self.install_status_frame, text="Cancel", width=80, command=lambda: self.callbacks["cancel_install"](self.rom.id))
+
+    def bind(self, rom, view_type, image_cache, art_priority=PRIORITY_VISIBLE, install_job=None):
+        # Points this row at a ROM. Only does any work if it's a different ROM to last
+        # time, or the ROM's catalog entry changed since. A row still waiting on its
+        # art asks again, so art that scrolled into view jumps the queue.
+        self.art_priority = art_priority
+        if rom is not self.rom or self.stale:
+            self.rom = rom
+            self.stale = False
+            self._fill_in_rom()
+        elif self.art_pending:
+            self._request_box_art()
+        self.update_view(view_type, image_cache)
+        self._show_install_state(install_job if view_type == "available" else None)
+
+    def _fill_in_rom(self):
+        rom = self.rom
+        self.name_label.configure(text=rom.name or "")
+        self.description_label.configure(text=truncate_description(rom.description))
+        base_color = FIRE_RED if rom.base_rom_id == "firered" else EMERALD_GREEN if rom.base_rom_id == "emerald" else SOUL_SILVER
+        self.base_label.configure(text=(rom.base_rom_id or "").title(), text_color=base_color)
+        self.author_label.configure(text=rom.author or "")
+        self._load_box_art()
+
+    def _load_box_art(self):
+        # Shows the box art from the thumbnail cache if we can. If we don't have the
+        # art at all the placeholder goes up and the scheduler fetches it.
+        self.art_pending = False
+        try:
+            if not self.rom.box_art_url:
+                raise FileNotFoundError("ROM has no box art")
+            box_art_dir = Path(self.rom.config.get_setting("box_art_dir"))
+            image_path = box_art_dir / Path(self.rom.box_art_url).name
+            scale = customtkinter.ScalingTracker.get_widget_scaling(self.widget)
+            thumbnail = self.thumbnails.get(image_path, scale, generate_missing=image_path.is_file())
+            if thumbnail is None:
+                if not image_path.is_file():
+                    self._show_no_art()
+                    self.art_pending = True
+                    self._request_box_art()
+                    return
+                # Thumbnail is being made in the background, use the full image this once.
+                thumbnail = Image.open(image_path)
+            self._show_art(thumbnail)
+        except Exception as e:
+            print(f"Could not load box art for {self.rom.name}: {e}")
+            self._show_no_art()
+
+    def _request_box_art(self):
+        rom = self.rom
+        scale = customtkinter.ScalingTracker.get_widget_scaling(self.widget)
+
+        def on_downloaded(image_path):
+            # The row may have been recycled for another ROM while we waited.
+            if self.rom is not rom or not self.art_pending:
+                return
+            self.art_pending = False
+            if image_path is None:
+                return
+            thumbnail = self.thumbnails.get(image_path, scale, generate_missing=False)
+            self._show_art(thumbnail if thumbnail is not None else Image.open(image_path))
+
+        self.art_scheduler.request(rom, scale, self.art_priority, on_downloaded)
+
+    def _show_art(self, image):
+        self.art_label.configure(image=CTkImage(image, size=(160, 160)))
+        self.no_art_label.grid_remove()
+        self.art_label.grid()
+
+    def _show_no_art(self):
+        self.art_label.grid_remove()
+        self.no_art_label.grid()
+
     def update_view(self, view_type, image_cache):
         # Sets up the item's buttons for the current view ('installed' or 'available').
         if self.last_view == view_type:
@@ -105,6 +218,32 @@ class RomListItemController:
         
         self.last_view = view_type
         
+    def _show_install_state(self, job):
+        # Swaps the buttons for the install's progress while it's queued or running.
+        # A finished install only matters while the hack is installed, which shows the
+        # installed view instead, so a done job left over from before a delete is ignored.
+        state = job.state if job and job.state not in (CANCELLED, DONE) else None
+        text = describe_install(job) if state else None
+        if (state, text) == self.install_status:
+            return
+        previous_state = self.install_status[0] if self.install_status else None
+        self.install_status = (state, text)
+        if state == previous_state and text:
+            # Only the progress moved on, the layout stays as it is.
+            self.install_status_label.configure(text=text)
+            return
+
+        self.button_frame.pack_forget()
+        self.install_status_frame.pack_forget()
+        self.cancel_install_button.pack_forget()
+        if state is None or state == FAILED:
+            self.button_frame.pack(fill="x", side="bottom")
+        else:
+            self.cancel_install_button.pack(side="left", padx=(10, 0))
+        if state is not None:
+            self.install_status_label.configure(text=text)
+            self.install_status_frame.pack(fill="x", side="bottom")
+
     def _create_installed_buttons(self, image_cache):
         # Makes the Play and Delete buttons.
         if image_cache:
@@ -131,12 +270,18 @@ class RomListItemController:
         else: # Fallback to a text button.
             customtkinter.CTkButton(self.button_frame, text="Install", command=lambda: self.callbacks["install"](self.rom.id, self.rom.name)).pack(side="left")
 
-    def show(self):
-        # Make the item's main frame visible.
+    def place_at(self, y):
+        # Positions the row inside the list viewport, y is relative to the viewport top.
         if self.widget:
-            self.widget.pack(pady=5, padx=5, fill="x")
+            self.widget.place(relx=0.5, y=y + 5, anchor="n", relwidth=0.98)
 
     def hide(self):
         # Hides the item's main frame without actually destroying it.
         if self.widget:
-            self.widget.pack_forget()
\ No newline at end of file
+            self.widget.place_forget()
+
+    def destroy(self):
+        # Gets rid of the widgets for good.
+        if self.widget:
+            self.widget.destroy()
+            self.widget = None
\ No newline at end of file
@@ -0,0 +1,59 @@
+import threading
+import time
+
+# Progress reporting for installs. Anything long running takes an optional
+# progress(phase, done, total) callback, where done and total are bytes for that
+# phase and total is None if it isn't known.
+
+PHASE_DOWNLOAD = "download"
+PHASE_PATCH = "patch"
+PHASE_VERIFY = "verify"
+
+# Reports closer together than this are dropped, apart from the first and last of a phase
+MIN_REPORT_INTERVAL = 0.1
+
+
+def report(progress, phase, done, total=None):
+    # Calls progress if there is one, so callers don't each need the None check.
+    if progress is not None:
+        progress(phase, done, total)
+
+
+class ThrottledProgress:
+    # Wraps a progress callback so it's called at most every min_interval seconds,
+    # however often it's reported to. Safe to share between threads, as segmented
+    # downloads do.
+
+    def __init__(self, callback, min_interval=MIN_REPORT_INTERVAL):
+        self.callback = callback
+        self.min_interval = min_interval
+        self._lock = threading.Lock()
+        self._phase = None
+        self._last_time = 0.0
+
+    def __call__(self, phase, done, total=None):
+        now = time.monotonic()
+        with self._lock:
+            finished = total is not None and done >= total
+            if phase == self._phase and not finished and now - self._last_time < self.min_interval:
+                return
+            self._phase = phase
+            self._last_time = now
+        self.callback(phase, done, total)
+
+
+class ByteCounter:
+    # Adds up bytes reported from several threads into one progress total.
+
+    def __init__(self, progress, phase, total=None, start=0):
+        self.progress = progress
+        self.phase = phase
+        self.total = total
+        self.done = start
+        self._lock = threading.Lock()
+
+    def add(self, count):
+        with self._lock:
+            self.done += count
+            done = self.done
+        report(self.progress, self.phase, done, self.total)
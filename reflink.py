@@ -0,0 +1,64 @@
+import os
+import shutil
+import sys
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+# Copies a base ROM as cheaply as the filesystem allows, so a patch can then be
+# applied to the copy in place. On btrfs and XFS the copy is a reflink that
+# shares every block with the base ROM until it's written to, so an install
+# only takes up as much space as the patch changes.
+
+FICLONE = 0x40049409 # _IOW(0x94, 9, int) from linux/fs.h
+COPY_CHUNK_SIZE = 1024 * 1024
+
+CLONE_REFLINK = "reflink"
+CLONE_COPY_RANGE = "copy_file_range"
+CLONE_COPY = "copy"
+
+
+def _copy_range(src, dst, size):
+    # In-kernel copy, which some filesystems (NFS, CIFS) also do server side.
+    copied = 0
+    while copied < size:
+        count = os.copy_file_range(src.fileno(), dst.fileno(), size - copied)
+        if count == 0:
+            break
+        copied += count
+    return copied == size
+
+
+def clone_file(source, destination):
+    # Copies source to destination, trying a reflink, then copy_file_range, then a
+    # plain copy. Returns which one was used.
+    with open(source, "rb") as src, open(destination, "wb") as dst:
+        if fcntl and sys.platform.startswith("linux"):
+            try:
+                fcntl.ioctl(dst.fileno(), FICLONE, src.fileno())
+                return CLONE_REFLINK
+            except OSError:
+                # Not supported here, or the files are on different filesystems.
+                pass
+        if hasattr(os, "copy_file_range"):
+            try:
+                if _copy_range(src, dst, os.fstat(src.fileno()).st_size):
+                    return CLONE_COPY_RANGE
+            except OSError:
+                pass
+            src.seek(0)
+            dst.seek(0)
+            dst.truncate()
+        shutil.copyfileobj(src, dst, COPY_CHUNK_SIZE)
+    return CLONE_COPY
+
+
+def describe_savings(method, size, written):
+    # A line for the log saying how much of an in-place install was actually written.
+    size_mb = size / (1024 * 1024)
+    written_mb = min(written, size) / (1024 * 1024)
+    if method == CLONE_REFLINK:
+        return f"Reflinked the base ROM: wrote {written_mb:.2f} MB of {size_mb:.2f} MB, {size_mb - written_mb:.2f} MB shared with the base ROM."
+    return f"Reflinks aren't supported here, copied the base ROM ({method}) and patched {written_mb:.2f} MB of {size_mb:.2f} MB in place."
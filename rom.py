@@ -1,25 +1,78 @@
 import abc
 from pathlib import Path
 import os
+import shutil
+import tracing
 from patch import apply_patch
 from launch import launch_mgba_with_rom
 from fetch import download_patch_from_server
+from patch_cache import PatchCache
+from patch_engine import PatchError, read_source_requirements
+from base_roms import BaseRomFingerprints, check_fingerprint
+from catalog import CatalogEntry
+from library import STORAGE_COMPRESSED, STORAGE_PATCH, STORAGE_ROM, hash_file
+from materialized import MaterializedCache
+from storage import FORMAT_ZIP, archive_format, archive_name, compress_rom, decompress_rom, resolve_format
+
+# Config values for storage_mode: keep whole patched ROMs, just their patches, or
+# the ROMs compressed
+STORAGE_MODE_FULL = "full"
+STORAGE_MODE_PATCH = "patch"
+STORAGE_MODE_COMPRESSED = "compressed"
+# Save files are kept next to the stored patch, not in the materialized ROM cache
+SAVE_EXTENSIONS = (".sav",)
+
+def _entry_field(field):
+    # A read-only attribute that comes straight from the ROM's catalog entry.
+    return property(lambda rom: getattr(rom.entry, field))
+
 
 class ROM(abc.ABC):
-    def __init__(self, hack_info, config):
-        # Store the raw data from hacks.json and the config object
-        self.raw_data = hack_info
+    # Archive formats the emulator can open itself, so compressed ROMs in these
+    # formats are launched without being extracted first
+    NATIVE_ARCHIVE_FORMATS = ()
+    # There can be one of these per catalog entry, so they're kept small
+    __slots__ = ("config", "library", "patch_cache", "fingerprints", "materialized", "entry")
+
+    # Core attributes from the hack's catalog entry
+    id = _entry_field("id")
+    name = _entry_field("name")
+    description = _entry_field("description")
+    base_rom_id = _entry_field("base_rom_id")
+    box_art_url = _entry_field("box_art_url")
+    patch_file_url = _entry_field("patch_file")
+    patch_sha256 = _entry_field("patch_sha256")
+    # Optional, which base ROM dump the patch was made for
+    base_rom_crc32 = _entry_field("base_rom_crc32")
+    base_rom_sha1 = _entry_field("base_rom_sha1")
+    author = _entry_field("author")
+    system = _entry_field("system")
+
+    def __init__(self, hack_info, config, library=None, patch_cache=None, fingerprints=None, materialized=None):
         self.config = config
+        # The installed-library manifest, downloaded patch cache, base ROM
+        # fingerprints and materialized ROM cache, shared by every ROM the service creates
+        self.library = library
+        self.patch_cache = patch_cache or PatchCache(config)
+        self.fingerprints = fingerprints or BaseRomFingerprints(config)
+        self.materialized = materialized or MaterializedCache(config)
+        self.update_info(hack_info)
+
+    def update_info(self, hack_info):
+        # Takes a CatalogEntry, or an entry from hacks.json as a dict
+        if not isinstance(hack_info, CatalogEntry):
+            hack_info = CatalogEntry.from_info(hack_info)
+        self.entry = hack_info
+
+    @property
+    def raw_data(self):
+        return self.entry.as_dict()
 
-        # Core attributes from the hack's data
-        self.id = hack_info.get("id")
-        self.name = hack_info.get("name")
-        self.description = hack_info.get("description")
-        self.base_rom_id = hack_info.get("base_rom_id")
-        self.box_art_url = hack_info.get("box_art_url")
-        self.patch_file_url = hack_info.get("patch_file")
-        self.author = hack_info.get("author")
-        self.system = hack_info.get("system")
+    def is_outdated(self, hack_info):
+        # Checks a newer catalog entry against ours, using its revision if it has one.
+        if not isinstance(hack_info, CatalogEntry):
+            hack_info = CatalogEntry.from_info(hack_info)
+        return self.entry.is_outdated(hack_info)
         
 
     @property
@@ -28,23 +81,338 @@ class ROM(abc.ABC):
         patched_dir = Path(self.config.get_setting("patched_roms_dir"))
         return patched_dir / f"{self.id}.{self.system}" 
 
+    @property
+    def rom_filename(self):
+        return f"{self.id}.{self.system}"
+
+    @property
+    def is_installed(self):
+        # Answered from the library manifest when we have one, rather than hitting the disk.
+        if self.library:
+            return self.library.is_installed(self.id)
+        return self.patched_rom_path.exists()
+
+    def _library_entry(self):
+        return self.library.get(self.id) if self.library else None
+
+    @property
+    def storage(self):
+        # How the install is stored, STORAGE_ROM if it isn't in the manifest.
+        entry = self._library_entry()
+        return entry.get("storage", STORAGE_ROM) if entry else STORAGE_ROM
+
+    @property
+    def is_patch_only(self):
+        # Whether this hack was installed as just its patch, in patch storage mode.
+        return self.storage == STORAGE_PATCH
+
+    @property
+    def installed_path(self):
+        # Whatever is stored for the install: the patched ROM, its patch or its archive.
+        entry = self._library_entry()
+        if entry:
+            return Path(self.config.get_setting("patched_roms_dir")) / entry["file"]
+        return self.patched_rom_path
+
+    def _record_install(self, progress=None, path=None, storage=STORAGE_ROM):
+        # Adds the freshly installed ROM (or stored patch) to the library manifest.
+        if not self.library:
+            return
+        try:
+            self.library.record_install(self.id, path or self.patched_rom_path, self.patch_file_url, progress, storage)
+        except OSError as e:
+            print(f"Warning: Could not add {self.name} to the library manifest: {e}")
+
+    def _base_rom_path(self):
+        # The configured base ROM for this hack, or None if it isn't set up.
+        base_roms = self.config.get_setting("base_roms", {})
+        base_rom_path_str = base_roms.get(self.base_rom_id)
+        if not base_rom_path_str or not Path(base_rom_path_str).exists():
+            print(f"Base ROM '{self.base_rom_id}' not found or configured.")
+            return None
+        return base_rom_path_str
+
+    @tracing.traced("rom.check_base_rom", "install")
+    def _check_base_rom(self, base_rom_path_str, patch_path=None, progress=None):
+        # Makes sure the base ROM is the dump this hack was made for, going by the
+        # catalog and, for BPS and UPS, the patch header. The base ROM is only
+        # hashed the first time it's seen, so this is quick.
+        expected = []
+        if self.base_rom_crc32 or self.base_rom_sha1:
+            expected.append(("the catalog", {"crc32": self.base_rom_crc32, "sha1": self.base_rom_sha1}))
+        if patch_path:
+            try:
+                requirements = read_source_requirements(patch_path)
+            except (OSError, PatchError) as e:
+                print(f"Could not read patch header for '{self.name}': {e}")
+                return False
+            if requirements:
+                expected.append(("the patch", requirements))
+        if not expected:
+            return True
+
+        try:
+            fingerprint = self.fingerprints.fingerprint(base_rom_path_str, progress)
+        except OSError as e:
+            print(f"Could not read base ROM {base_rom_path_str}: {e}")
+            return False
+        for source, requirements in expected:
+            mismatch = check_fingerprint(fingerprint, **requirements)
+            if mismatch:
+                print(f"Base ROM '{self.base_rom_id}' at {base_rom_path_str} isn't the one {source} expects for '{self.name}': {mismatch}. "
+                      "Check it's the right region and revision, and hasn't already been patched.")
+                return False
+        return True
+
     @abc.abstractmethod
-    def patch(self):
-        # Abstract method for patching. Subclasses must implement this.
+    def _patcher_options(self):
+        # Returns (patcher_path, extra apply_patch arguments) for this system.
         raise NotImplementedError
 
+    def patch(self, cancel_event=None, progress=None):
+        # Downloads the patch and applies it. Installs that go through the install
+        # queue run these two steps separately, so downloads overlap with patching.
+        # progress(phase, done, total) is called through the download, patch and
+        # verify phases, as often as they make progress, so wrap it in a
+        # ThrottledProgress if it's going anywhere expensive.
+        patch_path = self.download_patch(cancel_event, progress)
+        if not patch_path:
+            return False
+        return self.apply_downloaded_patch(patch_path, cancel_event, progress)
+
+    @tracing.traced("rom.download_patch", "install")
+    def download_patch(self, cancel_event=None, progress=None):
+        # Downloads the patch file from the server, returning its path or None.
+        # A base ROM the catalog says is wrong fails here, before any download.
+        base_rom_path_str = self._base_rom_path()
+        if not base_rom_path_str or not self._check_base_rom(base_rom_path_str, progress=progress):
+            return None
+        patch_path_str = download_patch_from_server(self.patch_file_url, self.config, self.patch_sha256, cancel_event, progress, self.patch_cache)
+        if not patch_path_str:
+            if not (cancel_event and cancel_event.is_set()):
+                print("Failed to download patch file.")
+            return None
+        return patch_path_str
+
+    def patch_arguments(self, patch_path, base_rom_path_str, output_path):
+        # The apply_patch arguments for this hack as (args, kwargs), without a progress
+        # callback, so they can be sent to another process.
+        # Determine patch type from the file extension.
+        patch_type = patch_path.suffix[1:].lower()
+        patcher_path, options = self._patcher_options()
+        args = (patch_type, patcher_path, str(patch_path), base_rom_path_str, str(output_path))
+        return args, dict(options, in_place=self.config.get_setting("reflink_installs", True))
+
+    def _apply(self, patch_path, base_rom_path_str, output_path, progress=None):
+        args, kwargs = self.patch_arguments(patch_path, base_rom_path_str, output_path)
+        return apply_patch(*args, progress=progress, **kwargs)
+
+    @tracing.traced("rom.apply_patch", "install")
+    def apply_downloaded_patch(self, patch_path_str, cancel_event=None, progress=None):
+        # Applies a downloaded patch to the base ROM. The output is written next to
+        # its final name and only renamed into place once it's complete, so a failed
+        # or cancelled install never leaves a broken ROM behind.
+        # In patch storage mode the ROM goes to the materialized cache instead, ready
+        # for the first launch, and only the patch is kept. In compressed storage mode
+        # the finished ROM is compressed and only the archive is kept.
+        patch_path = Path(patch_path_str)
+        prepared = self.prepare_apply(patch_path, progress)
+        if not prepared:
+            return False
+        base_rom_path_str, part_path = prepared
+
+        success = False
+        if not (cancel_event and cancel_event.is_set()):
+            success = self._apply(patch_path, base_rom_path_str, part_path, progress)
+        return self.finish_apply(patch_path, part_path, success, cancel_event, progress)
+
+    def prepare_apply(self, patch_path, progress=None):
+        # The first step of apply_downloaded_patch, split out so the patching itself can
+        # happen elsewhere. The patch header is checked against the base ROM before
+        # anything is written. Returns (base ROM path, where to write the patched ROM),
+        # or None, releasing the patch, if it can't be applied.
+        base_rom_path_str = self._base_rom_path()
+        if not base_rom_path_str or not self._check_base_rom(base_rom_path_str, patch_path, progress):
+            self.patch_cache.release(patch_path)
+            return None
+
+        if self.config.get_setting("storage_mode", STORAGE_MODE_FULL) == STORAGE_MODE_PATCH:
+            return base_rom_path_str, self.materialized.temp_path(self.rom_filename)
+        output_path = self.patched_rom_path
+        output_path.parent.mkdir(parents=True, exist_ok=True)
+        return base_rom_path_str, output_path.with_name(output_path.name + ".part")
+
+    def finish_apply(self, patch_path, part_path, success, cancel_event=None, progress=None):
+        # The last step of apply_downloaded_patch, storing the patched ROM written to
+        # part_path and recording the install, or cleaning up if patching failed or
+        # was cancelled. Returns whether the hack is now installed.
+        storage_mode = self.config.get_setting("storage_mode", STORAGE_MODE_FULL)
+        patch_only = storage_mode == STORAGE_MODE_PATCH
+        output_path = self.patched_rom_path
+        try:
+            if success and not (cancel_event and cancel_event.is_set()):
+                previous_path = self.installed_path if self.is_installed else None
+                # Drop any copy left from a previous install, it's out of date now.
+                self.materialized.remove(self.rom_filename)
+                if patch_only:
+                    stored_path = self._store_patch(patch_path)
+                    self.materialized.commit(part_path, self.rom_filename)
+                    self._record_install(progress, stored_path, STORAGE_PATCH)
+                elif storage_mode == STORAGE_MODE_COMPRESSED:
+                    stored_path = self._store_compressed(part_path)
+                    self._record_install(progress, stored_path, STORAGE_COMPRESSED)
+                else:
+                    stored_path = output_path
+                    os.replace(part_path, output_path)
+                    self._record_install(progress)
+                # Reinstalling in a different storage mode leaves the old file behind.
+                if previous_path and previous_path != stored_path:
+                    previous_path.unlink(missing_ok=True)
+                print(f"'{self.name}' installed successfully!")
+                return True
+        except OSError as e:
+            print(f"Error storing '{self.name}': {e}")
+            success = False
+        finally:
+            # The patch stays in the cache for reinstalls, it's just no longer in use.
+            self.patch_cache.release(patch_path)
+
+        # If patching failed or was cancelled, clean up the output that may have been created.
+        part_path.unlink(missing_ok=True)
+        if success:
+            print(f"Install of '{self.name}' cancelled.")
+        else:
+            print(f"Patching for '{self.name}' failed.")
+        return False
+
+    def _store_patch(self, patch_path):
+        # Keeps a patch-only install's patch next to the installed ROMs, out of reach of
+        # the patch cache's eviction. Hard linked to the cached copy where possible.
+        patched_dir = Path(self.config.get_setting("patched_roms_dir"))
+        patched_dir.mkdir(parents=True, exist_ok=True)
+        stored_path = patched_dir / f"{self.rom_filename}{patch_path.suffix.lower()}"
+        temp_path = stored_path.with_name(stored_path.name + ".part")
+        temp_path.unlink(missing_ok=True)
+        try:
+            os.link(patch_path, temp_path)
+        except OSError:
+            shutil.copyfile(patch_path, temp_path)
+        os.replace(temp_path, stored_path)
+        return stored_path
+
+    def _store_compressed(self, rom_path):
+        # Compresses a freshly patched ROM into patched_roms_dir and deletes the ROM.
+        fmt = resolve_format(self.config.get_setting("compression_format", FORMAT_ZIP))
+        patched_dir = Path(self.config.get_setting("patched_roms_dir"))
+        archive_path = compress_rom(rom_path, patched_dir / archive_name(self.rom_filename, fmt), fmt, self.rom_filename)
+        rom_path.unlink()
+        return archive_path
+
+    @tracing.traced("rom.materialize", "launch")
+    def materialize(self, progress=None):
+        # Rebuilds a patch-only install's ROM in the materialized cache, or extracts a
+        # compressed one, unless it's still there from last time. Returns the ROM's
+        # path, or None.
+        cached_path = self.materialized.lookup(self.rom_filename)
+        if cached_path:
+            tracing.count("materialized.hit")
+            return cached_path
+        tracing.count("materialized.miss")
+        if self.storage == STORAGE_COMPRESSED:
+            return self._extract()
+
+        entry = self._library_entry()
+        stored_path = self.installed_path
+        try:
+            if entry.get("sha256") and hash_file(stored_path) != entry["sha256"]:
+                print(f"The stored patch for '{self.name}' is corrupt, please reinstall it.")
+                return None
+        except OSError as e:
+            print(f"Could not read the stored patch for '{self.name}': {e}")
+            return None
+
+        base_rom_path_str = self._base_rom_path()
+        if not base_rom_path_str or not self._check_base_rom(base_rom_path_str, stored_path, progress):
+            return None
+        print(f"Materializing {self.name}...")
+        part_path = self.materialized.temp_path(self.rom_filename)
+        if not self._apply(stored_path, base_rom_path_str, part_path, progress):
+            part_path.unlink(missing_ok=True)
+            return None
+        return self.materialized.commit(part_path, self.rom_filename)
+
+    def _extract(self):
+        # Extracts a compressed install's ROM into the materialized cache.
+        entry = self._library_entry()
+        archive_path = self.installed_path
+        try:
+            if entry.get("sha256") and hash_file(archive_path) != entry["sha256"]:
+                print(f"The compressed ROM for '{self.name}' is corrupt, please reinstall it.")
+                return None
+            print(f"Extracting {self.name}...")
+            part_path = self.materialized.temp_path(self.rom_filename)
+            try:
+                decompress_rom(archive_path, part_path)
+            except Exception:
+                part_path.unlink(missing_ok=True)
+                raise
+        except Exception as e:
+            print(f"Could not extract '{self.name}': {e}")
+            return None
+        return self.materialized.commit(part_path, self.rom_filename)
+
+    def _link_save_files(self, rom_path):
+        # Emulators write saves next to the ROM, which for a materialized ROM would be
+        # lost with it, so point them back at the patched ROMs directory instead.
+        patched_dir = Path(self.config.get_setting("patched_roms_dir"))
+        for extension in SAVE_EXTENSIONS:
+            save_link = rom_path.with_suffix(extension)
+            save_target = (patched_dir / f"{self.id}{extension}").resolve()
+            try:
+                if save_link.is_symlink() and Path(os.readlink(save_link)) == save_target:
+                    continue
+                save_link.unlink(missing_ok=True)
+                os.symlink(save_target, save_link)
+            except OSError as e:
+                print(f"Warning: Saves for {self.name} will not outlast the materialized ROM cache: {e}")
+
+    def launch_path(self):
+        # The ROM to hand to the emulator, materializing it first for patch-only installs
+        # and compressed ones in a format the emulator can't open itself.
+        storage = self.storage
+        if storage == STORAGE_ROM:
+            return self.patched_rom_path if self.patched_rom_path.exists() else None
+        if storage == STORAGE_COMPRESSED and archive_format(self.installed_path) in self.NATIVE_ARCHIVE_FORMATS:
+            return self.installed_path if self.installed_path.exists() else None
+        rom_path = self.materialize()
+        if rom_path:
+            self._link_save_files(rom_path)
+        return rom_path
+
     @abc.abstractmethod
     def launch(self):
         # Abstract method for launching. Subclasses must implement this.
         raise NotImplementedError
 
     def delete(self):
-        # Deletes the patched ROM file. This logic is shared across ROM types.
+        # Deletes the patched ROM file (or stored patch or archive). This logic is shared
+        # across ROM types. Save files are left alone.
         try:
-            if self.patched_rom_path.exists():
-                self.patched_rom_path.unlink()
+            installed_path = self.installed_path
+            if self.storage != STORAGE_ROM:
+                self.materialized.remove(self.rom_filename)
+                for extension in SAVE_EXTENSIONS:
+                    save_link = self.materialized.path_for(self.id + extension)
+                    if save_link.is_symlink():
+                        save_link.unlink()
+            if installed_path.exists():
+                installed_path.unlink()
+                if self.library:
+                    self.library.record_delete(self.id)
                 print(f"Deleted {self.name}.")
                 return True
+            if self.library:
+                self.library.record_delete(self.id)
             print("ROM not found, nothing to delete.")
             return False
         except OSError as e:
@@ -53,51 +421,15 @@ class ROM(abc.ABC):
         
 # TODO I think there is more common logic across system types.
 class GBARom(ROM):
-    def patch(self):
-        # Handles the patching process for a GBA ROM.
-        base_roms = self.config.get_setting("base_roms", {})
-        base_rom_path_str = base_roms.get(self.base_rom_id)
-        if not base_rom_path_str or not Path(base_rom_path_str).exists():
-            print(f"Base ROM '{self.base_rom_id}' not found or configured.")
-            return False
+    __slots__ = ()
 
-        # Download the patch file from the server.
-        patch_path_str = download_patch_from_server(self.patch_file_url, self.config)
-        if not patch_path_str:
-            print("Failed to download patch fie")
-            return False
-        
-        # Determine patch type and required patcher executable from the file extension.
-        patch_path = Path(patch_path_str)
-        patch_type = patch_path.suffix[1:].lower()
-        
-        # Flips handles both .ips and .bps
-        patcher_path = "ups.exe" if patch_type == "ups" else "flips.exe"
-        
-        success = apply_patch(
-            patch_type,
-            patcher_path,
-            str(patch_path),
-            base_rom_path_str,
-            str(self.patched_rom_path)
-        )
-        
-        # Clean up by removing the downloaded patch file after use.
-        try:
-            patch_path.unlink()
-        except OSError as e:
-            print(f"Warning: Could not remove patch file {patch_path}: {e}")
+    # mGBA opens zipped ROMs itself
+    NATIVE_ARCHIVE_FORMATS = (FORMAT_ZIP,)
 
-        if success:
-            print(f"'{self.name}' installed successfully!")
-            return True
-        else:
-            # If patching failed, clean up the invalid output file that may have been created.
-            if self.patched_rom_path.exists():
-                self.patched_rom_path.unlink()
-            print(f"Patching for '{self.name}' failed.")
-            return False
-            
+    def _patcher_options(self):
+        # IPS, BPS and UPS are all handled by the built-in patch engine,
+        # so GBA installs don't need an external patcher.
+        return None, {}
 
     def launch(self):
         # Launches the installed GBA ROM using the configured emulator.
@@ -106,12 +438,13 @@ class GBARom(ROM):
             print("Emulator path not set or invalid")
             return False
         
-        if not self.patched_rom_path.exists():
+        rom_path = self.launch_path()
+        if not rom_path:
             print(f"{self.name} ROM is not installed.")
             return True
 
         try:
-            launch_mgba_with_rom(emulator_path, str(self.patched_rom_path))
+            launch_mgba_with_rom(emulator_path, str(rom_path))
             print(f"Launching {self.name}...")
             return True
         except Exception as e:
@@ -120,49 +453,13 @@ class GBARom(ROM):
         
 
 class NDSRom(ROM):
-    def patch(self):
-        # Handles the patching process for a GBA ROM.
-        base_roms = self.config.get_setting("base_roms", {})
-        base_rom_path_str = base_roms.get(self.base_rom_id)
-        if not base_rom_path_str or not Path(base_rom_path_str).exists():
-            print(f"Base ROM '{self.base_rom_id}' not found or configured.")
-            return False
+    __slots__ = ()
 
-        # Download the patch file from the server.
-        patch_path_str = download_patch_from_server(self.patch_file_url, self.config)
-        if not patch_path_str:
-            print("Failed to download patch file.")
-            return False
-        
-        # Determine patch type and required patcher executable from the file extension.
-        patch_path = Path(patch_path_str)
-        patch_type = patch_path.suffix[1:].lower()
-        
-        patcher_path = "xdelta.exe"
-        
-        success = apply_patch(
-            patch_type,
-            patcher_path,
-            str(patch_path),
-            base_rom_path_str,
-            str(self.patched_rom_path)
-        )
-        
-        # Clean up by removing the downloaded patch file after use.
-        try:
-            patch_path.unlink()
-        except OSError as e:
-            print(f"Warning: Could not remove patch file {patch_path}: {e}")
-
-        if success:
-            print(f"'{self.name}' installed successfully!")
-            return True
-        else:
-            # If patching failed, clean up the invalid output file that may have been created.
-            if self.patched_rom_path.exists():
-                self.patched_rom_path.unlink()
-            print(f"Patching for '{self.name}' failed.")
-            return False
+    def _patcher_options(self):
+        # xdelta patches are decoded by the built-in VCDIFF decoder, the
+        # external tool is only used for features it doesn't support.
+        memory_limit = int(self.config.get_setting("patch_memory_limit_mb", 64)) * 1024 * 1024
+        return "xdelta.exe", {"memory_limit": memory_limit}
 
     def launch(self):
         # Launches the installed GBA ROM using the configured emulator.
@@ -171,12 +468,13 @@ class NDSRom(ROM):
             print("Emulator path is not set or is invalid.")
             return False
         
-        if not self.patched_rom_path.exists():
+        rom_path = self.launch_path()
+        if not rom_path:
             print(f"ROM for {self.name} is not installed.")
             return False
 
         try:
-            launch_mgba_with_rom(emulator_path, str(self.patched_rom_path))
+            launch_mgba_with_rom(emulator_path, str(rom_path))
             print(f"Launching {self.name}...")
             return True
         except Exception as e:
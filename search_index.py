@@ -0,0 +1,225 @@
+import bisect
+import re
+from collections import defaultdict
+
+# In-memory search index over the hack catalog. Searches match whole words,
+# word prefixes (for search-as-you-type) and single-typo misspellings, and are
+# ranked by which field matched. System and base ROM filters are precomputed sets.
+
+TOKEN_PATTERN = re.compile(r"[a-z0-9]+")
+
+# How much a match in each field counts towards a result's rank
+FIELD_WEIGHTS = {"name": 3.0, "author": 2.0, "description": 1.0}
+# Heaviest first, so a word keeps the weight of the best field it turns up in
+FIELDS_BY_WEIGHT = sorted(FIELD_WEIGHTS.items(), key=lambda item: -item[1])
+EXACT_BONUS = 1.0
+PREFIX_FACTOR = 0.6
+TYPO_FACTOR = 0.3
+
+# Words shorter than this only match exactly or by prefix, as a typo in them is too ambiguous
+MIN_TYPO_LENGTH = 4
+QUERY_CACHE_SIZE = 256
+# Up to this many new words are inserted into the vocabulary one by one, more are sorted in together
+INSORT_LIMIT = 64
+
+
+def _text(value):
+    # Catalog values as text. Most are strings, but nothing stops a catalog giving
+    # a list (like several authors) or a number.
+    if value is None or isinstance(value, str):
+        return value or ""
+    if isinstance(value, (list, tuple)):
+        return " ".join(_text(item) for item in value)
+    return str(value)
+
+
+def tokenize(text):
+    text = _text(text)
+    return TOKEN_PATTERN.findall(text.lower()) if text else []
+
+
+def _deletes(token):
+    # Every way of deleting one character, used to find words one edit apart.
+    return {token[:i] + token[i + 1:] for i in range(len(token))}
+
+
+class SearchIndex:
+
+    def __init__(self):
+        self._postings = defaultdict(dict) # token -> {hack_id: weight}
+        self._vocabulary = [] # Sorted tokens, for prefix lookups
+        self._new_tokens = set() # Added since _vocabulary was last sorted
+        self._deletions = None # token with one char deleted -> tokens, built on the first typo lookup
+        self._doc_tokens = {} # hack_id -> tokens, so entries can be removed
+        self._names = {} # hack_id -> lower-cased name, for tie-breaking
+        self._facets = {"system": defaultdict(set), "base_rom": defaultdict(set)}
+        self._doc_facets = {}
+        self._cache = {} # Per-word matches, reused while the user keeps typing
+        self._results = {} # Whole query results
+        self._name_order = None # All ids sorted by name, rebuilt lazily after changes
+
+    def __len__(self):
+        return len(self._doc_tokens)
+
+    def add(self, rom):
+        # Indexes a ROM, replacing whatever was indexed for its id before.
+        hack_id = rom.id
+        self.remove(hack_id)
+        weights = {}
+        for field, weight in FIELDS_BY_WEIGHT:
+            for token in tokenize(getattr(rom, field, None)):
+                weights.setdefault(token, weight)
+
+        postings = self._postings
+        for token, weight in weights.items():
+            if token not in postings:
+                # Sorted in with the rest when next needed, so loading a whole
+                # catalog sorts once rather than inserting every word in order
+                self._new_tokens.add(token)
+                if self._deletions is not None:
+                    for deleted in _deletes(token):
+                        self._deletions[deleted].add(token)
+            postings[token][hack_id] = weight
+
+        self._doc_tokens[hack_id] = list(weights)
+        self._names[rom.id] = _text(rom.name).lower()
+        base_rom = rom.base_rom_id if isinstance(rom.base_rom_id, str) else None
+        facets = {"system": _text(rom.system).lower(), "base_rom": base_rom}
+        for facet, value in facets.items():
+            self._facets[facet][value].add(rom.id)
+        self._doc_facets[rom.id] = facets
+        self._invalidate()
+
+    def remove(self, hack_id):
+        tokens = self._doc_tokens.pop(hack_id, None)
+        if tokens is None:
+            return
+        for token in tokens:
+            postings = self._postings[token]
+            postings.pop(hack_id, None)
+            if not postings:
+                del self._postings[token]
+                index = bisect.bisect_left(self._vocabulary, token)
+                if index < len(self._vocabulary) and self._vocabulary[index] == token:
+                    del self._vocabulary[index]
+                else:
+                    self._new_tokens.remove(token)
+                if self._deletions is not None:
+                    for deleted in _deletes(token):
+                        self._deletions[deleted].discard(token)
+                        if not self._deletions[deleted]:
+                            del self._deletions[deleted]
+        for facet, value in self._doc_facets.pop(hack_id).items():
+            self._facets[facet][value].discard(hack_id)
+        self._names.pop(hack_id, None)
+        self._invalidate()
+
+    def _sorted_vocabulary(self):
+        if len(self._new_tokens) <= INSORT_LIMIT:
+            for token in self._new_tokens:
+                bisect.insort(self._vocabulary, token)
+        else:
+            self._vocabulary.extend(self._new_tokens)
+            self._vocabulary.sort()
+        self._new_tokens = set()
+        return self._vocabulary
+
+    def _deletion_index(self):
+        if self._deletions is None:
+            self._deletions = defaultdict(set)
+            for token in self._postings:
+                for deleted in _deletes(token):
+                    self._deletions[deleted].add(token)
+        return self._deletions
+
+    def _invalidate(self):
+        self._cache.clear()
+        self._results.clear()
+        self._name_order = None
+
+    def _ordered(self, ids):
+        # Sorts ids by name. Big result sets are picked out of the presorted list of
+        # every id, which is much cheaper than sorting them from scratch.
+        if len(ids) * 8 < len(self._names):
+            return sorted(ids, key=self._names.__getitem__)
+        if self._name_order is None:
+            self._name_order = sorted(self._names, key=self._names.__getitem__)
+        return [hack_id for hack_id in self._name_order if hack_id in ids]
+
+    def facet_ids(self, system=None, base_rom=None):
+        # The set of ids matching the filters, or None if there are no filters.
+        result = None
+        if system:
+            result = self._facets["system"].get(system.lower(), set())
+        if base_rom:
+            ids = self._facets["base_rom"].get(base_rom, set())
+            result = ids if result is None else result & ids
+        return result
+
+    def _match_token(self, token):
+        # Scores every entry containing the query word, an exact word, a word
+        # starting with it, or (for longer words) a word one typo away.
+        cached = self._cache.get(token)
+        if cached is not None:
+            return cached
+
+        scores = {}
+
+        def collect(matched_token, factor):
+            for hack_id, weight in self._postings[matched_token].items():
+                score = weight * factor
+                if score > scores.get(hack_id, 0):
+                    scores[hack_id] = score
+
+        vocabulary = self._sorted_vocabulary()
+        start = bisect.bisect_left(vocabulary, token)
+        for i in range(start, len(vocabulary)):
+            candidate = vocabulary[i]
+            if not candidate.startswith(token):
+                break
+            collect(candidate, 1.0 + EXACT_BONUS if candidate == token else PREFIX_FACTOR)
+
+        if len(token) >= MIN_TYPO_LENGTH:
+            # Symmetric delete: words within one insert, delete or substitution share a deletion.
+            deletions = self._deletion_index()
+            typos = set(deletions.get(token, ()))
+            for deleted in _deletes(token):
+                if deleted in self._postings:
+                    typos.add(deleted)
+                typos.update(deletions.get(deleted, ()))
+            for candidate in typos:
+                if candidate in self._postings and not candidate.startswith(token):
+                    collect(candidate, TYPO_FACTOR)
+
+        if len(self._cache) >= QUERY_CACHE_SIZE:
+            self._cache.clear()
+        self._cache[token] = scores
+        return scores
+
+    def search(self, query, system=None, base_rom=None):
+        # Returns matching hack ids, best match first. Every word in the query has to match.
+        tokens = tuple(tokenize(query))
+        key = (tokens, system, base_rom)
+        cached = self._results.get(key)
+        if cached is not None:
+            return list(cached)
+
+        allowed = self.facet_ids(system, base_rom)
+        if not tokens:
+            results = self._ordered(self._names.keys() if allowed is None else allowed)
+        else:
+            # Start from the rarest word so the intersection stays small
+            matches = sorted((self._match_token(token) for token in tokens), key=len)
+            totals = {hack_id: score for hack_id, score in matches[0].items() if allowed is None or hack_id in allowed}
+            for scores in matches[1:]:
+                totals = {hack_id: total + scores[hack_id] for hack_id, total in totals.items() if hack_id in scores}
+                if not totals:
+                    break
+            # Name order first, then a stable sort on score keeps names in order within a rank
+            results = self._ordered(totals)
+            results.sort(key=totals.__getitem__, reverse=True)
+
+        if len(self._results) >= QUERY_CACHE_SIZE:
+            self._results.clear()
+        self._results[key] = results
+        return list(results)
@@ -0,0 +1,211 @@
+import argparse
+import hashlib
+import os
+import shutil
+import tempfile
+import zipfile
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from pathlib import Path
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+from library import ROM_EXTENSIONS, STORAGE_COMPRESSED, STORAGE_PATCH, STORAGE_ROM
+
+# Compressed storage for installed ROMs. GBA images are mostly padding, so they
+# shrink a lot. Archives are zip (which mGBA opens directly) or, if the zstandard
+# package is installed, zstd. Also has the command that converts an existing
+# library between storage modes: python storage.py migrate --to compressed
+
+FORMAT_ZIP = "zip"
+FORMAT_ZSTD = "zstd"
+ARCHIVE_SUFFIXES = {FORMAT_ZIP: ".zip", FORMAT_ZSTD: ".zst"}
+ZIP_LEVEL = 9
+ZSTD_LEVEL = 10
+COPY_CHUNK_SIZE = 1024 * 1024
+
+
+def resolve_format(requested):
+    # The compression format to actually use, falling back to zip without zstandard.
+    if requested == FORMAT_ZSTD and zstandard is None:
+        print("zstandard is not installed, compressing ROMs as zip instead.")
+        return FORMAT_ZIP
+    return requested if requested in ARCHIVE_SUFFIXES else FORMAT_ZIP
+
+
+def archive_format(path):
+    # The format of an archive going by its extension, or None if it isn't one.
+    suffix = Path(path).suffix.lower()
+    for fmt, archive_suffix in ARCHIVE_SUFFIXES.items():
+        if suffix == archive_suffix:
+            return fmt
+    return None
+
+
+def archive_name(rom_filename, fmt):
+    # Zips are named <id>.zip, so an emulator opening them directly names the
+    # save <id>.sav, the same as it would for the raw ROM.
+    if fmt == FORMAT_ZIP:
+        return Path(rom_filename).stem + ".zip"
+    return rom_filename + ARCHIVE_SUFFIXES[fmt]
+
+
+def compress_rom(rom_path, archive_path, fmt, arcname=None):
+    # Writes rom_path into a new archive, replacing archive_path once it's complete.
+    # arcname is the ROM's name inside a zip, if it isn't the file's own name.
+    rom_path, archive_path = Path(rom_path), Path(archive_path)
+    temp_path = archive_path.with_name(archive_path.name + ".part")
+    if fmt == FORMAT_ZIP:
+        with zipfile.ZipFile(temp_path, "w", zipfile.ZIP_DEFLATED, compresslevel=ZIP_LEVEL) as archive:
+            archive.write(rom_path, arcname=arcname or rom_path.name)
+    elif fmt == FORMAT_ZSTD:
+        with open(rom_path, "rb") as source, open(temp_path, "wb") as output:
+            zstandard.ZstdCompressor(level=ZSTD_LEVEL).copy_stream(source, output, size=os.path.getsize(rom_path))
+    else:
+        raise ValueError(f"Unknown compression format '{fmt}'")
+    os.replace(temp_path, archive_path)
+    return archive_path
+
+
+def _zip_member(archive):
+    # The ROM inside a zip, the first file with a ROM extension.
+    for info in archive.infolist():
+        if info.filename.lower().endswith(ROM_EXTENSIONS):
+            return info
+    raise zipfile.BadZipFile("No ROM found in the archive")
+
+
+def rom_filename_in(archive_path):
+    # The name of the ROM an archive holds.
+    archive_path = Path(archive_path)
+    if archive_format(archive_path) == FORMAT_ZIP:
+        with zipfile.ZipFile(archive_path) as archive:
+            return Path(_zip_member(archive).filename).name
+    return archive_path.stem
+
+
+def decompress_rom(archive_path, output_path):
+    # Extracts the ROM from an archive to output_path.
+    fmt = archive_format(archive_path)
+    with open(output_path, "wb") as output:
+        if fmt == FORMAT_ZIP:
+            with zipfile.ZipFile(archive_path) as archive, archive.open(_zip_member(archive)) as source:
+                shutil.copyfileobj(source, output, COPY_CHUNK_SIZE)
+        elif fmt == FORMAT_ZSTD:
+            if zstandard is None:
+                raise RuntimeError("zstandard is needed to open .zst ROMs, install it with pip install zstandard")
+            with open(archive_path, "rb") as source:
+                zstandard.ZstdDecompressor().copy_stream(source, output)
+        else:
+            raise ValueError(f"{archive_path} isn't a compressed ROM")
+    return Path(output_path)
+
+
+def _sha256(path):
+    hasher = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(COPY_CHUNK_SIZE), b""):
+            hasher.update(chunk)
+    return hasher.hexdigest()
+
+
+def convert_file(source_path, target_storage, fmt):
+    # Converts one installed ROM to the target storage, deleting the original once
+    # the new file is in place. Runs in a worker process, so it only takes paths.
+    # Returns (new path, sha256 of it).
+    source_path = Path(source_path)
+    directory = source_path.parent
+    source_format = archive_format(source_path)
+
+    if source_format:
+        rom_filename = rom_filename_in(source_path)
+        fd, raw_path = tempfile.mkstemp(suffix=".part", dir=directory)
+        os.close(fd)
+        raw_path = decompress_rom(source_path, raw_path)
+    else:
+        rom_filename = source_path.name
+        raw_path = source_path
+
+    try:
+        if target_storage == STORAGE_COMPRESSED:
+            new_path = compress_rom(raw_path, directory / archive_name(rom_filename, fmt), fmt, rom_filename)
+        else:
+            new_path = directory / rom_filename
+            if raw_path != new_path:
+                os.replace(raw_path, new_path)
+    finally:
+        if source_format and Path(raw_path).exists() and raw_path != directory / rom_filename:
+            Path(raw_path).unlink()
+
+    if source_path != new_path:
+        source_path.unlink(missing_ok=True)
+    return str(new_path), _sha256(new_path)
+
+
+def migrate_library(config, library, target_storage, workers=None):
+    # Converts every installed ROM to target_storage (full or compressed) across a
+    # pool of processes. Patch-only installs are left as they are.
+    # Returns {"converted", "skipped", "failed"} counts.
+    fmt = resolve_format(config.get_setting("compression_format", FORMAT_ZIP))
+    directory = Path(config.get_setting("patched_roms_dir"))
+    target_suffix = ARCHIVE_SUFFIXES[fmt] if target_storage == STORAGE_COMPRESSED else None
+
+    jobs = {}
+    skipped = 0
+    for rom_id in library.installed_ids():
+        entry = library.get(rom_id)
+        storage = entry.get("storage", STORAGE_ROM)
+        already_there = (storage == target_storage and
+                         (target_storage != STORAGE_COMPRESSED or entry["file"].endswith(target_suffix)))
+        if storage == STORAGE_PATCH or already_there:
+            skipped += 1
+            continue
+        jobs[rom_id] = entry
+
+    results = {"converted": 0, "skipped": skipped, "failed": 0}
+    if not jobs:
+        return results
+
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        futures = {pool.submit(convert_file, str(directory / entry["file"]), target_storage, fmt): rom_id for rom_id, entry in jobs.items()}
+        for future in as_completed(futures):
+            rom_id = futures[future]
+            try:
+                new_path, sha256 = future.result()
+            except Exception as e:
+                print(f"Could not convert {rom_id}: {e}")
+                results["failed"] += 1
+                continue
+            library.record_install(rom_id, new_path, jobs[rom_id].get("source_patch"), storage=target_storage, sha256=sha256)
+            results["converted"] += 1
+            print(f"Converted {rom_id} to {Path(new_path).name}")
+    return results
+
+
+def main(argv=None):
+    from config_manager import Config
+    from library import LibraryManifest
+
+    parser = argparse.ArgumentParser(description="Convert installed ROMs between storage modes.")
+    subcommands = parser.add_subparsers(dest="command", required=True)
+    migrate = subcommands.add_parser("migrate", help="Convert the whole library")
+    migrate.add_argument("--to", choices=[STORAGE_ROM, "full", STORAGE_COMPRESSED], required=True, help="Storage to convert to")
+    migrate.add_argument("--format", choices=list(ARCHIVE_SUFFIXES), help="Compression format, defaults to compression_format in config.json")
+    migrate.add_argument("-j", "--jobs", type=int, default=None, help="Worker processes, defaults to one per core")
+    args = parser.parse_args(argv)
+
+    config = Config()
+    if args.format:
+        config.config_data["compression_format"] = args.format
+    library = LibraryManifest(config)
+    library.reconcile()
+    target = STORAGE_COMPRESSED if args.to == STORAGE_COMPRESSED else STORAGE_ROM
+    results = migrate_library(config, library, target, args.jobs)
+    print(f"{results['converted']} converted, {results['skipped']} skipped, {results['failed']} failed.")
+    return 1 if results["failed"] else 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
@@ -0,0 +1,36 @@
+import contextlib
+import io
+import sys
+import unittest
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from base_roms import check_fingerprint
+
+FINGERPRINT = {"size": 4, "crc32": "0000abcd", "sha1": "aa"}
+
+
+class CheckFingerprintTests(unittest.TestCase):
+
+    def test_matches(self):
+        self.assertIsNone(check_fingerprint(FINGERPRINT, size=4, crc32="ABCD", sha1="AA"))
+        self.assertIsNone(check_fingerprint(FINGERPRINT, crc32=0xabcd))
+
+    def test_mismatches(self):
+        self.assertIn("CRC32", check_fingerprint(FINGERPRINT, crc32="1234"))
+        self.assertIn("SHA-1", check_fingerprint(FINGERPRINT, sha1="bb"))
+
+    def test_malformed_catalog_values_are_ignored(self):
+        # The rest of what's expected is still checked
+        with contextlib.redirect_stdout(io.StringIO()) as output:
+            self.assertIsNone(check_fingerprint(FINGERPRINT, crc32="zz", sha1=1234))
+            self.assertIsNone(check_fingerprint(FINGERPRINT, sha1=["aa"]))
+            self.assertIn("4 bytes", check_fingerprint(FINGERPRINT, size=8, sha1=1234))
+            self.assertIn("SHA-1", check_fingerprint(FINGERPRINT, crc32="zz", sha1="bb"))
+        self.assertIn("Ignoring malformed SHA-1 1234", output.getvalue())
+        self.assertIn("Ignoring malformed CRC32 'zz'", output.getvalue())
+
+
+if __name__ == "__main__":
+    unittest.main()
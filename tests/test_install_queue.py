@@ -0,0 +1,90 @@
+import contextlib
+import io
+import os
+import sys
+import tempfile
+import time
+import unittest
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from install_queue import DONE, InstallQueue
+
+CATALOG = {"duo": {"name": "Duo Quest", "system": "gba", "base_rom_id": "emerald", "patch_file": "duo.bps"}}
+
+
+class FakeRom:
+    # Stands in for a ROM, installing instantly without a server or base ROM.
+
+    def __init__(self, hack_id):
+        self.id = hack_id
+        self.name = hack_id
+        self.installs = 0
+
+    def download_patch(self, cancel_event=None, progress=None):
+        return "patch"
+
+    def apply_downloaded_patch(self, patch_path, cancel_event=None, progress=None):
+        self.installs += 1
+        return True
+
+
+def wait_for(queue):
+    deadline = time.monotonic() + 5
+    while queue.active_jobs():
+        if time.monotonic() > deadline:
+            raise AssertionError("install didn't finish")
+        time.sleep(0.01)
+
+
+class InstallQueueTests(unittest.TestCase):
+
+    def test_delete_then_reinstall(self):
+        from app import RomLauncherService
+        previous = os.getcwd()
+        with tempfile.TemporaryDirectory() as tmp, contextlib.redirect_stdout(io.StringIO()):
+            os.chdir(tmp)
+            try:
+                service = RomLauncherService(sync_on_start=False)
+                service._sync_roms(CATALOG)
+                rom = FakeRom("duo")
+                job = service.installs.submit(rom)
+                wait_for(service.installs)
+                self.assertEqual(job.state, DONE)
+
+                # What the real install leaves behind
+                rom_path = Path(service.config.get_setting("patched_roms_dir")) / "duo.gba"
+                rom_path.parent.mkdir(parents=True, exist_ok=True)
+                rom_path.write_bytes(b"rom")
+                service.library.record_install("duo", rom_path)
+
+                self.assertIs(service.delete_rom("duo"), True)
+                # Back in the available list with nothing left of the old install
+                self.assertIsNone(service.install_job("duo"))
+
+                job = service.installs.submit(rom)
+                wait_for(service.installs)
+                self.assertEqual(job.state, DONE)
+                self.assertEqual(rom.installs, 2)
+                service.installs.shutdown()
+                service.config.flush()
+            finally:
+                os.chdir(previous)
+
+    def test_forget_drops_finished_jobs(self):
+        class Config:
+            def get_setting(self, key, default=None):
+                return default
+        queue = InstallQueue(Config(), 1)
+        self.assertTrue(queue.forget("missing"))
+        job = queue.submit(FakeRom("solo"))
+        wait_for(queue)
+        self.assertEqual(job.state, DONE)
+        self.assertTrue(queue.forget("solo"))
+        self.assertIsNone(queue.get("solo"))
+        queue.shutdown()
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,55 @@
+import contextlib
+import io
+import os
+import sys
+import tempfile
+import unittest
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from catalog import read_catalog
+from search_index import SearchIndex, tokenize
+
+# Catalogs are whatever the server sends, so values aren't always strings
+CATALOG = {
+    "duo": {"name": "Duo Quest", "author": ["Alice Smith", "Bob"], "system": "gba", "base_rom_id": "emerald", "patch_file": "duo.bps"},
+    "solo": {"name": "Solo Run", "author": "Carol", "description": 42, "system": "gba", "base_rom_id": "emerald", "patch_file": "solo.bps"},
+}
+
+
+class TokenizeTests(unittest.TestCase):
+
+    def test_non_string_values(self):
+        self.assertEqual(tokenize(["Alice Smith", "Bob"]), ["alice", "smith", "bob"])
+        self.assertEqual(tokenize(42), ["42"])
+        self.assertEqual(tokenize(None), [])
+
+
+class SearchIndexTests(unittest.TestCase):
+
+    def test_list_author_is_searchable(self):
+        index = SearchIndex()
+        for entry in read_catalog(CATALOG).entries.values():
+            index.add(entry)
+        self.assertEqual(index.search("bob"), ["duo"])
+        self.assertEqual(index.search("42"), ["solo"])
+        self.assertEqual(index.search("", system="GBA"), ["duo", "solo"])
+
+    def test_list_author_survives_sync(self):
+        from app import RomLauncherService
+        previous = os.getcwd()
+        with tempfile.TemporaryDirectory() as tmp, contextlib.redirect_stdout(io.StringIO()):
+            os.chdir(tmp)
+            try:
+                service = RomLauncherService(sync_on_start=False)
+                changes = service._sync_roms(CATALOG)
+                self.assertEqual(sorted(changes["added"]), ["duo", "solo"])
+                self.assertEqual([rom.id for rom in service.get_all_hacks("alice")], ["duo"])
+                service.config.flush()
+            finally:
+                os.chdir(previous)
+
+
+if __name__ == "__main__":
+    unittest.main()
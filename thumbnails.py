@@ -0,0 +1,154 @@
+import hashlib
+import json
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from PIL import Image
+
+import tracing
+
+# On-disk cache of box art thumbnails, already resized for the list and stored as
+# raw RGBA so loading one is a single small read with no decoding or resampling.
+# Thumbnails are keyed by a hash of the source image and generated on worker threads.
+
+THUMBNAIL_SIZE = 160
+INDEX_FILENAME = "index.json"
+
+
+def thumbnail_dimensions(scale):
+    side = max(1, round(THUMBNAIL_SIZE * scale))
+    return side, side
+
+
+class ThumbnailCache:
+
+    def __init__(self, config, max_workers=2):
+        self.config = config
+        self._lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(max_workers=max_workers)
+        self._pending = set()
+        self._index = None # Source image filename -> content hash
+
+    @property
+    def directory(self):
+        return Path(self.config.get_setting("cache_dir", "cache")) / "thumbnails"
+
+    @property
+    def max_bytes(self):
+        return int(float(self.config.get_setting("thumbnail_cache_mb", 64)) * 1024 * 1024)
+
+    def _load_index(self):
+        # Callers must hold the lock.
+        if self._index is None:
+            try:
+                with open(self.directory / INDEX_FILENAME, "r") as f:
+                    self._index = json.load(f)
+            except (FileNotFoundError, json.JSONDecodeError, OSError):
+                self._index = {}
+        return self._index
+
+    def _save_index(self):
+        # Callers must hold the lock.
+        index_path = self.directory / INDEX_FILENAME
+        temp_path = index_path.with_name(INDEX_FILENAME + ".tmp")
+        try:
+            with open(temp_path, "w") as f:
+                json.dump(self._index, f)
+            os.replace(temp_path, index_path)
+        except OSError as e:
+            print(f"Could not save thumbnail index: {e}")
+
+    def _thumbnail_path(self, content_hash, scale):
+        width, height = thumbnail_dimensions(scale)
+        return self.directory / f"{content_hash}_{width}x{height}.rgba"
+
+    def get(self, source_path, scale=1.0, generate_missing=True):
+        # Returns the thumbnail as a PIL image, or None if it hasn't been made yet,
+        # in which case it's queued up so it's there next time (unless the caller
+        # is arranging that itself).
+        source_path = Path(source_path)
+        with self._lock:
+            content_hash = self._load_index().get(source_path.name)
+        if content_hash:
+            thumbnail_path = self._thumbnail_path(content_hash, scale)
+            try:
+                with open(thumbnail_path, "rb") as f:
+                    data = f.read()
+                # Touching the file keeps it at the fresh end of the LRU order.
+                os.utime(thumbnail_path)
+                tracing.count("thumbnail_cache.hit")
+                return Image.frombytes("RGBA", thumbnail_dimensions(scale), data)
+            except (OSError, ValueError):
+                pass
+        tracing.count("thumbnail_cache.miss")
+        if generate_missing:
+            self.generate_async(source_path, scale)
+        return None
+
+    def generate_async(self, source_path, scale=1.0):
+        # Queues a thumbnail to be made on the worker pool, unless it's already queued.
+        key = (str(source_path), scale)
+        with self._lock:
+            if key in self._pending:
+                return None
+            self._pending.add(key)
+        return self._executor.submit(self._generate, Path(source_path), scale, key)
+
+    def _generate(self, source_path, scale, key):
+        try:
+            return self.generate(source_path, scale)
+        finally:
+            with self._lock:
+                self._pending.discard(key)
+
+    def generate(self, source_path, scale=1.0):
+        # Decodes and resizes the source image once and stores the result.
+        source_path = Path(source_path)
+        try:
+            with open(source_path, "rb") as f:
+                source_bytes = f.read()
+            content_hash = hashlib.sha1(source_bytes).hexdigest()
+            thumbnail_path = self._thumbnail_path(content_hash, scale)
+            if not thumbnail_path.exists():
+                with Image.open(source_path) as image:
+                    thumbnail = image.convert("RGBA").resize(thumbnail_dimensions(scale), Image.Resampling.LANCZOS)
+                self.directory.mkdir(parents=True, exist_ok=True)
+                temp_path = thumbnail_path.with_name(thumbnail_path.name + ".tmp")
+                with open(temp_path, "wb") as f:
+                    f.write(thumbnail.tobytes())
+                os.replace(temp_path, thumbnail_path)
+        except Exception as e:
+            print(f"Could not make thumbnail for {source_path}: {e}")
+            return None
+
+        with self._lock:
+            index = self._load_index()
+            if index.get(source_path.name) != content_hash:
+                index[source_path.name] = content_hash
+                self._save_index()
+            self._evict()
+        return thumbnail_path
+
+    def _evict(self):
+        # Deletes the least recently used thumbnails until we're under the size cap.
+        # Callers must hold the lock.
+        try:
+            with os.scandir(self.directory) as scan:
+                files = [(entry.stat().st_mtime_ns, entry.stat().st_size, entry.path) for entry in scan if entry.name.endswith(".rgba")]
+        except OSError:
+            return
+        total = sum(size for _, size, _ in files)
+        if total <= self.max_bytes:
+            return
+        for _, size, path in sorted(files):
+            try:
+                os.remove(path)
+                total -= size
+            except OSError:
+                pass
+            if total <= self.max_bytes:
+                break
+
+    def shutdown(self):
+        self._executor.shutdown(wait=False, cancel_futures=True)
@@ -0,0 +1,190 @@
+import functools
+import json
+import os
+import threading
+import time
+from collections import deque
+from pathlib import Path
+
+# Timed spans and counters for finding out where time goes: network requests,
+# patching, launches and GUI refreshes, plus bytes downloaded, cache hits and
+# retries. Off unless tracing_enabled is set in config.json (or ROMHACK_TRACE is
+# set in the environment), and while it's off span() hands back a shared do-nothing
+# object and count() returns straight away, so leaving the calls in costs nothing.
+# The results can be saved as Chrome trace-event JSON, which chrome://tracing and
+# ui.perfetto.dev open, and are summarised in the Settings window.
+
+# Oldest events are dropped past this, so a long session can't grow without limit.
+MAX_EVENTS = 200000
+CATEGORY_DEFAULT = "app"
+
+_enabled = False
+_lock = threading.Lock()
+_events = deque(maxlen=MAX_EVENTS)
+_counters = {}
+_span_stats = {} # name -> [count, total seconds, max seconds]
+_origin = time.perf_counter()
+
+
+class _NullSpan:
+    # Stands in for a span while tracing is off.
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+    def set(self, **args):
+        pass
+
+
+NULL_SPAN = _NullSpan()
+
+
+class _Span:
+
+    def __init__(self, name, category, args):
+        self.name = name
+        self.category = category
+        self.args = args
+        self.start = None
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        end = time.perf_counter()
+        if exc_type is not None:
+            self.args["error"] = exc_type.__name__
+        _record_span(self, end)
+        return False
+
+    def set(self, **args):
+        # Adds details only known once the span is under way, like a response status.
+        self.args.update(args)
+
+
+def _record_span(span, end):
+    duration = end - span.start
+    event = {
+        "name": span.name,
+        "cat": span.category,
+        "ph": "X",
+        "ts": (span.start - _origin) * 1e6,
+        "dur": duration * 1e6,
+        "pid": os.getpid(),
+        "tid": threading.get_ident(),
+        "args": span.args,
+    }
+    with _lock:
+        _events.append(event)
+        stats = _span_stats.get(span.name)
+        if stats is None:
+            _span_stats[span.name] = [1, duration, duration]
+        else:
+            stats[0] += 1
+            stats[1] += duration
+            stats[2] = max(stats[2], duration)
+
+
+def configure(enabled):
+    global _enabled
+    _enabled = bool(enabled)
+
+
+def configure_from(config):
+    # Turns tracing on if the config or the environment asks for it. Never turns it
+    # off, so it can't undo tracing switched on some other way (like cli.py --trace).
+    if config.get_setting("tracing_enabled", False) or os.environ.get("ROMHACK_TRACE"):
+        configure(True)
+
+
+def is_enabled():
+    return _enabled
+
+
+def span(name, category=CATEGORY_DEFAULT, **args):
+    # Times the body of a with block:
+    #   with tracing.span("fetch.catalog", "network", url=url) as s:
+    #       ...
+    #       s.set(status=response.status_code)
+    if not _enabled:
+        return NULL_SPAN
+    return _Span(name, category, args)
+
+
+def traced(name, category=CATEGORY_DEFAULT):
+    # Decorator version of span() for whole functions.
+    def decorate(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if not _enabled:
+                return func(*args, **kwargs)
+            with _Span(name, category, {}):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorate
+
+
+def count(name, value=1):
+    # Adds to a named counter, like bytes downloaded or cache hits.
+    if not _enabled:
+        return
+    now = time.perf_counter()
+    with _lock:
+        total = _counters.get(name, 0) + value
+        _counters[name] = total
+        _events.append({"name": name, "ph": "C", "ts": (now - _origin) * 1e6, "pid": os.getpid(), "args": {name: total}})
+
+
+def snapshot():
+    # Totals so far: {"counters": {name: value}, "spans": {name: {count, total_ms, mean_ms, max_ms}}}.
+    with _lock:
+        spans = {name: {"count": calls, "total_ms": round(total * 1000, 3), "mean_ms": round(total * 1000 / calls, 3), "max_ms": round(longest * 1000, 3)}
+                 for name, (calls, total, longest) in _span_stats.items()}
+        return {"counters": dict(_counters), "spans": spans, "events": len(_events)}
+
+
+def format_summary(summary=None):
+    # A snapshot as plain text, slowest spans first.
+    summary = summary or snapshot()
+    if not summary["spans"] and not summary["counters"]:
+        return "Nothing recorded yet." if _enabled else "Tracing is off."
+    lines = [f"{'Span':<28}{'Calls':>7}{'Total ms':>12}{'Mean ms':>10}{'Max ms':>10}"]
+    for name, stats in sorted(summary["spans"].items(), key=lambda item: -item[1]["total_ms"]):
+        lines.append(f"{name:<28}{stats['count']:>7}{stats['total_ms']:>12.1f}{stats['mean_ms']:>10.2f}{stats['max_ms']:>10.1f}")
+    if summary["counters"]:
+        lines.append("")
+        lines.append(f"{'Counter':<28}{'Value':>17}")
+        for name, value in sorted(summary["counters"].items()):
+            lines.append(f"{name:<28}{value:>17,}")
+    return "\n".join(lines)
+
+
+def reset():
+    with _lock:
+        _events.clear()
+        _counters.clear()
+        _span_stats.clear()
+
+
+def export_chrome_trace(path):
+    # Writes everything recorded so far in Chrome's trace-event format.
+    with _lock:
+        events = list(_events)
+    names = {}
+    for event in events:
+        if "tid" in event and event["tid"] not in names:
+            names[event["tid"]] = {"name": "thread_name", "ph": "M", "pid": event["pid"], "tid": event["tid"], "args": {"name": f"thread {len(names)}"}}
+    main_thread = threading.main_thread().ident
+    if main_thread in names:
+        names[main_thread]["args"]["name"] = "main"
+
+    path = Path(path)
+    temp_path = path.with_name(path.name + ".tmp")
+    with open(temp_path, "w") as f:
+        json.dump({"traceEvents": list(names.values()) + events, "displayTimeUnit": "ms"}, f)
+    os.replace(temp_path, path)
+    return path
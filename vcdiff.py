@@ -0,0 +1,257 @@
+import os
+import zlib
+
+from patch_engine import MappedFile, PatchError
+from progress import PHASE_PATCH, report
+
+# Streaming VCDIFF (RFC 3284) decoder for xdelta3 patches.
+# The source ROM is memory mapped and the target is written one window at a
+# time, so peak memory is bounded by the largest window rather than the ROM size.
+
+DEFAULT_MEMORY_LIMIT = 64 * 1024 * 1024
+
+VCDIFF_MAGIC = b"\xD6\xC3\xC4\x00"
+
+# Header indicator bits.
+VCD_DECOMPRESS = 0x01
+VCD_CODETABLE = 0x02
+VCD_APPHEADER = 0x04  # xdelta3 extension
+
+# Window indicator bits.
+VCD_SOURCE = 0x01
+VCD_TARGET = 0x02
+VCD_ADLER32 = 0x04  # xdelta3 extension
+
+NOOP, ADD, RUN, COPY = 0, 1, 2, 3
+
+NEAR_SIZE = 4
+SAME_SIZE = 3
+
+
+class UnsupportedPatchError(PatchError):
+    # Raised for valid VCDIFF features we don't decode, e.g. secondary compression.
+    pass
+
+
+def _build_default_code_table():
+    # Default instruction code table from RFC 3284 section 5.6.
+    # Each entry is (inst1, size1, mode1, inst2, size2, mode2).
+    table = [(RUN, 0, 0, NOOP, 0, 0)]
+    table += [(ADD, size, 0, NOOP, 0, 0) for size in [0] + list(range(1, 18))]
+    for mode in range(9):
+        table += [(COPY, size, mode, NOOP, 0, 0) for size in [0] + list(range(4, 19))]
+    for mode in range(6):
+        table += [(ADD, add_size, 0, COPY, copy_size, mode) for add_size in range(1, 5) for copy_size in range(4, 7)]
+    for mode in range(6, 9):
+        table += [(ADD, add_size, 0, COPY, 4, mode) for add_size in range(1, 5)]
+    table += [(COPY, 4, mode, ADD, 1, 0) for mode in range(9)]
+    return table
+
+
+DEFAULT_CODE_TABLE = _build_default_code_table()
+
+
+class _Section:
+    # Cursor over one of a window's data, instruction or address sections.
+
+    def __init__(self, data, name):
+        self.data = data
+        self.name = name
+        self.pos = 0
+
+    def read(self, length):
+        if self.pos + length > len(self.data):
+            raise PatchError(f"VCDIFF {self.name} section is truncated.")
+        chunk = self.data[self.pos:self.pos + length]
+        self.pos += length
+        return chunk
+
+    def read_byte(self):
+        if self.pos >= len(self.data):
+            raise PatchError(f"VCDIFF {self.name} section is truncated.")
+        value = self.data[self.pos]
+        self.pos += 1
+        return value
+
+    def read_int(self):
+        # VCDIFF integers are big-endian base 128, high bit set on all but the last byte.
+        value = 0
+        while True:
+            byte = self.read_byte()
+            value = (value << 7) | (byte & 0x7F)
+            if not byte & 0x80:
+                return value
+
+
+class _StreamReader:
+    # Reads header fields straight from the patch file so we never hold the whole patch.
+
+    def __init__(self, f):
+        self.f = f
+
+    def read(self, length):
+        data = self.f.read(length)
+        if len(data) != length:
+            raise PatchError("VCDIFF patch is truncated.")
+        return data
+
+    def read_byte(self):
+        return self.read(1)[0]
+
+    def read_int(self):
+        value = 0
+        for _ in range(10):
+            byte = self.read_byte()
+            value = (value << 7) | (byte & 0x7F)
+            if not byte & 0x80:
+                return value
+        raise PatchError("VCDIFF integer is too long.")
+
+    def at_end(self):
+        peek = self.f.peek(1) if hasattr(self.f, "peek") else b""
+        return not peek
+
+
+class _AddressCache:
+    # The near/same address caches from RFC 3284 section 5.1, reset per window.
+
+    def __init__(self):
+        self.near = [0] * NEAR_SIZE
+        self.next_slot = 0
+        self.same = [0] * (SAME_SIZE * 256)
+
+    def decode(self, addresses, here, mode):
+        if mode == 0:
+            addr = addresses.read_int()
+        elif mode == 1:
+            addr = here - addresses.read_int()
+        elif mode - 2 < NEAR_SIZE:
+            addr = self.near[mode - 2] + addresses.read_int()
+        else:
+            m = mode - (2 + NEAR_SIZE)
+            addr = self.same[m * 256 + addresses.read_byte()]
+        self.near[self.next_slot] = addr
+        self.next_slot = (self.next_slot + 1) % NEAR_SIZE
+        self.same[addr % (SAME_SIZE * 256)] = addr
+        return addr
+
+
+def _read_file_header(reader):
+    if reader.read(4) != VCDIFF_MAGIC:
+        raise PatchError("Not a VCDIFF/xdelta patch (bad magic).")
+    indicator = reader.read_byte()
+    if indicator & VCD_DECOMPRESS:
+        compressor = reader.read_byte()
+        raise UnsupportedPatchError(f"VCDIFF secondary compression (id {compressor}) isn't supported.")
+    if indicator & VCD_CODETABLE:
+        raise UnsupportedPatchError("VCDIFF custom code tables aren't supported.")
+    if indicator & VCD_APPHEADER:
+        reader.read(reader.read_int())
+
+
+def _decode_window(reader, source, output, memory_limit):
+    # Decodes one window and returns the target bytes for it.
+    indicator = reader.read_byte()
+    segment = None
+    segment_length = segment_position = 0
+    if indicator & (VCD_SOURCE | VCD_TARGET):
+        segment_length = reader.read_int()
+        segment_position = reader.read_int()
+
+    delta_length = reader.read_int()
+    target_length = reader.read_int()
+    window_memory = delta_length + target_length
+    if indicator & VCD_TARGET:
+        window_memory += segment_length
+    if window_memory > memory_limit:
+        raise PatchError(
+            f"VCDIFF window needs {window_memory / (1024 * 1024):.1f} MB, "
+            f"over the {memory_limit / (1024 * 1024):.1f} MB patch memory limit."
+        )
+
+    delta_indicator = reader.read_byte()
+    if delta_indicator:
+        raise UnsupportedPatchError("VCDIFF secondary compression isn't supported.")
+    data_length = reader.read_int()
+    inst_length = reader.read_int()
+    addr_length = reader.read_int()
+    checksum = int.from_bytes(reader.read(4), "big") if indicator & VCD_ADLER32 else None
+
+    data = _Section(reader.read(data_length), "data")
+    instructions = _Section(reader.read(inst_length), "instruction")
+    addresses = _Section(reader.read(addr_length), "address")
+
+    if indicator & VCD_SOURCE:
+        if segment_position + segment_length > len(source):
+            raise PatchError("VCDIFF source window is outside the base ROM.")
+        segment = source
+    elif indicator & VCD_TARGET:
+        # Copies come from target data we've already written out.
+        output.flush()
+        output.seek(segment_position)
+        segment = output.read(segment_length)
+        output.seek(0, 2)
+        segment_position = 0
+        if len(segment) != segment_length:
+            raise PatchError("VCDIFF target window is outside the decoded output.")
+
+    target = bytearray()
+    cache = _AddressCache()
+
+    def copy(addr, size):
+        if addr < segment_length:
+            count = min(size, segment_length - addr)
+            start = segment_position + addr
+            target.extend(segment[start:start + count])
+            addr += count
+            size -= count
+        if size:
+            start = addr - segment_length
+            if start + size <= len(target):
+                target.extend(target[start:start + size])
+            else:
+                # Overlapping copy repeats the bytes between start and the end of target.
+                pattern = target[start:]
+                if not pattern:
+                    raise PatchError("VCDIFF copy address is past the decoded data.")
+                target.extend((pattern * (size // len(pattern) + 1))[:size])
+
+    def execute(inst, size, mode):
+        if inst == NOOP:
+            return
+        if size == 0:
+            size = instructions.read_int()
+        if inst == ADD:
+            target.extend(data.read(size))
+        elif inst == RUN:
+            target.extend(data.read(1) * size)
+        else:
+            here = segment_length + len(target)
+            addr = cache.decode(addresses, here, mode)
+            if addr >= here:
+                raise PatchError("VCDIFF copy address is past the decoded data.")
+            copy(addr, size)
+
+    while instructions.pos < len(instructions.data):
+        inst1, size1, mode1, inst2, size2, mode2 = DEFAULT_CODE_TABLE[instructions.read_byte()]
+        execute(inst1, size1, mode1)
+        execute(inst2, size2, mode2)
+
+    if len(target) != target_length:
+        raise PatchError("VCDIFF window decoded to the wrong size.")
+    if checksum is not None and zlib.adler32(target) != checksum:
+        raise PatchError("Patched ROM checksum mismatch, output is invalid.")
+    return target
+
+
+def apply_vcdiff(patch_file, input_file, output_file, memory_limit=DEFAULT_MEMORY_LIMIT, progress=None):
+    # VCDIFF doesn't say how big the target is up front, so progress is
+    # measured by how far through the patch file we are.
+    patch_size = os.path.getsize(patch_file)
+    with open(patch_file, "rb") as patch_f, MappedFile(input_file) as source, open(output_file, "w+b") as output:
+        reader = _StreamReader(patch_f)
+        _read_file_header(reader)
+        while not reader.at_end():
+            output.write(_decode_window(reader, source, output, memory_limit))
+            report(progress, PHASE_PATCH, patch_f.tell(), patch_size)
+    return True